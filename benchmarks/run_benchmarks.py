@@ -0,0 +1,651 @@
+"""
+Benchmarks for the EZ-PB orchestration layer, run against the simulated PhyloBayes commands in [simulator.py] so that
+they measure EZ-PB rather than the MCMC. They are orchestration-only: the simulated [tracecomp] and [bpcomp] compute
+their outputs with EZ-PB's own diagnostics, so these benchmarks measure cost and scheduling, not whether the diagnostics
+are right.
+
+    checker_latency
+        The wall time, CPU time and I/O of a single convergence check, for chains of several lengths: a cold check that
+        reads every chain file from the start, an incremental check that only reads what the chains have appended since
+        the previous check, and a check that goes through the (simulated) external commands, which measures the cost of
+        running and parsing them rather than that of the real [tracecomp] and [bpcomp].
+    time_to_stop
+        How long EZ-PB lets the chains of converged alignments run on: the number of generations, and the seconds of
+        chain time, between the first generation at which EZ-PB's own check would have passed and the generation at
+        which the chains were stopped. This measures the delay of the checking loop, not when the chains really
+        converged.
+    scaling
+        The wall time and the CPU time of the EZ-PB process for a batch of many small alignments.
+
+Every result is appended as one JSON object per line to the results file (benchmarks/results.jsonl by default), along
+with the git revision of the tree it was measured on, so that the [compare] command can show how the metrics have
+changed from one version to the next.
+
+The [reference] command is the one that checks the accuracy of EZ-PB's own diagnostics, against the outputs of the real
+[tracecomp] and [bpcomp] recorded for the PhyloBayes chains in benchmarks/reference.
+"""
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+import ezpb  # noqa: E402
+import simulator  # noqa: E402
+
+RESULTS_FILE = os.path.join(BENCHMARKS_DIR, 'results.jsonl')
+SIMULATED_COMMANDS = ['mpirun', 'tracecomp', 'bpcomp']
+
+# Three chains of 500 generations and one of 400 of pb_mpi -poisson -ncat 1 on a 10 taxon alignment (the branch lengths
+# have been taken out of the tree lists), and the outputs of tracecomp and bpcomp for them; tracecomp cuts the chains
+# down to the length of the shortest one, and bpcomp does not
+REFERENCE_DIR = os.path.join(BENCHMARKS_DIR, 'reference')
+REFERENCE_FILE = os.path.join(REFERENCE_DIR, 'reference.json')
+REFERENCE_CHAINS = [['ref_1', 'ref_2'], ['ref_1', 'ref_2', 'ref_3'], ['ref_1', 'ref_2', 'ref_4']]
+REFERENCE_BURN_INS = [50, 100, 250]
+REFERENCE_SAMPLE_FREQS = [1, 5]
+# tracecomp and bpcomp print six significant digits
+REFERENCE_TOLERANCE = 1e-5
+
+# The parameters of each benchmark, for a quick run and for a full one
+PRESETS = {
+    'quick': {
+        'checker_latency': {'sizes': [1000, 5000, 20000], 'chains': 2, 'taxa': 30, 'step': 300, 'repeats': 3},
+        'time_to_stop': {'alignments': 2, 'chains': 2, 'rate': 300, 'converge_at': 400, 'min_cycles': 200,
+                         'check_freq': 1, 'max_loglik_effsize': 100},
+        'scaling': {'alignments': 20, 'chains': 2, 'threads': 4, 'rate': 500, 'min_cycles': 50},
+    },
+    'full': {
+        'checker_latency': {'sizes': [1000, 10000, 50000, 100000], 'chains': 4, 'taxa': 50, 'step': 1000,
+                            'repeats': 5},
+        'time_to_stop': {'alignments': 8, 'chains': 2, 'rate': 200, 'converge_at': 1000, 'min_cycles': 500,
+                         'check_freq': 5, 'max_loglik_effsize': 300},
+        'scaling': {'alignments': 2000, 'chains': 2, 'threads': 16, 'rate': 2000, 'min_cycles': 50},
+    },
+}
+
+
+def write_simulator_bin(directory):
+    """
+    Write the wrapper scripts that make the simulator stand in for [mpirun], [tracecomp] and [bpcomp], and return the
+    directory to put first on the PATH.
+
+    :param directory: The directory to create the bin directory in.
+    """
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in SIMULATED_COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n'
+                    % (sys.executable, os.path.join(BENCHMARKS_DIR, 'simulator.py'), command))
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+def simulator_environment(bin_dir, **parameters):
+    """
+    Return a copy of the environment with the simulator first on the PATH and the given simulation parameters set.
+
+    :param bin_dir: The directory returned by [write_simulator_bin].
+    :param parameters: Simulation parameters, named as in [simulator.py] without the EZPB_SIM_ prefix, in lower case.
+    """
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    for name, value in parameters.items():
+        env['EZPB_SIM_%s' % name.upper()] = str(value)
+    return env
+
+
+def write_alignments(directory, count, taxa=10, sites=100):
+    """
+    Write a number of small PHYLIP alignments, and return their paths. Their contents do not matter to the simulator,
+    but their sizes are used by EZ-PB's cost model.
+
+    :param directory: The directory to write the alignments to.
+    :param count: The number of alignments.
+    :param taxa: The number of taxa in each alignment.
+    :param sites: The number of sites in each alignment.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'gene%05d.phy' % i)
+        with open(path, 'w') as f:
+            f.write('%d %d\n' % (taxa, sites))
+            for t in range(taxa):
+                f.write('t%d %s\n' % (t, ''.join(rng.choice('ACGT') for s in range(sites))))
+        paths.append(path)
+    return paths
+
+
+def io_counters():
+    """
+    Return the number of bytes this process has read and written, from /proc/self/io, or [None] where it is not
+    available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def measure(fn, *args):
+    """
+    Call a function, and return its result along with the wall time, the CPU time (user and system) of this process and
+    of the child processes it waited for, and the bytes read and written by this process while it ran.
+
+    :param fn: The function to call.
+    :param args: The arguments to call it with.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = io_counters()
+    start = time.perf_counter()
+    result = fn(*args)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    after_io = io_counters()
+    metrics = {
+        'wall': wall,
+        'cpu': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        'child_cpu': ((after_children.ru_utime - children.ru_utime)
+                      + (after_children.ru_stime - children.ru_stime)),
+    }
+    if io is not None and after_io is not None:
+        metrics['read_bytes'] = after_io[0] - io[0]
+        metrics['write_bytes'] = after_io[1] - io[1]
+    return result, metrics
+
+
+def mean_metrics(samples):
+    """
+    Return the mean of each metric over a list of samples, as returned by [measure].
+
+    :param samples: The samples.
+    """
+    return {name: sum(sample[name] for sample in samples) / len(samples) for name in samples[0]}
+
+
+def run_check(directory, alignment, chains, min_cycles, diagnostics='native', readers=None):
+    """
+    Run one convergence check on simulated chains, with thresholds that are never met so that the check does all of its
+    work.
+
+    :param directory: The directory of the chain files.
+    :param alignment: The name of the alignment.
+    :param chains: The names of the chains.
+    :param min_cycles: The minimum number of generations for the check.
+    :param diagnostics: One of [ezpb.DIAGNOSTICS_MODES].
+    :param readers: A tuple of the trace readers, trace diagnostics and bipartition index to reuse, or [None] to read
+    the chain files from the start.
+    """
+    trace_readers, trace_diagnostics, bipartition_index = readers or (None, None, None)
+    return asyncio.get_event_loop().run_until_complete(ezpb.check_thresholds(
+        alignment, chains, min_cycles, float('inf'), float('inf'), 0.0, 0.0, work_dir=directory,
+        trace_readers=trace_readers, trace_diagnostics=trace_diagnostics, bipartition_index=bipartition_index,
+        diagnostics=diagnostics))
+
+
+def benchmark_checker_latency(work_dir, bin_dir, sizes, chains, taxa, step, repeats):
+    """
+    Measure a single convergence check on chains of each of the given lengths. Return a list of results.
+
+    :param work_dir: A scratch directory.
+    :param bin_dir: The directory of the simulated commands.
+    :param sizes: The chain lengths, in generations.
+    :param chains: The number of chains.
+    :param taxa: The number of taxa in the trees.
+    :param step: The number of generations the chains advance between incremental checks.
+    :param repeats: The number of checks to average over.
+    """
+    alignment = 'bench'
+    chain_names = ['chain_%d' % (i + 1) for i in range(chains)]
+    results = []
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    for size in sizes:
+        directory = os.path.join(work_dir, 'latency_%d' % size)
+        os.makedirs(directory)
+        simulated = {name: simulator.write_chain(directory, alignment, ezpb.chain_full_name(alignment, name), size,
+                                                 taxa, size // 2)
+                     for name in chain_names}
+        metrics = {}
+
+        cold = [measure(run_check, directory, alignment, chain_names, 0)[1] for i in range(repeats)]
+        metrics['cold'] = mean_metrics(cold)
+
+        readers = ezpb.trace_readers_for(alignment, chain_names, directory)
+        readers = (readers, ezpb.TraceDiagnostics(readers),
+                   ezpb.bipartition_index_for(alignment, chain_names, directory))
+        run_check(directory, alignment, chain_names, 0, readers=readers)
+        incremental = []
+        generations = size
+        for i in range(repeats):
+            for name, chain in simulated.items():
+                simulator.append_generations(directory, ezpb.chain_full_name(alignment, name), chain, generations,
+                                             generations + step)
+            generations += step
+            incremental.append(measure(run_check, directory, alignment, chain_names, 0, 'native', readers)[1])
+        metrics['incremental'] = mean_metrics(incremental)
+
+        external = [measure(run_check, directory, alignment, chain_names, 0, 'external')[1] for i in range(repeats)]
+        metrics['external'] = mean_metrics(external)
+
+        click.echo('  %d generations: cold %.3fs, incremental %.3fs, external %.3fs'
+                   % (size, metrics['cold']['wall'], metrics['incremental']['wall'], metrics['external']['wall']))
+        results.append(({'generations': size, 'chains': chains, 'taxa': taxa, 'step': step}, metrics))
+        shutil.rmtree(directory)
+    return results
+
+
+def ezpb_command(alignment_dir, chains, cpu_file, *options):
+    """
+    Return the command to run EZ-PB on a directory of alignments in a child process that writes its own CPU time to a
+    file when it exits.
+
+    :param alignment_dir: The directory of alignments.
+    :param chains: The number of chains per alignment.
+    :param cpu_file: The file to write the CPU time to.
+    :param options: Any further command line options.
+    """
+    script = ('import atexit, resource, sys\n'
+              'sys.path.insert(0, %r)\n'
+              'def dump():\n'
+              '    usage = resource.getrusage(resource.RUSAGE_SELF)\n'
+              '    open(%r, "w").write("%%f" %% (usage.ru_utime + usage.ru_stime))\n'
+              'atexit.register(dump)\n'
+              'import ezpb\n'
+              'ezpb.main()\n') % (REPO_DIR, cpu_file)
+    return [sys.executable, '-W', 'ignore', '-c', script] + list(options) + [alignment_dir, str(chains)]
+
+
+def run_ezpb(work_dir, env, alignment_dir, chains, *options):
+    """
+    Run EZ-PB to completion in a child process, and return its wall time and its CPU time (not counting the chains).
+
+    :param work_dir: The directory to run EZ-PB in.
+    :param env: The environment to run EZ-PB with.
+    :param alignment_dir: The directory of alignments.
+    :param chains: The number of chains per alignment.
+    :param options: Any further command line options.
+    """
+    cpu_file = os.path.join(work_dir, 'ezpb.cpu')
+    start = time.perf_counter()
+    subprocess.run(ezpb_command(alignment_dir, chains, cpu_file, *options), cwd=work_dir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    with open(cpu_file) as f:
+        cpu = float(f.read())
+    return wall, cpu
+
+
+def first_passing_generation(directory, alignment, chains, stop, min_cycles, thresholds, every):
+    """
+    Replay the checks on the saved chain files of an alignment, and return the first generation (to within [every]) at
+    which the chains would have passed the check, or [None] if they never would have.
+
+    :param directory: The directory of the saved chain files.
+    :param alignment: The name of the alignment.
+    :param chains: The names of the chains.
+    :param stop: The generation at which the chains were stopped.
+    :param min_cycles: The minimum number of generations for a check.
+    :param thresholds: The convergence thresholds, as keyword arguments to [ezpb.check_thresholds].
+    :param every: The number of generations between replayed checks.
+    """
+    replay = tempfile.mkdtemp(dir=directory)
+    try:
+        for generation in range(min_cycles, stop + 1, every):
+            for chain in chains:
+                full_name = ezpb.chain_full_name(alignment, chain)
+                for extension in ('.trace', '.treelist'):
+                    # the trace has a header line, the tree list does not
+                    keep = generation + 1 + (extension == '.trace')
+                    with open(os.path.join(directory, full_name + extension)) as source, \
+                            open(os.path.join(replay, full_name + extension), 'w') as target:
+                        for i, line in enumerate(source):
+                            if i >= keep:
+                                break
+                            target.write(line)
+            convergence = asyncio.get_event_loop().run_until_complete(ezpb.check_thresholds(
+                alignment, chains, min_cycles, float('inf'), work_dir=replay, **thresholds))
+            if convergence is not None and convergence.converged:
+                return generation
+        return None
+    finally:
+        shutil.rmtree(replay)
+
+
+def trace_times(path):
+    """
+    Return a dictionary mapping each generation of a trace file to the chain time at which it was written.
+
+    :param path: The path to the trace file.
+    """
+    with open(path) as f:
+        rows = [line.split() for line in f if not line.startswith('#')]
+    return {int(row[0]): float(row[1]) for row in rows if len(row) > 1}
+
+
+def benchmark_time_to_stop(work_dir, bin_dir, alignments, chains, rate, converge_at, min_cycles, check_freq,
+                           max_loglik_effsize):
+    """
+    Run EZ-PB on simulated alignments until they converge, and measure how far past convergence their chains ran.
+    Return a list of results.
+
+    :param work_dir: A scratch directory.
+    :param bin_dir: The directory of the simulated commands.
+    :param alignments: The number of alignments.
+    :param chains: The number of chains per alignment.
+    :param rate: The generations per second of each chain.
+    :param converge_at: The generation at which the simulated chains converge.
+    :param min_cycles: The minimum number of generations before checking.
+    :param check_freq: The time between checks, in seconds.
+    :param max_loglik_effsize: The log likelihood effective size the chains must exceed.
+    """
+    directory = os.path.join(work_dir, 'time_to_stop')
+    alignment_dir = os.path.join(directory, 'alignments')
+    paths = write_alignments(alignment_dir, alignments)
+    env = simulator_environment(bin_dir, rate=rate, converge_at=converge_at)
+    os.environ['PATH'] = env['PATH']
+    wall, cpu = run_ezpb(directory, env, alignment_dir, chains, '--threads', str(alignments * chains),
+                         '--threads-per-chain', '1', '--check-freq', str(check_freq), '--min-cycles', str(min_cycles),
+                         '--max-loglik-effsize', str(max_loglik_effsize), '--burn-in', 'fixed', '--fixed')
+
+    chain_names = ['chain_%d' % (i + 1) for i in range(chains)]
+    thresholds = {'max_loglik_effsize': max_loglik_effsize, 'min_loglik_rel_diff': ezpb.MIN_LOGLIK_REL_DIFF,
+                  'min_maxdiff': ezpb.MIN_MAXDIFF, 'burn_in': 'fixed'}
+    overshoot_generations = []
+    overshoot_seconds = []
+    for path in paths:
+        alignment = ezpb.alignment_name(path)
+        saved = os.path.join(directory, ezpb.OUTPUT_DIRECTORY, 'analyses', alignment)
+        traces = [trace_times(os.path.join(saved, '%s.trace' % ezpb.chain_full_name(alignment, chain)))
+                  for chain in chain_names]
+        stop = min(max(times) for times in traces)
+        first = first_passing_generation(saved, alignment, chain_names, stop, min_cycles, thresholds,
+                                         max(rate // 10, 1))
+        if first is None:
+            continue
+        overshoot_generations.append(stop - first)
+        overshoot_seconds.append(max(times[stop] - times[first] for times in traces))
+
+    metrics = {'wall': wall, 'cpu': cpu, 'converged': len(overshoot_generations)}
+    if overshoot_generations:
+        metrics['overshoot_generations'] = sum(overshoot_generations) / len(overshoot_generations)
+        metrics['overshoot_seconds'] = sum(overshoot_seconds) / len(overshoot_seconds)
+        click.echo('  %d of %d converged, %.0f generations (%.2fs) past convergence on average'
+                   % (len(overshoot_generations), alignments, metrics['overshoot_generations'],
+                      metrics['overshoot_seconds']))
+    parameters = {'alignments': alignments, 'chains': chains, 'rate': rate, 'converge_at': converge_at,
+                  'min_cycles': min_cycles, 'check_freq': check_freq, 'max_loglik_effsize': max_loglik_effsize}
+    return [(parameters, metrics)]
+
+
+def benchmark_scaling(work_dir, bin_dir, alignments, chains, threads, rate, min_cycles):
+    """
+    Run EZ-PB on a batch of small simulated alignments, stopping each at the maximum number of generations, and measure
+    the throughput and the CPU time of the EZ-PB process itself. Return a list of results.
+
+    :param work_dir: A scratch directory.
+    :param bin_dir: The directory of the simulated commands.
+    :param alignments: The number of alignments.
+    :param chains: The number of chains per alignment.
+    :param threads: The number of threads to run the chains on.
+    :param rate: The generations per second of each chain.
+    :param min_cycles: The minimum (and maximum) number of generations of each chain.
+    """
+    directory = os.path.join(work_dir, 'scaling')
+    alignment_dir = os.path.join(directory, 'alignments')
+    write_alignments(alignment_dir, alignments)
+    env = simulator_environment(bin_dir, rate=rate, converge_at=min_cycles)
+    wall, cpu = run_ezpb(directory, env, alignment_dir, chains, '--threads', str(threads), '--threads-per-chain', '1',
+                         '--check-freq', '0.2', '--min-cycles', str(min_cycles), '--max-gen', str(min_cycles),
+                         '--fixed')
+    metrics = {'wall': wall, 'cpu': cpu, 'alignments_per_second': alignments / wall,
+               'cpu_per_alignment': cpu / alignments}
+    click.echo('  %d alignments in %.1fs (%.1f/s), %.3fs of EZ-PB CPU time per alignment'
+               % (alignments, wall, metrics['alignments_per_second'], metrics['cpu_per_alignment']))
+    parameters = {'alignments': alignments, 'chains': chains, 'threads': threads, 'rate': rate,
+                  'min_cycles': min_cycles}
+    return [(parameters, metrics)]
+
+
+BENCHMARKS = {
+    'checker_latency': benchmark_checker_latency,
+    'time_to_stop': benchmark_time_to_stop,
+    'scaling': benchmark_scaling,
+}
+
+
+def record_reference(work_dir):
+    """
+    Run [tracecomp] and [bpcomp], which must be on the PATH, on the reference chains, and return their outputs: one
+    dictionary for every set of chains and every burn-in.
+
+    :param work_dir: The directory to run the commands in.
+    """
+    for file in os.listdir(REFERENCE_DIR):
+        if file.endswith('.trace') or file.endswith('.treelist'):
+            shutil.copy(os.path.join(REFERENCE_DIR, file), work_dir)
+
+    def run_command(*args):
+        subprocess.check_call(args, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    outputs = []
+    for chains in REFERENCE_CHAINS:
+        for discard in REFERENCE_BURN_INS:
+            chain_effsizes = []
+            for chain in chains:
+                run_command('tracecomp', '-x', '%d' % discard, chain)
+                chain_effsizes.append(ezpb.data_from_tracecomp_file(work_dir)[0])
+            run_command('tracecomp', '-x', '%d' % discard, *chains)
+            effsize, rel_diff = ezpb.data_from_tracecomp_file(work_dir)
+            max_diffs = {}
+            for every in REFERENCE_SAMPLE_FREQS:
+                run_command('bpcomp', '-x', '%d' % discard, '%d' % every, *chains)
+                max_diffs['%d' % every] = ezpb.data_from_bpcomp_file(work_dir)
+            outputs.append({'chains': chains, 'discard': discard, 'effsize': effsize, 'rel_diff': rel_diff,
+                            'chain_effsizes': chain_effsizes, 'max_diff': max_diffs})
+    return outputs
+
+
+def check_reference(output):
+    """
+    Compute EZ-PB's own diagnostics for one of the recorded outputs of [record_reference], and return a list of the
+    comparisons, as tuples (name, the value from PhyloBayes, the value from EZ-PB, whether they agree as they should).
+
+    Every value must be the same, to the precision that [tracecomp] and [bpcomp] print: the effective sizes, of every
+    chain and of the chains together, which [tracecomp] prints as integers, the relative difference, and the maximum
+    difference for every tree and for every [every]th tree after the burn-in.
+
+    :param output: The recorded output.
+    """
+    chains, discard = output['chains'], output['discard']
+    readers = {chain: ezpb.TraceReader(os.path.join(REFERENCE_DIR, '%s.trace' % chain)) for chain in chains}
+    for reader in readers.values():
+        reader.update()
+    effsize, rel_diff = ezpb.TraceDiagnostics(readers).compute(discard)
+    comparisons = [('rel_diff', output['rel_diff'], rel_diff,
+                    abs(rel_diff - output['rel_diff']) <= REFERENCE_TOLERANCE * max(output['rel_diff'], 1.0))]
+    for chain, expected in zip(chains, output['chain_effsizes']):
+        actual = int(ezpb.effective_sample_size(readers[chain].column(ezpb.LOGLIK_COLUMN)[discard:]))
+        comparisons.append(('effsize %s' % chain, expected, actual, actual == expected))
+    comparisons.append(('effsize', output['effsize'], effsize, effsize == output['effsize']))
+    for every in REFERENCE_SAMPLE_FREQS:
+        index = ezpb.BipartitionIndex({chain: os.path.join(REFERENCE_DIR, '%s.treelist' % chain) for chain in chains},
+                                      every)
+        expected = output['max_diff']['%d' % every]
+        max_diff = index.max_diff(discard)
+        comparisons.append(('max_diff every %d' % every, expected, max_diff,
+                            abs(max_diff - expected) <= REFERENCE_TOLERANCE))
+    return comparisons
+
+
+def git_revision():
+    """
+    Return the git revision of the tree, marked as dirty if it has uncommitted changes, or [None] outside of git.
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                        stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+@click.group()
+def cli():
+    """
+    Benchmark the EZ-PB orchestration layer against simulated PhyloBayes commands.
+    """
+
+
+@cli.command()
+@click.option('--preset', type=click.Choice(sorted(PRESETS)), default='quick',
+              help='How big to make the benchmarks.')
+@click.option('--benchmark', 'benchmarks', type=click.Choice(sorted(BENCHMARKS)), multiple=True,
+              help='A benchmark to run. May be given more than once; by default, every benchmark is run.')
+@click.option('--label', type=str, default=None,
+              help='A label to store with the results, to tell apart runs of the same revision.')
+@click.option('--results', type=str, default=RESULTS_FILE,
+              help='The file to append the results to.')
+def run(preset, benchmarks, label, results):
+    """
+    Run the benchmarks, and append their results to the results file.
+    """
+    revision = git_revision()
+    work_dir = tempfile.mkdtemp(prefix='ezpb-bench-')
+    try:
+        bin_dir = write_simulator_bin(work_dir)
+        for name in benchmarks or sorted(BENCHMARKS):
+            click.echo('%s:' % name)
+            for parameters, metrics in BENCHMARKS[name](work_dir, bin_dir, **PRESETS[preset][name]):
+                record = {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'revision': revision,
+                    'label': label,
+                    'python': platform.python_version(),
+                    'benchmark': name,
+                    'preset': preset,
+                    'parameters': parameters,
+                    'metrics': metrics,
+                }
+                with open(results, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def flatten(metrics, prefix=''):
+    """
+    Flatten nested metrics into a dictionary mapping dotted names to values.
+
+    :param metrics: The metrics, as stored in a result.
+    :param prefix: The prefix for the names.
+    """
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s%s.' % (prefix, name)))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+
+@cli.command()
+@click.option('--results', type=str, default=RESULTS_FILE,
+              help='The file to read the results from.')
+@click.option('--benchmark', type=click.Choice(sorted(BENCHMARKS)), default=None,
+              help='Only compare the results of this benchmark.')
+def compare(results, benchmark):
+    """
+    Print the latest results of each benchmark for each revision side by side, with the change relative to the first
+    revision.
+    """
+    latest = {}
+    revisions = []
+    with open(results) as f:
+        for line in f:
+            record = json.loads(line)
+            if benchmark is not None and record['benchmark'] != benchmark:
+                continue
+            revision = record['revision'] or 'unknown'
+            if record['label']:
+                revision = '%s (%s)' % (revision, record['label'])
+            if revision not in revisions:
+                revisions.append(revision)
+            key = (record['benchmark'], record['preset'], json.dumps(record['parameters'], sort_keys=True))
+            latest.setdefault(key, {})[revision] = flatten(record['metrics'])
+
+    for (name, preset, parameters), by_revision in sorted(latest.items()):
+        click.echo('%s [%s] %s' % (name, preset, parameters))
+        present = [revision for revision in revisions if revision in by_revision]
+        baseline = by_revision[present[0]]
+        for metric in sorted(baseline):
+            cells = []
+            for revision in present:
+                value = by_revision[revision].get(metric)
+                if value is None:
+                    cells.append('%s: -' % revision)
+                elif revision == present[0] or not baseline[metric]:
+                    cells.append('%s: %.4g' % (revision, value))
+                else:
+                    cells.append('%s: %.4g (%+.1f%%)' % (revision, value, 100.0 * (value / baseline[metric] - 1)))
+            click.echo('  %-32s %s' % (metric, '  '.join(cells)))
+
+
+@cli.command()
+@click.option('--record', is_flag=True,
+              help='Run tracecomp and bpcomp, which must be on the PATH, on the reference chains, and record their '
+                   + 'outputs, rather than checking against the recorded outputs.')
+def reference(record):
+    """
+    Check EZ-PB's own convergence diagnostics against the outputs of tracecomp and bpcomp recorded for the reference
+    chains. Exits with a non-zero status if any of them disagree where they should not.
+    """
+    if record:
+        work_dir = tempfile.mkdtemp(prefix='ezpb-reference-')
+        try:
+            outputs = record_reference(work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        with open(REFERENCE_FILE, 'w') as f:
+            json.dump(outputs, f, indent=1, sort_keys=True)
+            f.write('\n')
+        click.echo('Recorded %d outputs in %s.' % (len(outputs), REFERENCE_FILE))
+        return
+
+    with open(REFERENCE_FILE) as f:
+        outputs = json.load(f)
+    failures = 0
+    for output in outputs:
+        click.echo('%s, burn-in %d:' % (' '.join(output['chains']), output['discard']))
+        for name, expected, actual, agree in check_reference(output):
+            status = '' if agree is None else 'ok' if agree else 'FAIL'
+            click.echo('  %-20s PhyloBayes %-10.6g EZ-PB %-10.6g %s' % (name, expected, actual, status))
+            failures += agree is False
+    if failures:
+        click.echo('%d comparison(s) failed.' % failures)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,344 @@
+"""
+A stand-in for the PhyloBayes commands that EZ-PB runs, for benchmarking the orchestration without the cost of the real
+MCMC. Depending on the first argument, it behaves like:
+
+    simulator.py mpirun -np N pb_mpi [options] [-d ALIGNMENT] CHAIN
+        Runs a simulated chain: the .trace, .treelist, .chain, .run, .param and .monitor files of CHAIN are written in
+        the current directory at a steady rate until the process is terminated. Without -d, the chain is resumed from
+        its checkpoint, as [pb_mpi] does.
+    simulator.py tracecomp -x BURNIN CHAIN...
+        Writes tracecomp.contdiff for the chains, in the format of [tracecomp].
+    simulator.py bpcomp -x BURNIN EVERY CHAIN...
+        Writes bpcomp.bpdiff and bpcomp.con.tre for the chains, in the format of [bpcomp].
+
+The chains are configured with environment variables:
+    EZPB_SIM_RATE: generations per second for a chain on one process (default 100); a chain on N processes runs about
+    N ** 0.8 times as fast.
+    EZPB_SIM_TAXA: the number of taxa in the trees (default 20).
+    EZPB_SIM_CONVERGE_AT: the generation at which the chains of an alignment have all reached the same stationary
+    distribution (default 500). Before it, the log likelihood drifts up towards its stationary value and each chain
+    samples trees around its own starting topology; after it, every chain samples around the same topology.
+    EZPB_SIM_SEED: the seed for the random numbers (default 0); the chains of an alignment are seeded from it and from
+    their names.
+
+Every generation is written as soon as it is due, so EZ-PB sees the files grow as it would with [pb_mpi].
+
+The [tracecomp] and [bpcomp] stand-ins only exist so that EZ-PB has files to parse: they compute the diagnostics with
+EZ-PB's own [TraceDiagnostics] and [BipartitionIndex], so they agree with the native diagnostics by construction, and
+they cost what EZ-PB's code costs rather than what PhyloBayes' does. Nothing measured against them says anything about
+the accuracy of the diagnostics, or about the cost of the real commands; benchmarks/reference is for that.
+"""
+import os
+import random
+import signal
+import sys
+import time
+import zlib
+
+# EZ-PB is only imported by the diagnostic commands, so that the simulated chains start as quickly as [pb_mpi] would
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRACE_HEADER = '#iter\ttime\ttopo\tloglik\tlength\talpha\tNmode\tstatent\tstatalpha'
+# How long to sleep between writes, at most (in seconds)
+WRITE_INTERVAL = 0.05
+
+
+def environment(name, default, kind):
+    """
+    Read a simulation parameter from the environment.
+
+    :param name: The name of the parameter, without the EZPB_SIM_ prefix.
+    :param default: The value to use if the variable is not set.
+    :param kind: The type of the parameter.
+    """
+    return kind(os.environ.get('EZPB_SIM_%s' % name, default))
+
+
+def random_tree(taxa, rng):
+    """
+    Return a random rooted binary tree on a list of taxa, as nested lists.
+
+    :param taxa: The names of the taxa.
+    :param rng: The [random.Random] to draw from.
+    """
+    subtrees = list(taxa)
+    while len(subtrees) > 2:
+        i, j = sorted(rng.sample(range(len(subtrees)), 2))
+        right = subtrees.pop(j)
+        left = subtrees.pop(i)
+        subtrees.append([left, right])
+    return subtrees
+
+
+def newick(tree):
+    """
+    Return a tree of nested lists as a Newick string.
+
+    :param tree: The tree.
+    """
+    def write(node):
+        if isinstance(node, list):
+            return '(%s)' % ','.join(write(child) for child in node)
+        return '%s:%.3f' % (node, 0.1)
+    return write(tree) + ';'
+
+
+def relabel(tree, mapping):
+    """
+    Return a copy of a tree with its leaves renamed.
+
+    :param tree: The tree, as nested lists.
+    :param mapping: A dictionary mapping old names to new names.
+    """
+    if isinstance(tree, list):
+        return [relabel(child, mapping) for child in tree]
+    return mapping[tree]
+
+
+class SimulatedChain(object):
+    """
+    Generates the samples of a simulated chain: one line of the trace and one tree per generation.
+    """
+    def __init__(self, alignment, chain, taxa, converge_at, seed=0):
+        """
+        :param alignment: The name of the alignment; chains of the same alignment converge to the same distribution.
+        :param chain: The full name of the chain.
+        :param taxa: The number of taxa.
+        :param converge_at: The generation at which the chain reaches the stationary distribution.
+        :param seed: The seed for the random numbers.
+        """
+        self.taxa = ['t%d' % i for i in range(taxa)]
+        self.converge_at = max(converge_at, 1)
+        self.rng = random.Random(zlib.crc32(('%s %d' % (chain, seed)).encode()))
+        shared = random.Random(zlib.crc32(('%s %d' % (alignment, seed)).encode()))
+        self.target_tree = random_tree(self.taxa, shared)
+        self.start_tree = random_tree(self.taxa, self.rng)
+        self.stationary_loglik = -50.0 * taxa
+        self.drift = self.rng.uniform(20, 40) * taxa
+        self.noise = 0.0
+
+    def trace_line(self, generation, elapsed):
+        """
+        Return the line of the trace file for a generation.
+
+        :param generation: The generation.
+        :param elapsed: The number of seconds since the chain was started.
+        """
+        self.noise = 0.8 * self.noise + self.rng.gauss(0, 5)
+        remaining = max(1.0 - generation / self.converge_at, 0.0)
+        loglik = self.stationary_loglik - self.drift * remaining ** 2 + self.noise
+        return '%d\t%.3f\t0\t%.3f\t%.4f\t%.4f\t%d\t%.4f\t%.4f' % (
+            generation, elapsed, loglik, 1 + self.rng.random(), 0.5 + self.rng.random(), self.rng.randint(20, 60),
+            self.rng.random(), self.rng.random())
+
+    def tree_line(self, generation):
+        """
+        Return the tree sampled at a generation, as a Newick string.
+
+        :param generation: The generation.
+        """
+        # before converging, the chain mostly samples around its own starting tree
+        remaining = max(1.0 - generation / self.converge_at, 0.0)
+        base = self.start_tree if self.rng.random() < remaining else self.target_tree
+        # perturb the tree by swapping a few taxa, so that the chain samples a distribution of trees
+        names = list(self.taxa)
+        for i in range(min(self.rng.randint(0, 2), len(names) // 2)):
+            a, b = self.rng.sample(range(len(names)), 2)
+            names[a], names[b] = names[b], names[a]
+        return newick(relabel(base, dict(zip(self.taxa, names))))
+
+
+def write_chain(directory, alignment, chain, generations, taxa, converge_at, seed=0):
+    """
+    Write the files of a simulated chain that has run for a number of generations, all at once. This is used to set up
+    checks of a given size without waiting for a chain to get there. Return the [SimulatedChain], so that more
+    generations can be appended with [append_generations].
+
+    :param directory: The directory to write the files to.
+    :param alignment: The name of the alignment.
+    :param chain: The full name of the chain.
+    :param generations: The number of generations.
+    :param taxa: The number of taxa.
+    :param converge_at: The generation at which the chain reaches the stationary distribution.
+    :param seed: The seed for the random numbers.
+    """
+    simulated = SimulatedChain(alignment, chain, taxa, converge_at, seed)
+    with open(os.path.join(directory, '%s.trace' % chain), 'w') as trace:
+        trace.write(TRACE_HEADER + '\n')
+    open(os.path.join(directory, '%s.treelist' % chain), 'w').close()
+    append_generations(directory, chain, simulated, 0, generations)
+    return simulated
+
+
+def append_generations(directory, chain, simulated, start, end):
+    """
+    Append generations [start, end) of a simulated chain to its files.
+
+    :param directory: The directory of the chain files.
+    :param chain: The full name of the chain.
+    :param simulated: The [SimulatedChain].
+    :param start: The first generation to write.
+    :param end: The generation to stop before.
+    """
+    with open(os.path.join(directory, '%s.trace' % chain), 'a') as trace, \
+            open(os.path.join(directory, '%s.treelist' % chain), 'a') as treelist:
+        for generation in range(start, end):
+            trace.write(simulated.trace_line(generation, 0.0) + '\n')
+            treelist.write(simulated.tree_line(generation) + '\n')
+    with open(os.path.join(directory, '%s.chain' % chain), 'w') as checkpoint:
+        checkpoint.write('%d\n' % end)
+
+
+def run_chain(args):
+    """
+    Simulate [mpirun -np N pb_mpi ...] until terminated.
+
+    :param args: The arguments after "mpirun".
+    """
+    processes = int(args[args.index('-np') + 1]) if '-np' in args else 1
+    chain = args[-1]
+    alignment = args[args.index('-d') + 1] if '-d' in args else None
+    rate = environment('RATE', 100, float) * processes ** 0.8
+    taxa = environment('TAXA', 20, int)
+    converge_at = environment('CONVERGE_AT', 500, int)
+    seed = environment('SEED', 0, int)
+
+    trace_path = '%s.trace' % chain
+    generation = 0
+    if alignment is None and os.path.exists(trace_path):
+        # resuming: carry on from the generations already in the trace
+        with open(trace_path) as trace:
+            generation = max(sum(1 for line in trace) - 1, 0)
+    else:
+        with open(trace_path, 'w') as trace:
+            trace.write(TRACE_HEADER + '\n')
+        open('%s.treelist' % chain, 'w').close()
+        with open('%s.param' % chain, 'w') as param:
+            param.write('%s\n' % alignment)
+        open('%s.monitor' % chain, 'w').close()
+    with open('%s.run' % chain, 'w') as run:
+        run.write('1\n')
+
+    # the chains of an alignment share its name, which is the chain name up to the last "_chain"
+    simulated = SimulatedChain(chain.rsplit('_chain', 1)[0], chain, taxa, converge_at, seed)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    try:
+        write_generations(chain, simulated, generation, rate, stopping)
+    except FileNotFoundError:
+        # EZ-PB has moved the chain files away before the chain noticed it was being stopped
+        pass
+
+
+def write_generations(chain, simulated, generation, rate, stopping):
+    """
+    Append the generations of a simulated chain to its files as they fall due, until the chain is stopped.
+
+    :param chain: The full name of the chain.
+    :param simulated: The [SimulatedChain].
+    :param generation: The generation to start from.
+    :param rate: The number of generations per second.
+    :param stopping: A list that is appended to when the chain is to stop.
+    """
+    started = time.time()
+    first = generation
+    with open('%s.trace' % chain, 'a') as trace, open('%s.treelist' % chain, 'a') as treelist:
+        while not stopping:
+            due = first + int((time.time() - started) * rate)
+            while generation < due and not stopping:
+                trace.write(simulated.trace_line(generation, time.time() - started) + '\n')
+                treelist.write(simulated.tree_line(generation) + '\n')
+                generation += 1
+            trace.flush()
+            treelist.flush()
+            with open('%s.chain' % chain, 'w') as checkpoint:
+                checkpoint.write('%d\n' % generation)
+            time.sleep(min(WRITE_INTERVAL, 1.0 / rate))
+
+
+def import_ezpb():
+    """
+    Import and return the EZ-PB module of this repository.
+    """
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    import ezpb
+    return ezpb
+
+
+def diagnostic_arguments(args):
+    """
+    Parse the arguments of [tracecomp] or [bpcomp]: return the burn-in and the chain names.
+
+    :param args: The arguments after the command name.
+    """
+    args = list(args)
+    discard = 0
+    if '-x' in args:
+        i = args.index('-x')
+        discard = int(args[i + 1])
+        del args[i:i + 2]
+        if args and args[0].isdigit():
+            # [bpcomp] takes the sampling frequency after the burn-in
+            args.pop(0)
+    return discard, args
+
+
+def run_tracecomp(args):
+    """
+    Simulate [tracecomp -x BURNIN CHAIN...], with EZ-PB's native diagnostics (see above).
+
+    :param args: The arguments after "tracecomp".
+    """
+    ezpb = import_ezpb()
+    discard, chains = diagnostic_arguments(args)
+    readers = {chain: ezpb.TraceReader('%s.trace' % chain) for chain in chains}
+    for reader in readers.values():
+        reader.update()
+    effsize, rel_diff = ezpb.TraceDiagnostics(readers).compute(discard)
+    with open(ezpb.TRACECOMP_OUT_FILE, 'w') as out:
+        lines = ['setting', 'name                effsize\trel_diff']
+        lines.extend('' for i in range(ezpb.LOGLIK_LINE - len(lines)))
+        lines.append('loglik              %d\t%f' % (effsize, rel_diff))
+        out.write('\n'.join(lines) + '\n')
+
+
+def run_bpcomp(args):
+    """
+    Simulate [bpcomp -x BURNIN EVERY CHAIN...], with EZ-PB's native diagnostics (see above). The consensus tree written
+    is just the last tree of the first chain, which is enough for EZ-PB to have a tree to save.
+
+    :param args: The arguments after "bpcomp".
+    """
+    ezpb = import_ezpb()
+    discard, chains = diagnostic_arguments(args)
+    index = ezpb.BipartitionIndex({chain: '%s.treelist' % chain for chain in chains})
+    max_diff = index.max_diff(discard)
+    with open(ezpb.BPCOMP_OUT_FILE, 'w') as out:
+        lines = ['bipartition']
+        lines.extend('' for i in range(ezpb.MAX_DIFF_LINE - len(lines)))
+        lines.append('maxdiff     : %f' % max_diff)
+        lines.append('meandiff    : %f' % (max_diff / 2))
+        out.write('\n'.join(lines) + '\n')
+    tree = ''
+    if chains and os.path.exists('%s.treelist' % chains[0]):
+        with open('%s.treelist' % chains[0]) as treelist:
+            for line in treelist:
+                tree = line.strip() or tree
+    with open(ezpb.TREE_FILE_NAME, 'w') as out:
+        out.write(tree + '\n')
+
+
+COMMANDS = {
+    'mpirun': run_chain,
+    'tracecomp': run_tracecomp,
+    'bpcomp': run_bpcomp,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.exit('Usage: simulator.py {%s} ARGS...' % ','.join(sorted(COMMANDS)))
+    COMMANDS[sys.argv[1]](sys.argv[2:])
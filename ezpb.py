@@ -1,31 +1,102 @@
-import asyncio
+import collections
 import configparser
 import csv
-import multiprocessing
+import ctypes
+import ctypes.util
+import math
+import gzip
+import importlib.util
+import io
+import itertools
+import json
+import lzma
 import ntpath
 import os
 import re
 import shlex
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import warnings
 from functools import reduce, partial
 
 import click
-from pkg_resources import Requirement, resource_filename
 
-# ==================================== GLOBAL VARIABLES ====================================
-devnull = open(os.devnull, 'w')  # so we can suppress the output of subprocesses
 
+def lazy_import(name):
+    """
+    Import a module as [import name] does, and return what it would bind (the top-level package), except that the module
+    itself is only loaded once one of its attributes is first used. Its parent packages are loaded straight away.
+
+    :param name: The full name of the module.
+    """
+    if name not in sys.modules:
+        spec = importlib.util.find_spec(name)
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+    return sys.modules[name.partition('.')[0]]
+
+
+# numpy, asyncio and the other modules that only the server side uses take most of the time it takes to import this
+# module, so that the client commands, [submit] in particular, would spend most of their time importing them
+asyncio = lazy_import('asyncio')
+concurrent = lazy_import('concurrent.futures')
+np = lazy_import('numpy')
+sqlite3 = lazy_import('sqlite3')
 
-# Get the configuration variables from the config.ini file
-CONFIG_FILE = resource_filename(Requirement.parse("ezpb"), "config.ini")
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+# ==================================== GLOBAL VARIABLES ====================================
+# Get the configuration variables from the config.ini file, which is installed next to this module; pkg_resources is
+# slow to import, so it is only used to find the file if it is anywhere else
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+if not os.path.exists(CONFIG_FILE):
+    from pkg_resources import Requirement, resource_filename
+    CONFIG_FILE = resource_filename(Requirement.parse("ezpb"), "config.ini")
 config_data = configparser.ConfigParser()
 config_data.read(CONFIG_FILE)
 
 CHECK_FREQ = float(config_data['default']['check_freq'])
+# Whether checks are scheduled adaptively (after a number of new generations that depends on how close the chains are
+# to converging) rather than every [CHECK_FREQ] seconds, in which case [CHECK_FREQ] is the longest time between checks
+ADAPTIVE = config_data.getboolean('default', 'adaptive')
+# The smallest number of new generations to wait for between adaptive checks
+CHECK_GENS = int(config_data['default']['check_gens'])
+# The shortest time between adaptive checks, and the bounds on how often the trace files are polled for growth when
+# they cannot be watched with inotify (all in seconds)
+MIN_CHECK_INTERVAL = 1.0
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 30.0
 
 MAX_GEN_DISCARD = int(config_data['generations']['max_discard'])
+# How the burn-in is chosen: with the fixed rule of [discard_samples], or detected from the log likelihood trace by
+# [TraceDiagnostics.burn_in]
+BURN_IN_MODES = ['auto', 'fixed']
+BURN_IN = config_data['generations']['burn_in']
+# The burn-in detection tries burn-ins in steps of [BURN_IN_STEP] of the length of the chains, up to [BURN_IN_MAX]; a
+# burn-in is accepted when Geweke's z-score, comparing the first [GEWEKE_FIRST] with the last [GEWEKE_LAST] of the
+# samples after it (each estimated from [GEWEKE_BATCHES] batch means), is below [GEWEKE_Z]
+BURN_IN_STEP = 0.05
+BURN_IN_MAX = 0.5
+GEWEKE_FIRST = 0.1
+GEWEKE_LAST = 0.5
+GEWEKE_BATCHES = 10
+GEWEKE_Z = 2.0
 MIN_CYCLES = int(config_data['generations']['min_cycles'])
 
 TRACECOMP_OUT_FILE = config_data['output']['tracecomp']
@@ -36,9 +107,57 @@ MAX_DIFF_LINE = int(config_data['output']['max_diff_line'])
 
 TREE_SAMPLE_FREQ = int(config_data['default']['tree_sample_freq'])
 
+# How the convergence diagnostics are computed: natively from the chain files, with the external [tracecomp] and
+# [bpcomp] commands, or natively with the external commands run alongside as a cross-check
+DIAGNOSTICS_MODES = ['native', 'external', 'cross-check']
+DIAGNOSTICS = config_data['default']['diagnostics']
+# The trace column that the log likelihood diagnostics are computed from
+LOGLIK_COLUMN = 'loglik'
+# Whether the tree test is only run once the log likelihood thresholds have been broken, and how often (in checks) it
+# is run anyway so that the max diff still shows up in the output
+TIERED = config_data.getboolean('default', 'tiered')
+TREE_CHECK_EVERY = int(config_data['default']['tree_check_every'])
+# How far the native and external diagnostics may differ before a cross-check warns about it
+CROSS_CHECK_EFFSIZE_TOLERANCE = 0.25  # relative
+CROSS_CHECK_REL_DIFF_TOLERANCE = 0.05  # absolute
+CROSS_CHECK_MAX_DIFF_TOLERANCE = 0.01  # absolute
+# A chain is a straggler if it runs at less than [STRAGGLER_RATIO] times the rate of the fastest other chain, and has
+# fallen at least [STRAGGLER_MIN_LAG] generations behind it; stragglers are restarted from their checkpoints at most
+# [STRAGGLER_RESTARTS] times. A chain's rate is only trusted after [STRAGGLER_MIN_SAMPLES] measurements
+STRAGGLER_RATIO = float(config_data['default']['straggler_ratio'])
+STRAGGLER_RESTARTS = int(config_data['default']['straggler_restarts'])
+STRAGGLER_MIN_LAG = 20
+STRAGGLER_MIN_SAMPLES = 3
+# Whether every chain is pinned to its own set of cores, taken from a single NUMA node where possible, and where the
+# NUMA nodes of the machine are listed
+PIN_CORES = config_data.getboolean('default', 'pin_cores')
+NUMA_NODES_DIRECTORY = '/sys/devices/system/node'
+# Whether alignments are only started once there is enough free memory for their chains, and how much of the memory
+# of the machine (or of its cgroup) is kept free on top of that, as a fraction; whether they are also held back while
+# the load average would go over [MAX_LOAD] times the number of cores (0 to never), and how often a held back
+# alignment is looked at again (in seconds)
+MEMORY_ADMISSION = config_data.getboolean('resources', 'memory')
+MEMORY_HEADROOM = float(config_data['resources']['memory_headroom'])
+MAX_LOAD = float(config_data['resources']['max_load'])
+ADMISSION_POLL = float(config_data['resources']['admission_poll'])
+# The memory model of a chain before it is corrected by the footprints measured so far: a fixed amount for every MPI
+# rank, plus a number of bytes for every taxon, site and character state (the conditional likelihoods of the internal
+# nodes under the rate categories), taken from the last [MEMORY_HISTORY] alignments that were measured
+MEMORY_PER_RANK = 64 * 1024 * 1024
+MEMORY_PER_CELL = 64
+MEMORY_HISTORY = 50
+# How long the processes of a chain have to exit after a SIGTERM before they are sent a SIGKILL (in seconds)
+TERMINATE_TIMEOUT = float(config_data['default']['terminate_timeout'])
+# Whether runs that are projected not to converge before the maximum number of generations are stopped early, and how
+# sure the projection must be; the projection is only made once there are [PREDICTOR_MIN_CHECKS] checks to go on
+EARLY_ABORT = config_data.getboolean('default', 'early_abort')
+ABORT_CONFIDENCE = float(config_data['default']['abort_confidence'])
+PREDICTOR_MIN_CHECKS = 5
+PREDICTOR_MAX_LOG_SAMPLES = math.log(1e12)
+
 
 # Detect the number of cores on the machine (that we can use for the chain runs)
-N_THREADS = multiprocessing.cpu_count()
+N_THREADS = os.cpu_count()
 
 # CLI defaults:
 MAX_GEN = int(config_data['thresholds']['max_gen'])
@@ -55,10 +174,72 @@ INPUT_FILE_TYPES = config_data['input']['filetypes'].split(', ')
 # Output locations
 # The name of the logfile
 LOGFILE = 'alignments.log.csv'
+LOGFILE_LOCK = threading.Lock()
+# The columns of the logfile that come before the generations of each chain, and the ones that come after them (new
+# columns go at the end, so that spreadsheets built on the logfile of older versions keep working)
+LOGFILE_COLUMNS = ['alignment', 'converged', 'loglik_effsize', 'loglik_rel_diff', 'max_diff']
+LOGFILE_EXTRA_COLUMNS = ['aborted', 'projected_gen']
+# The name of the run-state database
+RUN_STORE = 'runs.sqlite'
+# The names of the telemetry files: a JSON line is appended for every event, and the Prometheus textfile is rewritten
+TELEMETRY = config_data.getboolean('output', 'telemetry')
+TELEMETRY_FILE = 'telemetry.jsonl'
+PROMETHEUS_FILE = 'ezpb.prom'
 # The name of the tree file generated by [bpcomp]
 TREE_FILE_NAME = 'bpcomp.con.tre'
 # The default directory to store the output in
 OUTPUT_DIRECTORY = config_data['output']['directory']
+# The subdirectory of the output directory that the chains of each alignment are run in while they are running; every
+# alignment gets its own directory inside this one so that concurrent runs never share chain or summary files
+WORK_DIRECTORY = 'running'
+# The Unix socket in the output directory that [ezpb serve] accepts submissions on
+SOCKET_FILE = config_data['serve']['socket']
+# The directory in the output directory that [ezpb worker] processes share their job queue of alignments through, how
+# often a worker renews the lease on each alignment it runs, and how long after its last renewal a lease expires, so
+# that the alignment can be taken over by another worker (in seconds)
+QUEUE_DIRECTORY = config_data['queue']['directory']
+LEASE_HEARTBEAT = float(config_data['queue']['heartbeat'])
+LEASE_TIMEOUT = float(config_data['queue']['lease_timeout'])
+# Every worker keeps its run store and its logfile in its own directory in [QUEUE_DIRECTORY]/[WORKERS_DIRECTORY], since
+# SQLite and appends to a shared file cannot be trusted on network filesystems; whichever worker finds every alignment
+# done merges them into the output directory, while it holds the lease named [MERGE_LEASE]
+WORKERS_DIRECTORY = 'workers'
+MERGE_LEASE = '.merge'
+# A node-local directory to run the chains in instead, if any; the chain files are then synced to the working directory
+# in the output directory every [SYNC_FREQ] seconds, so that the chains can be resumed if the node is lost
+SCRATCH = config_data['output']['scratch'] or None
+SYNC_FREQ = float(config_data['output']['sync_freq'])
+# How the consensus tree of an alignment is built once its chains have stopped: natively from the tree lists, or by
+# [bpcomp] (falling back on the native consensus if [bpcomp] has not left a tree)
+CONSENSUS_MODES = ['native', 'bpcomp']
+CONSENSUS = config_data['output']['consensus']
+CONSENSUS_WORKERS = int(config_data['output']['consensus_workers'])
+# The name of the file that the trees sampled after the burn-in are written to alongside the consensus tree, and
+# whether the full tree lists of alignments whose chain files are not saved are archived as well, or only this sample
+TREE_SAMPLE_FILE_NAME = 'ezpb.sample.tre'
+TREELIST_MODES = ['full', 'sample']
+TREELISTS = config_data['output']['treelists']
+# The suffix of the files that the tree lists of running chains are thinned into (see [TreelistSampler])
+TREELIST_SAMPLE_SUFFIX = '.treesample'
+
+# The files in the output directory that the trees of the good alignments are bundled into, for gene tree summary
+# methods such as ASTRAL: the consensus trees, one per line; the names of their alignments, in the same order; and the
+# paths to their tree samples, in the same order (as for the bootstrap option of ASTRAL)
+GENE_TREES_FILE = 'gene_trees.tre'
+GENE_TREE_NAMES_FILE = 'gene_trees.names'
+GENE_TREE_SAMPLES_FILE = 'gene_tree_samples.txt'
+# How the chain files of finished alignments are compressed when they are archived, and how many archiving jobs are
+# run at the same time in the background; the values of [COMPRESSION_FORMATS] are the extensions of the archives
+COMPRESSION_FORMATS = collections.OrderedDict([('none', ''), ('gzip', '.gz'), ('xz', '.xz'), ('zstd', '.zst')])
+COMPRESSION = config_data['output']['compression']
+ARCHIVE_WORKERS = int(config_data['output']['archive_workers'])
+# The size of the blocks that files are streamed in when they are compressed or copied (in bytes)
+ARCHIVE_BLOCK_SIZE = 1024 * 1024
+
+
+# The columns of the CSV report that [replay] writes, if asked to
+REPLAY_REPORT_COLUMNS = ['alignment', 'original', 'original_generations', 'replay', 'replay_generations',
+                         'loglik_effsize', 'loglik_rel_diff', 'max_diff', 'core_hours_saved']
 
 
 # Output file data
@@ -68,6 +249,19 @@ KEEP_CHAIN_FILE_TYPES = ['.monitor', '.param', '.run', '.trace', '.treelist']
 ALL_CHAIN_FILE_TYPES = KEEP_CHAIN_FILE_TYPES + ['.chain']
 
 
+# Alignment cost model
+# The number of character states of each datatype; the cost of a site grows with the square of the number of states,
+# since the substitution matrices are states x states
+DATATYPE_STATES = {'dna': 4, 'rna': 4, 'nucleotide': 4, 'protein': 20}
+NUCLEOTIDE_SYMBOLS = set('ACGTUNRYKMSWBDHV-?.')
+# How many lines of a PHYLIP file to look at when guessing its datatype
+DATATYPE_SAMPLE_LINES = 10
+# The chains of an alignment get a thread for every [COST_PER_THREAD] of its cost, rounded up: with less work than that
+# per MPI rank, the ranks of a chain spend more time exchanging their likelihoods than computing them (the default is
+# 50 taxa by 2500 nucleotide sites, or by 100 amino acid sites)
+COST_PER_THREAD = float(config_data['default']['cost_per_thread'])
+
+
 def new_tree_file_name(alignment):
     """
     Return the new file name to use when renaming the default tree generated by [bpcomp].
@@ -77,6 +271,15 @@ def new_tree_file_name(alignment):
     return '%s.tre' % alignment
 
 
+def new_tree_sample_file_name(alignment):
+    """
+    Return the new file name to use when renaming the tree sample of an alignment (see [write_tree_sample]).
+
+    :param alignment: The name of the alignment.
+    """
+    return '%s.sample.tre' % alignment
+
+
 def every(lst, fn):
     """
     Apply a function returning a boolean to every element of a list; return True if the function returns True for every
@@ -88,384 +291,4551 @@ def every(lst, fn):
     return reduce(lambda acc, elem: acc and fn(elem), lst, True)
 
 
-def trace_file_len(fname):
+class AppendedFileReader(object):
     """
-    Return the number of generations in a chain trace file. If the file does not exist, return 0.
-
-    :param fname: The path to the chain trace file.
+    The base class for readers of files that a chain keeps appending lines to, such as its trace file or its tree list.
+    The reader remembers how far into the file it has read, so that only the lines appended since the last read have
+    to be read again.
     """
-    try:
-        with open(fname) as f:
-            for i, l in enumerate(f):
-                pass
-        return i - 1
-    except FileNotFoundError:
-        return 0
+    def __init__(self, path):
+        """
+        :param path: The path to the file. The file does not need to exist yet.
+        """
+        self.path = path
+        self.offset = 0
+        self._partial = b''
+
+    def reset(self):
+        """
+        Forget everything that has been read so far, so that the next read starts from the beginning of the file.
+        """
+        self.offset = 0
+        self._partial = b''
+
+    def read_new_lines(self):
+        """
+        Return a list of the complete lines (as bytes) that have been appended to the file since the last read. A
+        trailing line that has not been completely written yet is kept back until the next read. If the file has been
+        replaced by a shorter one (for example, because the chain has been restarted from scratch), the reader is
+        [reset] first.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return []
+
+        if size < self.offset:
+            self.reset()
+        if size == self.offset:
+            return []
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        self.offset += len(chunk)
+
+        lines = (self._partial + chunk).split(b'\n')
+        # the last element is whatever comes after the last newline, i.e. an incomplete line (or nothing)
+        self._partial = lines.pop()
+        return lines
 
 
-def data_from_tracecomp_file():
+class TraceReader(AppendedFileReader):
     """
-    Parse out and return data from the summary file generated by the [tracecomp] command. Currently this is the log
-    likelihood effective size, and the log likelihood relative difference.
+    An incremental reader for a chain trace file. Every call to [update] only reads and parses the lines that the chain
+    has appended since the previous call. The parsed rows are kept in memory as a growing array, one column per trace
+    column (loglik, length, et cetera), so that they can be reused by anything else that needs the trace data.
     """
-    data = ''  # assume file will have more thant [MAX_DIFF_LINE] lines
-    with open(TRACECOMP_OUT_FILE) as f:
-        for i, line in enumerate(f):
-            if i == LOGLIK_LINE:
-                data = line
+    def __init__(self, path):
+        """
+        :param path: The path to the chain trace file. The file does not need to exist yet.
+        """
+        super(TraceReader, self).__init__(path)
+        self.columns = None
+        self.rows = 0
+        self._data = None
+
+    def reset(self):
+        super(TraceReader, self).reset()
+        self.columns = None
+        self.rows = 0
+        self._data = None
+
+    def update(self):
+        """
+        Read and parse the lines that have been appended to the trace file since the last update. Return the number of
+        new rows.
+        """
+        lines = self.read_new_lines()
+
+        if self.columns is None and lines:
+            self.columns = [column.lstrip('#') for column in lines.pop(0).decode().split()]
+
+        rows = [line.split() for line in lines if line.strip()]
+        # skip anything malformed rather than letting one bad line break the whole check
+        rows = [row for row in rows if len(row) == len(self.columns)]
+        if not rows:
+            return 0
+
+        self._append(np.array(rows, dtype=float))
+        return len(rows)
+
+    def _append(self, new_rows):
+        needed = self.rows + len(new_rows)
+        if self._data is None or needed > len(self._data):
+            # grow geometrically, so that appending stays cheap however long the chain runs for
+            capacity = max(needed, 2 * (0 if self._data is None else len(self._data)), 1024)
+            data = np.empty((capacity, len(self.columns)))
+            if self._data is not None:
+                data[:self.rows] = self._data[:self.rows]
+            self._data = data
+        self._data[self.rows:needed] = new_rows
+        self.rows = needed
+
+    @property
+    def data(self):
+        """
+        The parsed rows of the trace file, as an array with one row per generation and one column per trace column.
+        """
+        if self._data is None:
+            return np.empty((0, 0 if self.columns is None else len(self.columns)))
+        return self._data[:self.rows]
+
+    def column(self, name):
+        """
+        Return the values of one of the trace columns, for example "loglik", as an array.
+
+        :param name: The name of the column, as given in the header of the trace file.
+        """
+        return self.data[:, self.columns.index(name)]
+
+    def generations(self):
+        """
+        Return the number of generations in the trace file read so far: the number of rows after the header, not
+        counting the first one, which holds the starting state. If the file does not exist yet, return 0.
+        """
+        return max(self.rows - 1, 0)
 
-    parsed_data = re.sub(r'\s+', ' ', data).split(' ')
-    loglik_effsize = int(parsed_data[1])
-    loglik_rel_diff = float(parsed_data[2])
-    return loglik_effsize, loglik_rel_diff
 
+# The value of 2 pi that [tracecomp] uses in its lag window, which is slightly off
+TRACECOMP_TWO_PI = 6.28311854
 
-def data_from_bpcomp_file():
+
+def effective_sample_size(values):
     """
-    Parse out and return data from the summary file generated by the [bpcomp] command. Currently this is just the max
-    difference.
+    Return the effective sample size of a series of samples from a chain, as [tracecomp] estimates it: the number of
+    samples divided by the integrated autocorrelation time, where the autocorrelations (normalised by the number of
+    samples, not by the number of pairs) at every lag below half the number of samples are summed with a
+    Tukey-Hanning lag window. If that would make the autocorrelation time less than 1, the number of samples is
+    returned instead. The autocorrelations are computed with an FFT. [tracecomp] prints the integer part of the result.
+
+    :param values: The samples, as an array.
     """
-    data = ''  # assume file will have more thant [LOGLIK_LINE] lines
-    with open(BPCOMP_OUT_FILE) as f:
-        for i, line in enumerate(f):
-            if i == MAX_DIFF_LINE:
-                data = line
+    n = len(values)
+    lags = n // 2
+    if lags <= 1:
+        return float(n)
 
-    parsed_data = re.sub(r'\s+', ' ', data).split(' ')
-    max_diff = float(parsed_data[2])
-    return max_diff
+    x = values - values.mean()
+    if not x.any():
+        # a constant series carries no information about its autocorrelation
+        return float(n)
 
+    size = 1 << (2 * n - 1).bit_length()  # pad so that the circular correlation does not wrap around
+    transform = np.fft.rfft(x, size)
+    autocovariance = np.fft.irfft(transform * np.conjugate(transform), size)[:lags]
+    autocorrelation = autocovariance[1:] / autocovariance[0]
 
-def create_logfile(output_dir, chains):
+    window = 0.5 * (np.cos(TRACECOMP_TWO_PI * np.arange(1, lags) / n) + 1)
+    autocorrelation_time = 1 + 2 * np.dot(window, autocorrelation)
+    if autocorrelation_time < 1:
+        return float(n)
+    return n / autocorrelation_time
+
+
+def relative_difference(samples):
     """
-    Create the CSV logfile, and populate it with column names for each of the summary statistics and each chain.
+    Return the relative difference between the samples of several chains, as [tracecomp] computes it: the difference
+    between the largest and the smallest mean of any chain, divided by the average of the standard deviations of all
+    of the chains. For two chains, this is the difference between their means divided by the average of their standard
+    deviations. It matches the output of [tracecomp] for the reference chains in benchmarks/reference.
 
-    :param output_dir: The output directory (where the output files are being moved to).
-    :param chains: A list of the names of the chains being run.
+    :param samples: A list of pairs (mean, standard deviation), one for each chain. The standard deviations are those
+    of samples, with n - 1 in the denominator, as in [tracecomp].
+    """
+    if not samples:
+        return 0.0
+    means = [mean for mean, sd in samples]
+    sd = sum(sd for mean, sd in samples) / len(samples)
+    if sd <= 0:
+        return 0.0
+    return (max(means) - min(means)) / sd
 
-    Preconditions:
-        - output directory must exist
+
+class TraceDiagnostics(object):
     """
-    with open(os.path.join(output_dir, LOGFILE), 'w+') as f:
-        chain_columns = ', '.join(chains)
-        f.write('alignment, converged, loglik_effsize, loglik_rel_diff, max_diff, ' + chain_columns)
+    Computes the log likelihood effective size and relative difference of a set of chains directly from their trace
+    data, in the same way as [tracecomp] does: every chain is cut down to the length of the shortest one, and after
+    discarding the burn-in, the effective size is the mean of the effective sizes of the chains (see
+    [effective_sample_size]), and the relative difference is that of [relative_difference]. Both match the outputs of
+    [tracecomp] for the reference chains in benchmarks/reference.
 
+    The diagnostics are updated incrementally. Running sums of each chain's values are extended with the rows that the
+    trace readers have read since the last update, so the means and standard deviations for any burn-in take constant
+    time, and a result is reused as long as neither the chains nor the burn-in have changed. The same sums make the
+    burn-in detection cheap: every window mean in Geweke's test is a difference of two running sums.
+    """
+    def __init__(self, trace_readers, column=LOGLIK_COLUMN):
+        """
+        :param trace_readers: A dictionary mapping each chain name to the [TraceReader] for its trace file.
+        :param column: The trace column to compute the diagnostics from. Defaults to the log likelihood.
+        """
+        self.trace_readers = trace_readers
+        self.column = column
+        self._sums = {chain: (np.zeros(1), np.zeros(1)) for chain in trace_readers}
+        self._shift = {}
+        self._cache = None
+        self._burn_in_cache = None
+        self.burn_in_detected = None
 
-def add_row_to_logfile(output_dir, *args):
+    def update(self):
+        """
+        Extend the running sums with the rows that the trace readers have read since the last update. This does not
+        update the readers themselves.
+        """
+        for chain, reader in self.trace_readers.items():
+            sums, squares = self._sums[chain]
+            if reader.rows < len(sums) - 1:
+                # the reader has started over, so we have to as well
+                sums, squares = np.zeros(1), np.zeros(1)
+                self._shift.pop(chain, None)
+            if reader.rows == len(sums) - 1:
+                continue
+
+            values = reader.column(self.column)[len(sums) - 1:]
+            # the sums are taken relative to the first value, so that the squares do not lose precision
+            shift = self._shift.setdefault(chain, values[0])
+            values = values - shift
+            sums = np.concatenate((sums, sums[-1] + np.cumsum(values)))
+            squares = np.concatenate((squares, squares[-1] + np.cumsum(values * values)))
+            self._sums[chain] = (sums, squares)
+
+    def _mean_sd(self, chain, discard, end):
+        sums, squares = self._sums[chain]
+        discard = min(discard, end)
+        n = end - discard
+        if n < 2:
+            return 0.0, 0.0
+        total = sums[end] - sums[discard]
+        total_squares = squares[end] - squares[discard]
+        mean = total / n
+        variance = max((total_squares - n * mean * mean) / (n - 1), 0.0)
+        return mean + self._shift.get(chain, 0.0), variance ** 0.5
+
+    def compute(self, discard):
+        """
+        Return the effective size and the relative difference of the chains, as a tuple, after discarding a number of
+        samples from the start of every chain.
+
+        :param discard: The number of samples to discard from the start of every chain.
+        """
+        self.update()
+        discard = int(discard)
+        key = (discard, tuple(reader.rows for reader in self.trace_readers.values()))
+        if self._cache is not None and self._cache[0] == key:
+            return self._cache[1]
+
+        rows = min(reader.rows for reader in self.trace_readers.values())
+        effsize = np.mean([effective_sample_size(reader.column(self.column)[discard:rows])
+                           for reader in self.trace_readers.values()])
+        rel_diff = relative_difference([self._mean_sd(chain, discard, rows) for chain in self.trace_readers])
+        result = int(effsize), float(rel_diff)
+        self._cache = (key, result)
+        return result
+
+    def _window_mean(self, chain, start, end):
+        # the mean of a window of a chain, and the variance of that mean estimated from batch means (so that it allows
+        # for the autocorrelation of the samples), both from the running sums in constant time per batch
+        sums = self._sums[chain][0]
+        bounds = np.linspace(start, end, GEWEKE_BATCHES + 1).astype(int)
+        batch_means = (sums[bounds[1:]] - sums[bounds[:-1]]) / np.diff(bounds)
+        mean = (sums[end] - sums[start]) / (end - start)
+        return mean, np.var(batch_means, ddof=1) / GEWEKE_BATCHES
+
+    def geweke(self, chain, discard):
+        """
+        Return Geweke's z-score for a chain after discarding a number of samples: the difference between the means of
+        the start and of the end of the remaining samples, in units of its standard error. Return [None] if there are
+        too few samples for the test.
+
+        :param chain: The name of the chain.
+        :param discard: The number of samples to discard from the start of the chain.
+        """
+        n = len(self._sums[chain][0]) - 1
+        remaining = n - discard
+        first_end = discard + int(GEWEKE_FIRST * remaining)
+        last_start = n - int(GEWEKE_LAST * remaining)
+        if first_end - discard < GEWEKE_BATCHES:
+            return None
+        first_mean, first_variance = self._window_mean(chain, discard, first_end)
+        last_mean, last_variance = self._window_mean(chain, last_start, n)
+        if first_variance + last_variance == 0:
+            return 0.0
+        return (first_mean - last_mean) / (first_variance + last_variance) ** 0.5
+
+    def burn_in(self):
+        """
+        Detect the burn-in of the chains: for each chain, the smallest burn-in (trying steps of [BURN_IN_STEP] of the
+        length of the chains, up to [BURN_IN_MAX]) that passes Geweke's test, and for the chains as a whole, the
+        largest of these. If a chain passes no burn-in, or the chains are too short for the test, the detection fails
+        and the fixed rule of [discard_samples] is used for all of the chains instead; [burn_in_detected] is then False.
+        Return the number of samples to discard from the start of every chain.
+        """
+        self.update()
+        key = tuple(reader.rows for reader in self.trace_readers.values())
+        if self._burn_in_cache is not None and self._burn_in_cache[0] == key:
+            self.burn_in_detected = self._burn_in_cache[2]
+            return self._burn_in_cache[1]
+
+        rows = min(len(self._sums[chain][0]) - 1 for chain in self.trace_readers)
+        step = max(int(BURN_IN_STEP * rows), 1)
+        candidates = range(0, int(BURN_IN_MAX * rows) + 1, step)
+        burn_in = 0
+        detected = True
+        for chain in self.trace_readers:
+            chain_burn_in = None
+            for discard in candidates:
+                z = self.geweke(chain, discard)
+                if z is None:
+                    break
+                if abs(z) < GEWEKE_Z:
+                    chain_burn_in = discard
+                    break
+            if chain_burn_in is None:
+                detected = False
+                break
+            burn_in = max(burn_in, chain_burn_in)
+        if not detected:
+            burn_in = int(discard_samples(rows))
+
+        self.burn_in_detected = detected
+        self._burn_in_cache = (key, burn_in, detected)
+        return burn_in
+
+
+# Splits a Newick string into parentheses, commas, semicolons and everything in between (names, lengths and labels)
+NEWICK_TOKEN = re.compile(r'[(),;]|[^(),;]+')
+
+
+def popcount(bits):
     """
-    Add a CSV row to the logfile, given summary statistics and chain generation values.
+    Return the number of set bits in an integer.
 
-    :param output_dir: The output directory (where the output files are being moved to).
-    :param args: The name of the alignment, and the summary statistics, in the same order as the columns of the logfile
-    as generated by [create_logfile].
+    :param bits: The integer.
+    """
+    return bin(bits).count('1')
 
-    Preconditions:
-        - [create_logfile] must have been called prior to the calling of this function
+
+class TaxonIndex(object):
     """
-    with open(os.path.join(output_dir, LOGFILE), 'a') as f:
-        args_as_strings = map(str, args)
-        f.write('\n' + ', '.join(args_as_strings))
+    Assigns every taxon a bit, so that a set of taxa (i.e. one side of a bipartition) can be stored as a single integer
+    bitset. The same index must be shared by all of the chains being compared, so that their bitsets agree.
+    """
+    def __init__(self):
+        self.bits = {}
 
+    def __len__(self):
+        return len(self.bits)
 
-def discard_samples(chain_length):
+    def bit(self, taxon):
+        """
+        Return the bit of a taxon, assigning it the next free bit if it has not been seen before.
+
+        :param taxon: The name of the taxon.
+        """
+        bit = self.bits.get(taxon)
+        if bit is None:
+            bit = self.bits[taxon] = 1 << len(self.bits)
+        return bit
+
+    def taxa(self):
+        """
+        Return the names of the taxa, in the order of their bits.
+        """
+        return sorted(self.bits, key=self.bits.get)
+
+
+def newick_splits(newick, taxon_index):
     """
-    Calculate the number of generations to discard when running [tracecomp] or [bpcomp].
+    Return the non-trivial bipartitions of an unrooted tree, as a list of bitsets. Every bipartition is stored as the
+    side that does not contain the first taxon of the index, so that the same bipartition always has the same bitset
+    however the tree happens to be rooted. Branch lengths and internal node labels are ignored.
 
-    :param chain_length: The current length of the chains. Although the chains will have different lengths, as long as
-    the number of threads given to each chain is the same they should be roughly equal. Therefore, the length of any one
-    of the chains is a good estimate.
+    :param newick: The tree, as a Newick string.
+    :param taxon_index: The [TaxonIndex] to take the bits of the taxa from.
     """
-    return min(chain_length / 10, MAX_GEN_DISCARD)
+    clades = []
+    stack = [0]
+    expecting_leaf = True
+    for token in NEWICK_TOKEN.findall(newick):
+        if token == '(':
+            stack.append(0)
+            expecting_leaf = True
+        elif token == ',':
+            expecting_leaf = True
+        elif token == ')':
+            clade = stack.pop()
+            clades.append(clade)
+            stack[-1] |= clade
+            expecting_leaf = False
+        elif token == ';':
+            break
+        elif expecting_leaf:
+            # whatever follows a colon is the branch length
+            name = token.split(':', 1)[0].strip()
+            if name:
+                stack[-1] |= taxon_index.bit(name)
+            expecting_leaf = False
 
+    everything = (1 << len(taxon_index)) - 1
+    taxa = popcount(stack[0])
+    splits = set()
+    for clade in clades:
+        if clade & 1:
+            clade ^= everything
+        if 1 < popcount(clade) < taxa - 1:
+            splits.add(clade)
+    return list(splits)
 
-class Convergence(object):
+
+class TreelistReader(AppendedFileReader):
     """
-    The container class for the chain summary/convergence statistics.
+    An incremental reader for a chain tree list (the .treelist file, with one Newick tree per line). Every call to
+    [update] only parses the trees that the chain has appended since the previous call. Every tree is stored as the
+    array of ids of its bipartitions, all packed into one growing array, which keeps the memory needed for long chains
+    with many taxa small.
     """
-    def __init__(self, stop, converged, loglik_effsize, loglik_rel_diff, max_diff, generations):
+    def __init__(self, path, splits):
         """
-        :param stop: True if the chains are to be terminated, False if not.
-        :param converged: True if the chains is to be terminated due to convergence, False if not.
-
-        Summary statistics:
-        :param loglik_effsize: The log likelihood effective size.
-        :param loglik_rel_diff: The log likelihood relative difference.
-        :param max_diff: The maximum difference.
-        :param generations: The number of generations the chains have reached. This is to be a dictionary of the
-        following form:
-        {
-            'chain_1_name': length,
-            'chain_2_name': length,
-            et cetera
-        }
+        :param path: The path to the tree list. The file does not need to exist yet.
+        :param splits: The [SplitTable] to intern the bipartitions with.
         """
-        self.stop = stop
-        self.converged = converged
-        self.loglik_effsize = loglik_effsize
-        self.loglik_rel_diff = loglik_rel_diff
-        self.max_diff = max_diff
-        self.generations = generations
+        super(TreelistReader, self).__init__(path)
+        self.splits = splits
+        # the number of times the tree list has been started over, so that anything built on it knows to do the same
+        self.restarts = 0
+        self.trees = 0
+        self._ids = np.empty(0, dtype=np.int32)
+        self._ends = [0]
 
-    def as_list(self):
+    def reset(self):
+        super(TreelistReader, self).reset()
+        self.restarts += 1
+        self.trees = 0
+        self._ids = np.empty(0, dtype=np.int32)
+        self._ends = [0]
+
+    def update(self):
         """
-        Returns the summary statistics in list form, in the following order:
-        [converged?, log likelihood effective size, log likelihood relative difference, maximum difference]
+        Read and parse the trees that have been appended to the tree list since the last update. Return the number of
+        new trees.
         """
-        return [self.converged, self.loglik_effsize, self.loglik_rel_diff, self.max_diff]
+        new_ids = []
+        for line in self.read_new_lines():
+            line = line.decode().strip()
+            if not line.endswith(';'):
+                continue
+            ids = [self.splits.id(split) for split in newick_splits(line, self.splits.taxon_index)]
+            new_ids.extend(ids)
+            self._ends.append(self._ends[-1] + len(ids))
 
-    def print_data(self):
+        added = len(self._ends) - 1 - self.trees
+        if added:
+            self._ids = np.concatenate((self._ids, np.array(new_ids, dtype=np.int32)))
+            self.trees += added
+        return added
+
+    def split_ids(self, trees):
         """
-        Print a message for the user detailing the summary statistics.
+        Return the ids of the bipartitions of a selection of the trees read so far, all in one array.
+
+        :param trees: A [range] of tree indices.
         """
-        for chain, gen in self.generations.items():
-            print('Generations for chain %s: %d' % (chain, gen))
-        print('Log likelihood effective size: %d' % self.loglik_effsize)
-        print('Log likelihood relative difference: %f' % self.loglik_rel_diff)
-        print('Max diff: %f' % self.max_diff)
+        if not len(trees):
+            return np.empty(0, dtype=np.int32)
+        if trees.step == 1:
+            return self._ids[self._ends[trees.start]:self._ends[trees.stop]]
+        return np.concatenate([self._ids[self._ends[i]:self._ends[i + 1]] for i in trees])
 
 
-def chain_full_name(alignment, chain):
+class TreelistSampler(AppendedFileReader):
     """
-    Return the full name of a chain, composed of the chain name and the alignment name, to be used for the chain files.
+    Thins a chain tree list as the chain writes it: every call to [update] appends every [every]th tree of those the
+    chain has written since the previous call, counting from the first tree of the tree list, to the sample file of
+    the tree list (its path with [TREELIST_SAMPLE_SUFFIX] added). The tree sample and the consensus tree of the
+    alignment are then built from these files once the chains have stopped (see [build_consensus_tree]), which only
+    have to apply the burn-in, rather than from the full tree lists, which need not be kept.
 
-    :param alignment: The name of the alignment.
-    :param chain: The name of the chain.
+    The thinned tree lists give as many trees after the burn-in as the full ones, but not always the same trees: the
+    full tree lists are sampled every [every]th tree from the end of the burn-in, the thinned ones every [every]th tree
+    from the start of the chain. The sample file is started over whenever a sampler is made, so that it never depends
+    on an earlier run.
     """
-    return '%s_%s' % (alignment, chain)
+    def __init__(self, path, every=None):
+        """
+        :param path: The path to the tree list. The file does not need to exist yet.
+        :param every: Only every [every]th tree is kept. Defaults to [TREE_SAMPLE_FREQ].
+        """
+        super(TreelistSampler, self).__init__(path)
+        self.every = TREE_SAMPLE_FREQ if every is None else every
+        self.sample_path = path + TREELIST_SAMPLE_SUFFIX
+        self.trees = 0
+        open(self.sample_path, 'w').close()
+
+    def reset(self):
+        super(TreelistSampler, self).reset()
+        self.trees = 0
+        open(self.sample_path, 'w').close()
+
+    def update(self):
+        """
+        Append the trees to keep of those that have been appended to the tree list since the last update to the sample
+        file. Return the number of trees kept.
+        """
+        trees = [line.strip() for line in self.read_new_lines() if line.strip().endswith(b';')]
+        kept = [tree for i, tree in enumerate(trees, self.trees) if i % self.every == 0]
+        self.trees += len(trees)
+        if kept:
+            with open(self.sample_path, 'ab') as f:
+                f.write(b'\n'.join(kept) + b'\n')
+        return len(kept)
 
 
-def check_thresholds(alignment, chains, min_cycles, max_gen, max_loglik_effsize, min_loglik_rel_diff, min_maxdiff):
+class SplitTable(object):
     """
-    Check if the termination thresholds have been satisfied. This can come about in two ways:
-        - The chains have converged (the convergence thresholds have *all* been broken).
-        - The chains have run for too long without converging (the chains have *all* exceeded the maximum number of
-        generations).
-    After checking, return an instance of [Convergence], with the summary statistics and termination information.
+    Gives every distinct bipartition seen in any of the chains a small integer id, so that bipartition counts can be
+    kept in arrays.
+    """
+    def __init__(self):
+        self.taxon_index = TaxonIndex()
+        self.ids = {}
+        self.splits = []
 
-    Note that this function does *not* perform the check, and returns [None], if the minimum number of generations has
-    not been reached by *all* of the chains.
+    def __len__(self):
+        return len(self.splits)
 
-    :param alignment: The name of the alignment.
-    :param chains: A list of the names of the chains being run.
-    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
-    :param max_gen: The maximum number of generations for the chains to run before terminating regardless of
-    convergence. Termination happens only when *all* of the chains have reached beyond this point.
+    def id(self, split):
+        """
+        Return the id of a bipartition, assigning it the next free id if it has not been seen before.
 
-    Convergence thresholds:
-    :param max_loglik_effsize: The maximum log likelihood effective size.
-    :param min_loglik_rel_diff: The minimum log likelihood relative difference.
-    :param min_maxdiff: The minimum maximum difference.
+        :param split: The bipartition, as a bitset.
+        """
+        split_id = self.ids.get(split)
+        if split_id is None:
+            split_id = self.ids[split] = len(self.splits)
+            self.splits.append(split)
+        return split_id
 
-    Preconditions:
-        - the chains have equal numbers of threads allocated to them
+
+class SplitCounter(object):
     """
-    if trace_file_len('%s.trace' % chain_full_name(alignment, chains[0])) < min_cycles:
-        return None
-    else:
-        all_generations = {}
-        above_max_gen = True
-        g = 0
-        for chain in chains:
-            generations = trace_file_len('%s.trace' % chain_full_name(alignment, chain))
-            all_generations[chain] = generations
-            g = generations
-            above_max_gen = above_max_gen and (generations > max_gen)
+    Counts how many of the sampled trees of a chain contain each bipartition, where the sample is every [every]th tree
+    after the burn-in, as with [bpcomp -x burnin every]: like [bpcomp], the first tree sampled is the [every]th one
+    after the burn-in, rather than the first.
+
+    A separate count is kept for every possible offset of the burn-in modulo [every], each covering its own range of
+    trees. Moving the burn-in then only means adding or removing the trees between the old start of the range and the
+    new one, in either direction, and trees read since the count was last used are added on at the end.
+    """
+    def __init__(self, treelist, every):
+        """
+        :param treelist: The [TreelistReader] of the chain.
+        :param every: Only every [every]th tree after the burn-in is sampled.
+        """
+        self.treelist = treelist
+        self.every = every
+        self._restarts = treelist.restarts
+        self._clear()
 
-        chain_full_names = [chain_full_name(alignment, chain) for chain in chains]
+    def _clear(self):
+        # the trees counted for offset r are range(self._starts[r], self._ends[r], self.every)
+        self._starts = list(range(self.every))
+        self._ends = list(range(self.every))
+        self._counts = [np.zeros(0, dtype=np.int64) for _ in range(self.every)]
 
-        # we can assume that all the chains have progressed about the same amount, so pick one of the generation values
-        discard = discard_samples(g)
-        subprocess.call('tracecomp -x %d %s' % (discard, ' '.join(chain_full_names)),
-                        shell=True, stdout=devnull, stderr=devnull)  # suppress output
+    def _add(self, offset, trees, sign):
+        ids = self.treelist.split_ids(trees)
+        if len(ids):
+            change = np.bincount(ids)
+            counts = self._counts_padded(offset, len(change))
+            counts[:len(change)] += sign * change
+            self._counts[offset] = counts
+        return len(trees)
 
-        # the results get written to a file
-        loglik_effsize, loglik_rel_diff = data_from_tracecomp_file()
-        # have the thresholds been broken?
-        loglik_effsize_broken = loglik_effsize > max_loglik_effsize
-        loglik_rel_diff_broken = loglik_rel_diff < min_loglik_rel_diff
+    def _counts_padded(self, offset, size):
+        counts = self._counts[offset]
+        if len(counts) < size:
+            counts = np.concatenate((counts, np.zeros(size - len(counts), dtype=np.int64)))
+        return counts
+
+    def frequencies(self, discard):
+        """
+        Return an array with the frequency of every bipartition (indexed by id) among the sampled trees, and the number
+        of trees sampled.
 
-        subprocess.call('bpcomp -x %d %d %s' % (discard, TREE_SAMPLE_FREQ, ' '.join(chain_full_names)),
-                        shell=True, stdout=devnull, stderr=devnull)  # suppress output
+        :param discard: The number of trees to discard from the start of the chain.
+        """
+        if self.treelist.restarts != self._restarts:
+            # the tree list has started over, so the counts have to as well
+            self._restarts = self.treelist.restarts
+            self._clear()
 
-        # once again the results are written to a file
-        max_diff = data_from_bpcomp_file()
+        # from here on, [discard] is the index of the first tree sampled
+        discard += self.every - 1
+        offset = discard % self.every
+        trees = self.treelist.trees
+        start, end = self._starts[offset], self._ends[offset]
 
-        # have the thresholds been broken?
-        max_diff_broken = max_diff < min_maxdiff
+        # slide the start of the counted range to the new burn-in
+        if discard > start:
+            self._add(offset, range(start, min(discard, end), self.every), -1)
+            end = max(end, discard)
+        elif discard < start:
+            self._add(offset, range(discard, start, self.every), 1)
 
-        # print('Thresholds: max loglik %d, min loglik rel diff %f, min maxdiff %f'
-        #       % (max_loglik_effsize, min_loglik_rel_diff, min_maxdiff))
-        # print('Broken: %d %d %d' % (loglik_effsize_broken, loglik_rel_diff_broken, max_diff_broken))
+        # and count the trees that have been read since the count was last used
+        end += self.every * self._add(offset, range(end, trees, self.every), 1)
+        self._starts[offset], self._ends[offset] = discard, end
 
-        converged = loglik_effsize_broken and loglik_rel_diff_broken and max_diff_broken
-        stop = above_max_gen or converged
-        return Convergence(stop, converged, loglik_effsize, loglik_rel_diff, max_diff, all_generations)
+        sampled = len(range(discard, trees, self.every))
+        counts = self._counts_padded(offset, len(self.treelist.splits))
+        if not sampled:
+            return counts.astype(float), 0
+        return counts / sampled, sampled
 
 
-async def check_thresholds_periodic(alignment, chains, callback, check_freq, min_cycles, **thresholds):
+class BipartitionIndex(object):
     """
-    Periodically check for convergence using [check_thresholds], waiting a set amount of time before each check.
+    Computes the maximum difference between the bipartition frequencies of a set of chains directly from their tree
+    lists, as [bpcomp] does: the largest difference between the frequencies of any bipartition in any two chains,
+    among the trees sampled after the burn-in.
 
-    :param alignment: The name of the alignment.
-    :param chains: A list of the names of the chains b eing run.
-    :param callback: The callback function to call when the threshold check has failed, for whatever reason. This
-    function must take the [Convergence] instance generated by the check as its first and only argument.
-    :param check_freq: How often to perform the check (in seconds).
-    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
-    :param thresholds: The convergence thresholds to be used by [check_thresholds]. For details check the documentation
-    of the former.
+    This matches the output of [bpcomp -x burnin every] for the reference chains in benchmarks/reference, for every
+    tree and for every [every]th tree. The one known difference is with no burn-in and [every] above 1, where [bpcomp]
+    divides the counts by one more tree than it has sampled.
 
-    Preconditions:
-        - the chains have equal numbers of threads allocated to them
+    The tree lists are read incrementally, so every check only parses the trees written since the last check, and
+    moving the burn-in only touches the trees that enter or leave the sample.
     """
-    while True:
-        result = check_thresholds(alignment, chains, min_cycles, **thresholds)
-        # None indicates that the minimum number of cycles has not yet been reached
-        if result is None or not result.stop:
-            if result is not None:
-                # print some data for the user
-                result.print_data()
-                print('')  # new line
+    def __init__(self, treelist_paths, every=None):
+        """
+        :param treelist_paths: A dictionary mapping each chain name to the path of the chain's tree list.
+        :param every: Only every [every]th tree after the burn-in is sampled. Defaults to [TREE_SAMPLE_FREQ].
+        """
+        every = TREE_SAMPLE_FREQ if every is None else every
+        self.splits = SplitTable()
+        self.treelists = {chain: TreelistReader(path, self.splits) for chain, path in treelist_paths.items()}
+        self.counters = {chain: SplitCounter(treelist, every) for chain, treelist in self.treelists.items()}
 
-            await asyncio.sleep(check_freq)
-            continue
-        else:
-            # print some data for the user
-            result.print_data()
-            print('')  # new line
-            callback(result)
-            break
+    def update(self):
+        """
+        Read the trees that have been appended to the tree lists since the last update.
+        """
+        for treelist in self.treelists.values():
+            treelist.update()
+
+    def max_diff(self, discard):
+        """
+        Return the maximum difference between the bipartition frequencies of the chains.
+
+        :param discard: The number of trees to discard from the start of every chain.
+        """
+        self.update()
+        frequencies = [counter.frequencies(int(discard))[0] for counter in self.counters.values()]
+        size = max(len(f) for f in frequencies)
+        if not size:
+            return 0.0
+        frequencies = np.array([np.pad(f, (0, size - len(f)), 'constant') for f in frequencies])
+        return float((frequencies.max(axis=0) - frequencies.min(axis=0)).max())
 
 
-def mpirun_cmd(threads, phyle_name, chain_name):
+def treelist_len(path):
     """
-    Return the [mpirun] command to execute given an alignment and a chain.
+    Return the number of trees in a tree list, counted as [sampled_trees] counts them. Unlike a trace file, a tree list
+    has no header line. If the file does not exist, return 0.
 
-    :param threads: The number of threads to run the chain on.
-    :param phyle_name: The *full* name of the alignment file to process.
-    :param chain_name: The *full* name of the chain.
+    :param path: The path to the tree list.
     """
-    # Get it? Phyle name? .phy file name?
-    return shlex.split('mpirun -np %d pb_mpi -cat -gtr -dgam 4 -d %s %s' % (threads, phyle_name, chain_name))
+    try:
+        with open(path, buffering=ARCHIVE_BLOCK_SIZE) as f:
+            return sum(1 for line in f if line.strip().endswith(';'))
+    except FileNotFoundError:
+        return 0
 
 
-def terminate_all_processes(processes):
+def sampled_trees(path, discard, every):
     """
-    Terminate all the processes in a list. Note that this sends a SIGTERM rather than a SIGKILL, allowing each process
-    to exit gracefully.
+    Generate the trees sampled from a tree list, as Newick strings: every [every]th tree after the burn-in, as with
+    [bpcomp -x burnin every]. The file is streamed, so only one tree is held in memory at a time.
 
-    :param processes: The list of processes to terminate.
+    :param path: The path to the tree list.
+    :param discard: The number of trees to discard from the start of the tree list.
+    :param every: Only every [every]th tree after the burn-in is sampled.
     """
-    for process in processes:
-        process.terminate()
+    with open(path, buffering=ARCHIVE_BLOCK_SIZE) as f:
+        trees = (line.strip() for line in f if line.strip().endswith(';'))
+        for tree in itertools.islice(trees, discard, None, every):
+            yield tree
 
-def file_directory(file):
-    """
-    Get the parent directory of a given file. For example, the parent directory of "path/to/file.txt" is "path/to".
 
-    :param file: The path to the file.
+def consensus_newick(taxa, supports):
     """
-    return os.path.dirname(os.path.realpath(file))
+    Return the Newick string of the tree made up of a set of compatible bipartitions, with the support of each
+    bipartition as the label of its node. The tree is rooted on the node that the first taxon hangs off, and the
+    children of every node are written in the order of their first taxon, so that the same bipartitions always give the
+    same string.
 
+    :param taxa: The names of the taxa, in the order of their bits.
+    :param supports: A dictionary mapping each bipartition, as a bitset of the side without the first taxon, to its
+    support.
+    """
+    everything = (1 << len(taxa)) - 1
+    children = collections.defaultdict(list)
+    clades = [everything]
+    # every clade hangs off the smallest clade that contains it, and the larger clades are placed first
+    for split in sorted(supports, key=lambda split: (-popcount(split), split)):
+        parent = min((clade for clade in clades if clade & split == split), key=popcount)
+        children[parent].append(split)
+        clades.append(split)
+    for i in range(len(taxa)):
+        parent = min((clade for clade in clades if clade & (1 << i)), key=popcount)
+        children[parent].append(1 << i)
 
-def alignment_name(path):
-    return "--".join(path.split(os.path.sep)[1:])
+    def write(clade):
+        if popcount(clade) == 1:
+            return taxa[clade.bit_length() - 1]
+        # the lowest bit of a clade is its first taxon
+        subtrees = ','.join(write(child) for child in sorted(children[clade], key=lambda child: child & -child))
+        if clade == everything:
+            return '(%s)' % subtrees
+        return '(%s)%.2f' % (subtrees, supports[clade])
+    return write(everything) + ';'
 
 
-def move_output_files(output_dir, tree_dir, alignment, save_chain_files, root_dir="."):
+def majority_consensus(treelist_paths, discard=None, every=None, sample=None):
     """
-    After the chains have finished running, move the chain output files and the generated tree file to their places in
-    the output directory.
+    Return the majority-rule consensus of the trees sampled from a set of tree lists, as a Newick string with the
+    support of every bipartition (the fraction of the sampled trees that contain it) as the label of its node, or
+    [None] if there are no trees. The trees of all of the tree lists are pooled, and every bipartition that is in more
+    than half of them is kept.
+
+    The tree lists are streamed, so the memory needed does not grow with the number of trees, only with the number of
+    distinct bipartitions. The result only depends on the trees and the order of the tree lists.
+
+    :param treelist_paths: The paths to the tree lists, in order. Tree lists that do not exist are skipped.
+    :param discard: The number of trees to discard from the start of every tree list. Defaults to [discard_samples] of
+    the shortest tree list. If it would leave no trees to sample, no trees are discarded.
+    :param every: Only every [every]th tree after the burn-in is sampled. Defaults to [TREE_SAMPLE_FREQ].
+    :param sample: A file to write the sampled trees to, one per line, if any, so that the tree lists do not have to
+    be read again to keep the sample.
+    """
+    every = TREE_SAMPLE_FREQ if every is None else every
+    treelist_paths = [path for path in treelist_paths if os.path.exists(path)]
+    if not treelist_paths:
+        return None
+    if discard is None:
+        discard = discard_samples(min(treelist_len(path) for path in treelist_paths))
+
+    taxon_index = TaxonIndex()
+    counts = collections.Counter()
+    sampled = 0
+    for path in treelist_paths:
+        for tree in sampled_trees(path, int(discard), every):
+            counts.update(newick_splits(tree, taxon_index))
+            if sample is not None:
+                sample.write(tree + '\n')
+            sampled += 1
+    if not sampled:
+        return majority_consensus(treelist_paths, 0, every, sample) if discard else None
+
+    supports = {split: count / sampled for split, count in counts.items() if 2 * count > sampled}
+    return consensus_newick(taxon_index.taxa(), supports)
+
+
+def write_consensus_tree(treelist_paths, path, discard=None, every=None, sample_path=None):
+    """
+    Write the majority-rule consensus of a set of tree lists (see [majority_consensus]) to a file. The tree only
+    appears under its final name once it is complete. Return True if a tree was written, and False if there were no
+    trees to build it from.
+
+    :param treelist_paths: The paths to the tree lists, in order.
+    :param path: The path to write the tree to.
+    :param discard: The number of trees to discard from the start of every tree list.
+    :param every: Only every [every]th tree after the burn-in is sampled.
+    :param sample_path: The path to write the sampled trees to as well, if any; see [write_tree_sample]. They are
+    written as the tree lists are read for the consensus.
+    """
+    sample = open(sample_path + '.part', 'w') if sample_path is not None else None
+    try:
+        tree = majority_consensus(treelist_paths, discard, every, sample)
+    finally:
+        if sample is not None:
+            sample.close()
+    if sample_path is not None:
+        if tree is None:
+            os.remove(sample_path + '.part')
+        else:
+            os.replace(sample_path + '.part', sample_path)
+    if tree is None:
+        return False
+    with open(path + '.part', 'w') as f:
+        f.write(tree + '\n')
+    os.replace(path + '.part', path)
+    return True
+
+
+def write_tree_sample(treelist_paths, path, discard=None, every=None):
+    """
+    Write the trees sampled from a set of tree lists after the burn-in (every [every]th tree, as for
+    [majority_consensus]) to a file, one per line, in the order of the tree lists. The tree lists are streamed, so the
+    sample can be kept in place of tree lists that are far too long to be read whole. The sample only appears under its
+    final name once it is complete. Return the number of trees written.
+
+    :param treelist_paths: The paths to the tree lists, in order. Tree lists that do not exist are skipped.
+    :param path: The path to write the sample to.
+    :param discard: The number of trees to discard from the start of every tree list. Defaults to [discard_samples] of
+    the shortest tree list. If it would leave no trees to sample, no trees are discarded.
+    :param every: Only every [every]th tree after the burn-in is sampled. Defaults to [TREE_SAMPLE_FREQ].
+    """
+    every = TREE_SAMPLE_FREQ if every is None else every
+    treelist_paths = [treelist_path for treelist_path in treelist_paths if os.path.exists(treelist_path)]
+    if not treelist_paths:
+        return 0
+    if discard is None:
+        discard = discard_samples(min(treelist_len(treelist_path) for treelist_path in treelist_paths))
+
+    sampled = 0
+    with open(path + '.part', 'w') as f:
+        for treelist_path in treelist_paths:
+            for tree in sampled_trees(treelist_path, int(discard), every):
+                f.write(tree + '\n')
+                sampled += 1
+    if not sampled and discard:
+        os.remove(path + '.part')
+        return write_tree_sample(treelist_paths, path, 0, every)
+    os.replace(path + '.part', path)
+    return sampled
+
+
+def write_gene_tree_bundle(output_dir):
+    """
+    Bundle the consensus trees of the alignments in the good_trees directory of an output directory, with the paths to
+    their tree samples, into the files named by [GENE_TREES_FILE], [GENE_TREE_NAMES_FILE] and [GENE_TREE_SAMPLES_FILE],
+    in the order of the names of the alignments. The bundle replaces any earlier one. Return the number of trees in it.
 
     :param output_dir: The path to the output directory.
-    :param tree_dir: The directory to move the tree file to.
+    """
+    tree_dir = os.path.join(output_dir, 'good_trees')
+    sample_suffix = new_tree_sample_file_name('')
+    alignments = []
+    if os.path.exists(tree_dir):
+        alignments = sorted(file[:-len(new_tree_file_name(''))] for file in os.listdir(tree_dir)
+                            if file.endswith(new_tree_file_name('')) and not file.endswith(sample_suffix))
+    with open(os.path.join(output_dir, GENE_TREES_FILE + '.part'), 'w') as trees, \
+            open(os.path.join(output_dir, GENE_TREE_NAMES_FILE + '.part'), 'w') as names, \
+            open(os.path.join(output_dir, GENE_TREE_SAMPLES_FILE + '.part'), 'w') as samples:
+        for alignment in alignments:
+            with open(os.path.join(tree_dir, new_tree_file_name(alignment))) as f:
+                trees.write(f.read().strip() + '\n')
+            names.write(alignment + '\n')
+            sample_path = os.path.join(tree_dir, new_tree_sample_file_name(alignment))
+            samples.write((os.path.abspath(sample_path) if os.path.exists(sample_path) else '') + '\n')
+    for file in (GENE_TREES_FILE, GENE_TREE_NAMES_FILE, GENE_TREE_SAMPLES_FILE):
+        os.replace(os.path.join(output_dir, file + '.part'), os.path.join(output_dir, file))
+    return len(alignments)
+
+
+def data_from_tracecomp_file(work_dir='.'):
+    """
+    Parse out and return data from the summary file generated by the [tracecomp] command. Currently this is the log
+    likelihood effective size, and the log likelihood relative difference.
+
+    :param work_dir: The directory that [tracecomp] was run in. Defaults to the current directory.
+    """
+    data = ''  # assume file will have more thant [MAX_DIFF_LINE] lines
+    with open(os.path.join(work_dir, TRACECOMP_OUT_FILE)) as f:
+        for i, line in enumerate(f):
+            if i == LOGLIK_LINE:
+                data = line
+
+    parsed_data = re.sub(r'\s+', ' ', data).split(' ')
+    loglik_effsize = int(parsed_data[1])
+    loglik_rel_diff = float(parsed_data[2])
+    return loglik_effsize, loglik_rel_diff
+
+
+def data_from_bpcomp_file(work_dir='.'):
+    """
+    Parse out and return data from the summary file generated by the [bpcomp] command. Currently this is just the max
+    difference.
+
+    :param work_dir: The directory that [bpcomp] was run in. Defaults to the current directory.
+    """
+    data = ''  # assume file will have more thant [LOGLIK_LINE] lines
+    with open(os.path.join(work_dir, BPCOMP_OUT_FILE)) as f:
+        for i, line in enumerate(f):
+            if i == MAX_DIFF_LINE:
+                data = line
+
+    parsed_data = re.sub(r'\s+', ' ', data).split(' ')
+    max_diff = float(parsed_data[2])
+    return max_diff
+
+
+def create_logfile(output_dir, chains):
+    """
+    Create the CSV logfile, and populate it with column names for each of the summary statistics and each chain.
+
+    :param output_dir: The output directory (where the output files are being moved to).
+    :param chains: A list of the names of the chains being run.
+
+    Preconditions:
+        - output directory must exist
+    """
+    with open(os.path.join(output_dir, LOGFILE), 'w+') as f:
+        f.write(', '.join(LOGFILE_COLUMNS + chains + LOGFILE_EXTRA_COLUMNS))
+
+
+def add_row_to_logfile(output_dir, *args):
+    """
+    Add a CSV row to the logfile, given summary statistics and chain generation values.
+
+    :param output_dir: The output directory (where the output files are being moved to).
+    :param args: The name of the alignment, the summary statistics and the generations of the chains, in the same order
+    as the columns of the logfile as generated by [create_logfile].
+
+    Preconditions:
+        - [create_logfile] must have been called prior to the calling of this function
+    """
+    # callbacks for several alignments may be writing to the logfile at the same time
+    with LOGFILE_LOCK, open(os.path.join(output_dir, LOGFILE), 'a') as f:
+        args_as_strings = map(str, args)
+        f.write('\n' + ', '.join(args_as_strings))
+
+
+class RunStore(object):
+    """
+    The run-state store: an SQLite database in the output directory that records, for every alignment, its status, its
+    final summary statistics, the number of generations reached by each of its chains, and the summary statistics of
+    every convergence check. Looking up whether an alignment has already been run is a single indexed query, so
+    resuming a large batch does not mean scanning a logfile once per alignment.
+
+    The CSV logfile is still written alongside the database, and can be regenerated from it with [export_csv].
+
+    The store may be used from several threads (for example, from callbacks run in the event loop's executor); every
+    operation holds a lock for as long as it uses the database connection.
+    """
+    # the statuses of an alignment
+    RUNNING = 'running'
+    CONVERGED = 'converged'
+    NOT_CONVERGED = 'not_converged'
+    INCOMPLETE = 'incomplete'
+    FINISHED = (CONVERGED, NOT_CONVERGED)
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS alignments (
+            name TEXT PRIMARY KEY,
+            file TEXT,
+            status TEXT NOT NULL,
+            converged INTEGER,
+            loglik_effsize REAL,
+            loglik_rel_diff REAL,
+            max_diff REAL,
+            started REAL,
+            finished REAL,
+            position INTEGER,
+            aborted INTEGER,
+            projected_gen REAL
+        );
+        CREATE INDEX IF NOT EXISTS alignments_by_status ON alignments (status);
+        CREATE TABLE IF NOT EXISTS chains (
+            alignment TEXT NOT NULL,
+            chain TEXT NOT NULL,
+            generations INTEGER,
+            PRIMARY KEY (alignment, chain)
+        );
+        CREATE TABLE IF NOT EXISTS checks (
+            alignment TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            time REAL NOT NULL,
+            loglik_effsize REAL,
+            loglik_rel_diff REAL,
+            max_diff REAL,
+            stop INTEGER,
+            converged INTEGER,
+            projected_gen REAL,
+            discard INTEGER,
+            PRIMARY KEY (alignment, number)
+        );
+        CREATE TABLE IF NOT EXISTS check_generations (
+            alignment TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            chain TEXT NOT NULL,
+            generations INTEGER,
+            PRIMARY KEY (alignment, number, chain)
+        );
+    """
+    # the columns that have been added since the first version of the store, which older stores have to be given
+    ADDED_COLUMNS = [('alignments', 'aborted', 'INTEGER'), ('alignments', 'projected_gen', 'REAL'),
+                     ('checks', 'projected_gen', 'REAL'), ('checks', 'discard', 'INTEGER'),
+                     ('alignments', 'memory_estimate', 'REAL'), ('alignments', 'peak_memory', 'REAL')]
+
+    def __init__(self, output_dir):
+        """
+        Open the store in an output directory, creating it if it does not exist yet. If the output directory has a CSV
+        logfile from before the store existed, the alignments in it are imported as finished.
+
+        :param output_dir: The output directory.
+
+        Preconditions:
+            - output directory must exist
+        """
+        self.path = os.path.join(output_dir, RUN_STORE)
+        self._lock = threading.Lock()
+        exists = os.path.exists(self.path)
+        self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(self.SCHEMA)
+            for table, column, column_type in self.ADDED_COLUMNS:
+                columns = [row[1] for row in self._connection.execute('PRAGMA table_info(%s)' % table)]
+                if column not in columns:
+                    self._connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+
+        logfile = os.path.join(output_dir, LOGFILE)
+        if not exists and os.path.exists(logfile):
+            self.import_csv(logfile)
+
+    def close(self):
+        """
+        Close the connection to the database.
+        """
+        with self._lock:
+            self._connection.close()
+
+    def is_done(self, alignment):
+        """
+        Return True if the alignment has already been run to the end (whether its chains converged or not).
+
+        :param alignment: The name of the alignment.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT status FROM alignments WHERE name = ?', (alignment,)).fetchone()
+        return row is not None and row[0] in self.FINISHED
+
+    def status(self, alignment):
+        """
+        Return the status of an alignment, or [None] if it is not in the store.
+
+        :param alignment: The name of the alignment.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT status FROM alignments WHERE name = ?', (alignment,)).fetchone()
+        return None if row is None else row[0]
+
+    def alignments(self, status=None):
+        """
+        Return the names of the alignments in the store, in the order they were added, optionally only those with a
+        given status.
+
+        :param status: The status to select, or [None] to select every alignment.
+        """
+        with self._lock:
+            if status is None:
+                rows = self._connection.execute('SELECT name FROM alignments ORDER BY position')
+            else:
+                rows = self._connection.execute('SELECT name FROM alignments WHERE status = ? ORDER BY position',
+                                                (status,))
+            return [row[0] for row in rows]
+
+    def start(self, alignment, alignment_file):
+        """
+        Record that the chains of an alignment have been started.
+
+        :param alignment: The name of the alignment.
+        :param alignment_file: The path to the alignment file.
+        """
+        with self._lock, self._connection:
+            self._insert(alignment)
+            self._connection.execute(
+                'UPDATE alignments SET file = ?, status = ?, started = ?, finished = NULL WHERE name = ?',
+                (os.path.abspath(alignment_file), self.RUNNING, time.time(), alignment))
+
+    def record_check(self, alignment, convergence):
+        """
+        Record the result of a convergence check.
+
+        :param alignment: The name of the alignment.
+        :param convergence: The [Convergence] instance generated by the check.
+        """
+        with self._lock, self._connection:
+            number = self._connection.execute('SELECT COUNT(*) FROM checks WHERE alignment = ?',
+                                              (alignment,)).fetchone()[0]
+            self._connection.execute(
+                'INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (alignment, number, time.time(), convergence.loglik_effsize, convergence.loglik_rel_diff,
+                 convergence.max_diff, convergence.stop, convergence.converged, convergence.projected_generations,
+                 None if convergence.discard is None else int(convergence.discard)))
+            self._connection.executemany(
+                'INSERT INTO check_generations VALUES (?, ?, ?, ?)',
+                [(alignment, number, chain, generations) for chain, generations in convergence.generations.items()])
+
+    def finish(self, alignment, convergence):
+        """
+        Record the final summary statistics of an alignment whose chains have been stopped.
+
+        :param alignment: The name of the alignment.
+        :param convergence: The [Convergence] instance generated by the last check.
+        """
+        status = self.CONVERGED if convergence.converged else self.NOT_CONVERGED
+        with self._lock, self._connection:
+            self._update(alignment, status, convergence)
+
+    def mark_incomplete(self, alignment, convergence=None):
+        """
+        Record that the chains of an alignment were stopped before the run was over, for example by an exception.
+
+        :param alignment: The name of the alignment.
+        :param convergence: The [Convergence] instance generated by the last check, if there was one.
+        """
+        with self._lock, self._connection:
+            self._update(alignment, self.INCOMPLETE, convergence)
+
+    def record_memory(self, alignment, estimate, peak):
+        """
+        Record the memory that the chains of an alignment were estimated to need, before any correction, and the most
+        that they were measured to use (see [AdmissionControl]).
+
+        :param alignment: The name of the alignment.
+        :param estimate: The uncorrected estimate, in bytes.
+        :param peak: The largest measured footprint, in bytes.
+        """
+        with self._lock, self._connection:
+            self._insert(alignment)
+            self._connection.execute('UPDATE alignments SET memory_estimate = ?, peak_memory = ? WHERE name = ?',
+                                     (estimate, peak, alignment))
+
+    def memory_ratios(self):
+        """
+        Return the ratios of the measured to the estimated memory of the alignments recorded with [record_memory], in
+        the order they were recorded in.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT peak_memory / memory_estimate FROM alignments WHERE memory_estimate > 0 AND peak_memory > 0 '
+                'ORDER BY finished')
+            return [row[0] for row in rows.fetchall()]
+
+    def _insert(self, alignment):
+        # add a row for the alignment if there is none yet, numbered so that the alignments keep the order they came in
+        self._connection.execute(
+            'INSERT OR IGNORE INTO alignments (name, status, position) '
+            'VALUES (?, ?, (SELECT COUNT(*) FROM alignments))', (alignment, self.RUNNING))
+
+    def _update(self, alignment, status, convergence):
+        self._insert(alignment)
+        self._connection.execute('UPDATE alignments SET status = ?, finished = ? WHERE name = ?',
+                                 (status, time.time(), alignment))
+        if convergence is not None:
+            self._connection.execute(
+                'UPDATE alignments SET converged = ?, loglik_effsize = ?, loglik_rel_diff = ?, max_diff = ?, '
+                'aborted = ?, projected_gen = ? WHERE name = ?',
+                (convergence.converged, convergence.loglik_effsize, convergence.loglik_rel_diff,
+                 convergence.max_diff, convergence.aborted, convergence.projected_generations, alignment))
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO chains VALUES (?, ?, ?)',
+                [(alignment, chain, generations) for chain, generations in convergence.generations.items()])
+
+    def generations(self, alignment):
+        """
+        Return a dictionary mapping each chain of an alignment to the number of generations it had reached when it was
+        last recorded.
+
+        :param alignment: The name of the alignment.
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT chain, generations FROM chains WHERE alignment = ?', (alignment,))
+            return dict(rows.fetchall())
+
+    def times(self, alignment):
+        """
+        Return the times at which the chains of an alignment were last started and stopped, as a tuple of timestamps,
+        either of which may be [None].
+
+        :param alignment: The name of the alignment.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT started, finished FROM alignments WHERE name = ?',
+                                           (alignment,)).fetchone()
+        return (None, None) if row is None else row
+
+    def checks(self, alignment):
+        """
+        Return the time series of the convergence checks of an alignment, as a list of dictionaries with the keys
+        "time", "loglik_effsize", "loglik_rel_diff", "max_diff", "stop", "converged", "projected_gen", "discard" and
+        "generations" (itself a dictionary mapping each chain to its number of generations), in the order of the
+        checks.
+
+        :param alignment: The name of the alignment.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT number, time, loglik_effsize, loglik_rel_diff, max_diff, stop, converged, projected_gen, '
+                'discard FROM checks WHERE alignment = ? ORDER BY number', (alignment,)).fetchall()
+            generations = collections.defaultdict(dict)
+            for number, chain, g in self._connection.execute(
+                    'SELECT number, chain, generations FROM check_generations WHERE alignment = ?', (alignment,)):
+                generations[number][chain] = g
+        return [{'time': row[1], 'loglik_effsize': row[2], 'loglik_rel_diff': row[3], 'max_diff': row[4],
+                 'stop': bool(row[5]), 'converged': bool(row[6]), 'projected_gen': row[7], 'discard': row[8],
+                 'generations': generations[row[0]]}
+                for row in rows]
+
+    def import_csv(self, path):
+        """
+        Import the alignments in a CSV logfile (as written by [create_logfile] and [add_row_to_logfile]) as finished.
+
+        :param path: The path to the logfile.
+        """
+        with open(path) as csv_fp:
+            reader = csv.DictReader(csv_fp, skipinitialspace=True)
+            rows = list(reader)
+            chains = [column for column in (reader.fieldnames or [])
+                      if column not in LOGFILE_COLUMNS and column not in LOGFILE_EXTRA_COLUMNS]
+
+        def number(value, kind):
+            try:
+                return kind(value)
+            except (TypeError, ValueError):
+                return None
+
+        with self._lock, self._connection:
+            for row in rows:
+                converged = row.get('converged', '').strip() == 'True'
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO alignments (name, status, converged, loglik_effsize, loglik_rel_diff, '
+                    'max_diff, aborted, projected_gen, position) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM alignments))',
+                    (row['alignment'], self.CONVERGED if converged else self.NOT_CONVERGED, converged,
+                     number(row.get('loglik_effsize'), float), number(row.get('loglik_rel_diff'), float),
+                     number(row.get('max_diff'), float), (row.get('aborted') or '').strip() == 'True',
+                     number(row.get('projected_gen'), float)))
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO chains VALUES (?, ?, ?)',
+                    [(row['alignment'], chain, number(row.get(chain), int)) for chain in chains])
+
+    @classmethod
+    def finished_in(cls, output_dir):
+        """
+        Return the names of the alignments that have been run to the end according to the store in an output directory,
+        without writing to it (or creating it, if there is none).
+
+        :param output_dir: The output directory.
+        """
+        path = os.path.abspath(os.path.join(output_dir, RUN_STORE))
+        if not os.path.exists(path):
+            return []
+        connection = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(path), uri=True, timeout=60)
+        try:
+            rows = connection.execute('SELECT name FROM alignments WHERE status IN (?, ?) ORDER BY position',
+                                      cls.FINISHED)
+            return [row[0] for row in rows]
+        finally:
+            connection.close()
+
+    def merge(self, path):
+        """
+        Merge another store into this one, such as the store of a worker (see [merge_worker_stores]). An alignment that
+        is in both stores takes its status, its summary statistics and the generations of its chains from the store
+        in which it was finished or, if it was finished in both or in neither, in which it was started last. The
+        convergence checks of both are kept, in the order they were made. Merging the same store again changes
+        nothing that it has not changed since.
+
+        :param path: The path to the other store.
+        """
+        other = sqlite3.connect(path, timeout=60)
+        try:
+            columns = [row[1] for row in other.execute('PRAGMA table_info(alignments)')
+                       if row[1] not in ('name', 'position')]
+            rows = other.execute('SELECT name, %s FROM alignments ORDER BY position' % ', '.join(columns)).fetchall()
+            chains = collections.defaultdict(list)
+            for alignment, chain, generations in other.execute('SELECT alignment, chain, generations FROM chains'):
+                chains[alignment].append((alignment, chain, generations))
+            checks = collections.defaultdict(list)
+            for row in other.execute('SELECT * FROM checks ORDER BY number'):
+                checks[row[0]].append(row)
+            check_generations = collections.defaultdict(list)
+            for row in other.execute('SELECT * FROM check_generations'):
+                check_generations[row[0], row[1]].append(row[2:])
+        finally:
+            other.close()
+
+        with self._lock, self._connection:
+            for row in rows:
+                name, values = row[0], dict(zip(columns, row[1:]))
+                mine = self._connection.execute('SELECT status, started FROM alignments WHERE name = ?',
+                                                (name,)).fetchone()
+                finished = values['status'] in self.FINISHED
+                if mine is None or ((finished, values['started'] or 0) >= (mine[0] in self.FINISHED, mine[1] or 0)):
+                    self._insert(name)
+                    self._connection.execute('UPDATE alignments SET %s WHERE name = ?'
+                                             % ', '.join('%s = ?' % column for column in columns),
+                                             [values[column] for column in columns] + [name])
+                    self._connection.execute('DELETE FROM chains WHERE alignment = ?', (name,))
+                    self._connection.executemany('INSERT INTO chains VALUES (?, ?, ?)', chains[name])
+
+                # the checks of both stores, told apart by their times, are numbered again in the order of their times
+                merged = {}
+                for check in self._connection.execute('SELECT * FROM checks WHERE alignment = ?', (name,)).fetchall():
+                    merged[check[2]] = (check, self._connection.execute(
+                        'SELECT chain, generations FROM check_generations WHERE alignment = ? AND number = ?',
+                        (name, check[1])).fetchall())
+                for check in checks[name]:
+                    merged.setdefault(check[2], (check, check_generations[name, check[1]]))
+                self._connection.execute('DELETE FROM checks WHERE alignment = ?', (name,))
+                self._connection.execute('DELETE FROM check_generations WHERE alignment = ?', (name,))
+                for number, check_time in enumerate(sorted(merged)):
+                    check, generations = merged[check_time]
+                    self._connection.execute('INSERT INTO checks VALUES (%s)' % ', '.join('?' * len(check)),
+                                             (name, number) + tuple(check[2:]))
+                    self._connection.executemany('INSERT INTO check_generations VALUES (?, ?, ?, ?)',
+                                                 [(name, number, chain, g) for chain, g in generations])
+
+    def export_csv(self, path, chains):
+        """
+        Write the finished alignments to a CSV file in the format of the logfile, so that spreadsheets built on the
+        logfile keep working.
+
+        :param path: The path to write the CSV file to.
+        :param chains: A list of the names of the chains, one column each.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT name, converged, loglik_effsize, loglik_rel_diff, max_diff, aborted, projected_gen '
+                'FROM alignments WHERE status IN (?, ?) ORDER BY position', self.FINISHED).fetchall()
+            generations = collections.defaultdict(dict)
+            for alignment, chain, g in self._connection.execute('SELECT alignment, chain, generations FROM chains'):
+                generations[alignment][chain] = g
+
+        with open(path, 'w') as f:
+            f.write(', '.join(LOGFILE_COLUMNS + chains + LOGFILE_EXTRA_COLUMNS))
+            for name, converged, loglik_effsize, loglik_rel_diff, max_diff, aborted, projected_gen in rows:
+                effsize = '' if loglik_effsize is None else '%d' % loglik_effsize
+                values = [name, bool(converged), effsize, loglik_rel_diff, max_diff]
+                values += [generations[name].get(chain, 0) for chain in chains]
+                values += [bool(aborted), projected_gen]
+                f.write('\n' + ', '.join('' if value is None else str(value) for value in values))
+
+
+def discard_samples(chain_length):
+    """
+    Calculate the number of generations to discard when running [tracecomp] or [bpcomp], with the fixed rule (see
+    [BURN_IN_MODES]).
+
+    :param chain_length: The current length of the chains. Although the chains will have different lengths, as long as
+    the number of threads given to each chain is the same they should be roughly equal. Therefore, the length of any one
+    of the chains is a good estimate.
+    """
+    return min(chain_length / 10, MAX_GEN_DISCARD)
+
+
+class Convergence(object):
+    """
+    The container class for the chain summary/convergence statistics.
+    """
+    def __init__(self, stop, converged, loglik_effsize, loglik_rel_diff, max_diff, generations, aborted=False,
+                 projected_generations=None, discard=None, timings=None):
+        """
+        :param stop: True if the chains are to be terminated, False if not.
+        :param converged: True if the chains is to be terminated due to convergence, False if not.
+        :param aborted: True if the chains are to be terminated early, because they are projected not to converge
+        before the maximum number of generations.
+        :param projected_generations: The number of generations at which the chains are projected to converge by a
+        [ConvergencePredictor] (which may be infinite), or [None] if no projection was made.
+        :param discard: The number of generations discarded from the start of every chain as burn-in.
+        :param timings: A dictionary mapping each stage of the check (see [check_thresholds]) to the wall time spent in
+        it, in seconds.
+
+        Summary statistics:
+        :param loglik_effsize: The log likelihood effective size.
+        :param loglik_rel_diff: The log likelihood relative difference.
+        :param max_diff: The maximum difference, or [None] if it was not computed.
+        :param generations: The number of generations the chains have reached. This is to be a dictionary of the
+        following form:
+        {
+            'chain_1_name': length,
+            'chain_2_name': length,
+            et cetera
+        }
+        """
+        self.stop = stop
+        self.converged = converged
+        self.loglik_effsize = loglik_effsize
+        self.loglik_rel_diff = loglik_rel_diff
+        self.max_diff = max_diff
+        self.generations = generations
+        self.aborted = aborted
+        self.projected_generations = projected_generations
+        self.discard = discard
+        self.timings = timings if timings is not None else {}
+
+    def as_list(self):
+        """
+        Returns the summary statistics in list form, in the following order:
+        [converged?, log likelihood effective size, log likelihood relative difference, maximum difference]
+        """
+        return [self.converged, self.loglik_effsize, self.loglik_rel_diff, self.max_diff]
+
+    def print_data(self):
+        """
+        Print a message for the user detailing the summary statistics.
+        """
+        for chain, gen in self.generations.items():
+            print('Generations for chain %s: %d' % (chain, gen))
+        if self.discard is not None:
+            print('Burn-in: %d' % self.discard)
+        print('Log likelihood effective size: %d' % self.loglik_effsize)
+        print('Log likelihood relative difference: %f' % self.loglik_rel_diff)
+        if self.max_diff is None:
+            print('Max diff: not computed (log likelihood thresholds not yet broken)')
+        else:
+            print('Max diff: %f' % self.max_diff)
+        if self.projected_generations is not None:
+            print('Projected generations to converge: %s' % ('never' if math.isinf(self.projected_generations)
+                                                             else '%d' % self.projected_generations))
+
+
+def chain_full_name(alignment, chain):
+    """
+    Return the full name of a chain, composed of the chain name and the alignment name, to be used for the chain files.
+
     :param alignment: The name of the alignment.
-    :param save_chain_files: True if the output chain files from this run are to be kept, False if they are to be
-    deleted.
-    :param root_dir: The root directory of the alignment file. Defaults to the current directory.
+    :param chain: The name of the chain.
+    """
+    return '%s_%s' % (alignment, chain)
+
+
+def trace_readers_for(alignment, chains, work_dir='.'):
+    """
+    Return a dictionary mapping each chain name to a new [TraceReader] for the chain's trace file.
+
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains being run.
+    :param work_dir: The directory that the chains are being run in. Defaults to the current directory.
+    """
+    return {chain: TraceReader(os.path.join(work_dir, '%s.trace' % chain_full_name(alignment, chain)))
+            for chain in chains}
+
+
+def bipartition_index_for(alignment, chains, work_dir='.'):
+    """
+    Return a new [BipartitionIndex] for the tree lists of the chains.
+
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains being run.
+    :param work_dir: The directory that the chains are being run in. Defaults to the current directory.
+    """
+    return BipartitionIndex({chain: os.path.join(work_dir, '%s.treelist' % chain_full_name(alignment, chain))
+                             for chain in chains})
+
+
+async def run_diagnostic_command(args, work_dir='.'):
+    """
+    Run one of the PhyloBayes diagnostic commands ([tracecomp] or [bpcomp]) as an asynchronous subprocess, suppressing
+    its output, and wait for it to finish. If the waiting coroutine is cancelled, the command is killed.
+
+    :param args: The command and its arguments, as a list.
+    :param work_dir: The directory to run the command in. Defaults to the current directory.
+    """
+    process = await asyncio.create_subprocess_exec(*args, cwd=work_dir, stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        return await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+
+
+async def timed(timings, stage, awaitable):
+    """
+    Await something, and add the wall time that it took to a stage of a dictionary of timings.
+
+    :param timings: A dictionary mapping stages to wall times, in seconds, such as a [collections.defaultdict].
+    :param stage: The name of the stage.
+    :param awaitable: The coroutine or future to await.
+    """
+    start = time.time()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] += time.time() - start
+
+
+async def check_thresholds(alignment, chains, min_cycles, max_gen, max_loglik_effsize, min_loglik_rel_diff,
+                           min_maxdiff, work_dir='.', trace_readers=None, trace_diagnostics=None,
+                           bipartition_index=None, diagnostics=DIAGNOSTICS, tiered=False, tree_check=False,
+                           burn_in=BURN_IN, consensus=CONSENSUS):
+    """
+    Check if the termination thresholds have been satisfied. This can come about in two ways:
+        - The chains have converged (the convergence thresholds have *all* been broken).
+        - The chains have run for too long without converging (the chains have *all* exceeded the maximum number of
+        generations).
+    After checking, return an instance of [Convergence], with the summary statistics and termination information.
+
+    Note that this function does *not* perform the check, and returns [None], if the minimum number of generations has
+    not been reached by *all* of the chains. The chains need not have progressed equally: the burn-in is worked out from
+    the chain that is furthest behind.
+
+    This is a coroutine: the trace files and tree lists are parsed in the event loop's default executor, and [tracecomp]
+    and [bpcomp] are run as asynchronous subprocesses (at the same time, unless [tiered] needs the result of the one
+    before running the other), so that the event loop is free to supervise other alignments while the check runs.
+
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains being run.
+    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+    :param max_gen: The maximum number of generations for the chains to run before terminating regardless of
+    convergence. Termination happens only when *all* of the chains have reached beyond this point.
+
+    Convergence thresholds:
+    :param max_loglik_effsize: The maximum log likelihood effective size.
+    :param min_loglik_rel_diff: The minimum log likelihood relative difference.
+    :param min_maxdiff: The minimum maximum difference.
+
+    :param work_dir: The directory that the chains are being run in. Defaults to the current directory.
+    :param trace_readers: A dictionary mapping each chain name to the [TraceReader] for its trace file, as created by
+    [trace_readers_for]. Passing the same readers to every check means that each check only reads the new part of
+    every trace file. If not given, the trace files are read from the start.
+    :param trace_diagnostics: The [TraceDiagnostics] for the chains, built on [trace_readers]. Like the readers, this
+    should be kept between checks. If not given, a new one is created.
+    :param bipartition_index: The [BipartitionIndex] for the chains' tree lists, as created by [bipartition_index_for].
+    This should also be kept between checks. If not given, a new one is created.
+    :param diagnostics: How to compute the diagnostics; one of [DIAGNOSTICS_MODES]. "native" computes them in-process,
+    "external" runs [tracecomp] and [bpcomp], and "cross-check" does both, warning if they disagree and using the native
+    values.
+    :param tiered: If True, the (expensive) maximum difference is only computed when the (cheap) log likelihood
+    thresholds have both been broken, or when the chains have exceeded the maximum number of generations, since
+    otherwise the chains cannot have converged anyway. If it is not computed, the max diff of the result is [None].
+    :param tree_check: If True, compute the maximum difference even if [tiered] would skip it, for example to log it
+    every so often.
+    :param burn_in: How to choose the number of generations to discard as burn-in, for both the trace and the tree
+    diagnostics; one of [BURN_IN_MODES]. "fixed" uses [discard_samples], and "auto" detects the burn-in from the log
+    likelihood traces with [TraceDiagnostics.burn_in].
+    :param consensus: How the consensus tree is to be built once the chains are stopped; one of [CONSENSUS_MODES]. With
+    "bpcomp" in native mode, [bpcomp] is run when the chains are to be stopped, since it has not been run for the
+    check. With "native", the tree is left to [build_consensus_tree].
+
+    The wall time spent in each stage of the check is recorded in the timings of the result: "trace_read" (reading the
+    trace files), "burn_in", "trace_diagnostics" and "tree_diagnostics" (the native diagnostics, including reading the
+    tree lists), "tracecomp" and "bpcomp" (the external commands), and "parse" (reading their output files).
+    """
+    loop = asyncio.get_event_loop()
+    timings = collections.defaultdict(float)
+    if trace_readers is None:
+        trace_readers = trace_readers_for(alignment, chains, work_dir)
+    if trace_diagnostics is None:
+        trace_diagnostics = TraceDiagnostics(trace_readers)
+    if bipartition_index is None:
+        bipartition_index = bipartition_index_for(alignment, chains, work_dir)
+    await timed(timings, 'trace_read', asyncio.gather(
+        *[loop.run_in_executor(None, trace_readers[chain].update) for chain in chains]))
+
+    all_generations = {}
+    above_max_gen = True
+    for chain in chains:
+        generations = trace_readers[chain].generations()
+        all_generations[chain] = generations
+        above_max_gen = above_max_gen and (generations > max_gen)
+
+    # the chain that is furthest behind decides whether there is enough to check, and how much to discard as burn-in
+    g = min(all_generations.values())
+    if g < min_cycles:
+        return None
+
+    chain_full_names = [chain_full_name(alignment, chain) for chain in chains]
+
+    if burn_in == 'auto':
+        discard = await timed(timings, 'burn_in', loop.run_in_executor(None, trace_diagnostics.burn_in))
+        if not trace_diagnostics.burn_in_detected:
+            warnings.warn('Alignment %s: no burn-in passed Geweke\'s test, so the fixed burn-in rule was used'
+                          % alignment, UserWarning)
+    else:
+        discard = discard_samples(g)
+    tracecomp_cmd = ['tracecomp', '-x', '%d' % discard] + chain_full_names
+    bpcomp_cmd = ['bpcomp', '-x', '%d' % discard, '%d' % TREE_SAMPLE_FREQ] + chain_full_names
+
+    async def trace_test():
+        if diagnostics != 'external':
+            loglik_effsize, loglik_rel_diff = await timed(timings, 'trace_diagnostics', loop.run_in_executor(
+                None, trace_diagnostics.compute, discard))
+
+        if diagnostics != 'native':
+            await timed(timings, 'tracecomp', run_diagnostic_command(tracecomp_cmd, work_dir))
+
+            # the results get written to a file
+            tracecomp_effsize, tracecomp_rel_diff = await timed(timings, 'parse', loop.run_in_executor(
+                None, data_from_tracecomp_file, work_dir))
+            if diagnostics == 'external':
+                loglik_effsize, loglik_rel_diff = tracecomp_effsize, tracecomp_rel_diff
+            elif (abs(loglik_effsize - tracecomp_effsize) > CROSS_CHECK_EFFSIZE_TOLERANCE * tracecomp_effsize
+                  or abs(loglik_rel_diff - tracecomp_rel_diff) > CROSS_CHECK_REL_DIFF_TOLERANCE):
+                warnings.warn('Alignment %s: native log likelihood diagnostics (effsize %d, rel_diff %f) disagree with '
+                              'tracecomp (effsize %d, rel_diff %f)'
+                              % (alignment, loglik_effsize, loglik_rel_diff, tracecomp_effsize, tracecomp_rel_diff),
+                              UserWarning)
+        return loglik_effsize, loglik_rel_diff
+
+    async def tree_test():
+        if diagnostics != 'external':
+            max_diff = await timed(timings, 'tree_diagnostics', loop.run_in_executor(
+                None, bipartition_index.max_diff, discard))
+
+        if diagnostics != 'native':
+            await timed(timings, 'bpcomp', run_diagnostic_command(bpcomp_cmd, work_dir))
+
+            # once again the results are written to a file
+            bpcomp_max_diff = await timed(timings, 'parse', loop.run_in_executor(
+                None, data_from_bpcomp_file, work_dir))
+            if diagnostics == 'external':
+                max_diff = bpcomp_max_diff
+            elif abs(max_diff - bpcomp_max_diff) > CROSS_CHECK_MAX_DIFF_TOLERANCE:
+                warnings.warn('Alignment %s: native max diff (%f) disagrees with bpcomp (%f)'
+                              % (alignment, max_diff, bpcomp_max_diff), UserWarning)
+        return max_diff
+
+    if tiered and not above_max_gen and not tree_check:
+        (loglik_effsize, loglik_rel_diff), max_diff = await trace_test(), None
+    else:
+        (loglik_effsize, loglik_rel_diff), max_diff = await asyncio.gather(trace_test(), tree_test())
+
+    # have the thresholds been broken?
+    loglik_effsize_broken = loglik_effsize > max_loglik_effsize
+    loglik_rel_diff_broken = loglik_rel_diff < min_loglik_rel_diff
+
+    if max_diff is None:
+        if not (loglik_effsize_broken and loglik_rel_diff_broken):
+            # the chains cannot have converged, so there is no need for the tree test
+            return Convergence(False, False, loglik_effsize, loglik_rel_diff, None, all_generations,
+                               discard=discard, timings=dict(timings))
+        max_diff = await tree_test()
+
+    # have the thresholds been broken?
+    max_diff_broken = max_diff < min_maxdiff
+
+    converged = loglik_effsize_broken and loglik_rel_diff_broken and max_diff_broken
+    stop = above_max_gen or converged
+    if stop and diagnostics == 'native' and consensus == 'bpcomp':
+        # bpcomp has not been run, but we still need it for the consensus tree
+        await timed(timings, 'bpcomp', run_diagnostic_command(bpcomp_cmd, work_dir))
+    return Convergence(stop, converged, loglik_effsize, loglik_rel_diff, max_diff, all_generations, discard=discard,
+                       timings=dict(timings))
+
+
+class TraceWatcher(object):
+    """
+    Waits for the chains in a directory to append to their trace files. On Linux the directory is watched with inotify,
+    so a waiting coroutine wakes up as soon as a trace file is written to; elsewhere (or if inotify is unavailable) the
+    sizes of the trace files are polled instead, at an interval that the caller can adapt to how fast the chains are
+    running.
+    """
+    IN_MODIFY = 0x2
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, work_dir, suffix='.trace'):
+        """
+        :param work_dir: The directory that the chains are being run in.
+        :param suffix: The suffix of the files to watch.
+        """
+        self.work_dir = work_dir
+        self.suffix = suffix
+        self._fd = None
+        self._changed = asyncio.Event()
+        self._sizes = self._trace_sizes()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(work_dir),
+                                          self.IN_MODIFY | self.IN_CREATE | self.IN_MOVED_TO) < 0:
+                    os.close(fd)
+                else:
+                    asyncio.get_event_loop().add_reader(fd, self._read_events)
+                    self._fd = fd
+        except (OSError, AttributeError, NotImplementedError):
+            # no libc, no inotify, or an event loop that cannot watch file descriptors; fall back to polling
+            self._fd = None
+
+    @property
+    def polling(self):
+        """
+        True if the trace files are being polled, and False if they are being watched with inotify.
+        """
+        return self._fd is None
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        i = 0
+        while i + self.EVENT_HEADER.size <= len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, i)
+            i += self.EVENT_HEADER.size
+            name = data[i:i + length].rstrip(b'\0')
+            i += length
+            if name.endswith(os.fsencode(self.suffix)):
+                self._changed.set()
+
+    def _trace_sizes(self):
+        sizes = {}
+        try:
+            for file in os.listdir(self.work_dir):
+                if file.endswith(self.suffix):
+                    try:
+                        sizes[file] = os.path.getsize(os.path.join(self.work_dir, file))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return sizes
+
+    async def wait(self, timeout, poll_interval=MIN_POLL_INTERVAL):
+        """
+        Wait until one of the trace files has grown, or until the timeout runs out. Return True if a trace file has
+        grown, and False if the timeout ran out first.
+
+        :param timeout: The longest time to wait (in seconds).
+        :param poll_interval: How often to check the sizes of the trace files when polling (in seconds).
+        """
+        if not self.polling:
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                return False
+            self._changed.clear()
+            return True
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(poll_interval, remaining))
+            sizes = self._trace_sizes()
+            if sizes != self._sizes:
+                self._sizes = sizes
+                return True
+
+    def close(self):
+        """
+        Stop watching the directory.
+        """
+        if self._fd is not None:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+class CheckScheduler(object):
+    """
+    Decides how many generations the chains should reach before they are checked again. Rather than checking every so
+    many seconds, the scheduler projects, from the last check, how many generations the chains still need to break all
+    of the convergence thresholds, and schedules the next check halfway there (but at least [check_gens] generations
+    ahead). Chains far from converging are therefore checked rarely, and chains close to converging are checked often,
+    so that they are stopped soon after they converge.
+
+    The projection assumes that the effective size grows in proportion to the number of samples after the burn-in,
+    and that the relative difference and the max diff shrink in proportion to the inverse square root of it.
+    """
+    def __init__(self, check_gens, min_cycles, max_gen, max_loglik_effsize, min_loglik_rel_diff, min_maxdiff):
+        """
+        :param check_gens: The smallest number of new generations to wait for between checks.
+        :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+        For the other parameters, see the documentation of [check_thresholds].
+        """
+        self.check_gens = check_gens
+        self.min_cycles = min_cycles
+        self.max_gen = max_gen
+        self.max_loglik_effsize = max_loglik_effsize
+        self.min_loglik_rel_diff = min_loglik_rel_diff
+        self.min_maxdiff = min_maxdiff
+        self.rate = None
+        self._last = None
+
+    def observe(self, generations):
+        """
+        Record how many generations the chains have reached, to keep track of how fast they are running.
+
+        :param generations: The smallest number of generations reached by any chain.
+        """
+        now = time.time()
+        if self._last is not None:
+            last_time, last_generations = self._last
+            if now > last_time and generations > last_generations:
+                rate = (generations - last_generations) / (now - last_time)
+                # smooth the rate, since the chains do not write to their trace files at a steady pace
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        if self._last is None or generations != self._last[1]:
+            self._last = (now, generations)
+
+    def projected_generations(self, convergence):
+        """
+        Return the projected number of generations at which the chains will break all of the convergence thresholds.
+
+        :param convergence: The [Convergence] instance generated by the last check.
+        """
+        generations = min(convergence.generations.values())
+        discard = discard_samples(generations) if convergence.discard is None else convergence.discard
+        samples = max(generations - discard, 1)
+
+        needed = [samples * (self.max_loglik_effsize + 1) / max(convergence.loglik_effsize, 1)]
+        if convergence.loglik_rel_diff >= self.min_loglik_rel_diff:
+            needed.append(samples * (convergence.loglik_rel_diff / self.min_loglik_rel_diff) ** 2)
+        if convergence.max_diff is not None and convergence.max_diff >= self.min_maxdiff:
+            needed.append(samples * (convergence.max_diff / self.min_maxdiff) ** 2)
+        return max(needed) + discard
+
+    def next_target(self, convergence, generations):
+        """
+        Return the number of generations that the chains should reach before they are checked again.
+
+        :param convergence: The [Convergence] instance generated by the last check, or [None] if the chains had not yet
+        reached the minimum number of generations.
+        :param generations: The smallest number of generations reached by any chain.
+        """
+        if convergence is None:
+            return max(self.min_cycles, generations + 1)
+        target = generations + max(self.check_gens, (self.projected_generations(convergence) - generations) / 2)
+        # make sure that the chains are checked as soon as they run past the maximum number of generations
+        return int(min(target, max(self.max_gen + 1, generations + self.check_gens)))
+
+    def poll_interval(self, target, generations):
+        """
+        Return how often to poll the trace files while waiting for the chains to reach a number of generations, if they
+        cannot be watched with inotify: about four times before the chains are expected to get there.
+
+        :param target: The number of generations to wait for.
+        :param generations: The smallest number of generations reached by any chain.
+        """
+        if not self.rate:
+            return MIN_POLL_INTERVAL
+        return min(max((target - generations) / self.rate / 4, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+
+def normal_quantile(p):
+    """
+    Return the quantile function of the standard normal distribution at a probability, found by bisection.
+
+    :param p: The probability, strictly between 0 and 1.
+    """
+    low, high = -10.0, 10.0
+    for i in range(100):
+        middle = (low + high) / 2
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class ConvergencePredictor(object):
+    """
+    Projects, from the history of the convergence checks of an alignment, how many generations its chains need to
+    break all of the convergence thresholds, so that runs which are stuck far from converging can be stopped early.
+
+    Each diagnostic is fitted as a power law of the number of samples after the burn-in (a straight line on a log-log
+    scale) by least squares, and the line is extrapolated to the threshold. To be on the safe side, the projection uses
+    the most optimistic slope within the one-sided [confidence] interval of the fit, so a run is only deemed hopeless if
+    even that slope does not get it to converge before the maximum number of generations.
+    """
+    def __init__(self, max_gen, max_loglik_effsize, min_loglik_rel_diff, min_maxdiff, confidence=ABORT_CONFIDENCE):
+        """
+        :param confidence: How sure the projection must be that the chains will not converge in time.
+        For the other parameters, see the documentation of [check_thresholds].
+        """
+        self.max_gen = max_gen
+        self.max_loglik_effsize = max_loglik_effsize
+        self.min_loglik_rel_diff = min_loglik_rel_diff
+        self.min_maxdiff = min_maxdiff
+        self.z = normal_quantile(confidence)
+        self._history = []
+
+    def observe(self, convergence):
+        """
+        Add the result of a check to the history.
+
+        :param convergence: The [Convergence] instance generated by the check.
+        """
+        generations = min(convergence.generations.values())
+        discard = discard_samples(generations) if convergence.discard is None else convergence.discard
+        samples = generations - discard
+        if samples > 0:
+            self._history.append((samples, convergence.loglik_effsize, convergence.loglik_rel_diff,
+                                  convergence.max_diff, discard))
+
+    def _needed_samples(self, values, threshold, increasing):
+        # the number of samples at which the fitted power law (optimistically) crosses the threshold
+        points = [(samples, value) for samples, value in values if value is not None]
+        if len(points) < PREDICTOR_MIN_CHECKS:
+            return None
+        last_samples, last_value = points[-1]
+        if (last_value > threshold) if increasing else (last_value < threshold):
+            return last_samples
+
+        x = np.log([samples for samples, value in points])
+        y = np.log([max(value, 1e-9) for samples, value in points])
+        spread = np.sum((x - x.mean()) ** 2)
+        if spread == 0:
+            return None
+        slope = np.sum((x - x.mean()) * (y - y.mean())) / spread
+        intercept = y.mean() - slope * x.mean()
+        residuals = y - (intercept + slope * x)
+        slope_error = math.sqrt(np.sum(residuals ** 2) / (len(points) - 2) / spread)
+        slope = slope + self.z * slope_error if increasing else slope - self.z * slope_error
+        if (slope <= 0) if increasing else (slope >= 0):
+            # even the optimistic trend is heading the wrong way
+            return math.inf
+        # extrapolate from the last check, which knows the most about where the chains are now
+        log_needed = math.log(last_samples) + (math.log(threshold) - math.log(max(last_value, 1e-9))) / slope
+        # anything this far out might as well be never (and would overflow)
+        return math.exp(log_needed) if log_needed < PREDICTOR_MAX_LOG_SAMPLES else math.inf
+
+    def projected_generations(self):
+        """
+        Return the projected number of generations at which the chains will break all of the convergence thresholds
+        (which may be infinite), or [None] if there are not enough checks to go on yet.
+        """
+        needed = [
+            self._needed_samples([(h[0], h[1]) for h in self._history], self.max_loglik_effsize, True),
+            self._needed_samples([(h[0], h[2]) for h in self._history], self.min_loglik_rel_diff, False),
+            self._needed_samples([(h[0], h[3]) for h in self._history], self.min_maxdiff, False),
+        ]
+        # the max diff may not have been computed often enough (with tiered checks), in which case it is left out
+        needed = [samples for samples in needed if samples is not None]
+        if len(needed) < 2:
+            return None
+        # assume that the burn-in stays where it was at the last check
+        return max(needed) + self._history[-1][4]
+
+    def hopeless(self, projected_generations):
+        """
+        Return True if a projection says that the chains will not converge before the maximum number of generations.
+
+        :param projected_generations: The projection, as returned by [projected_generations].
+        """
+        return projected_generations is not None and projected_generations > self.max_gen
+
+
+async def call_callback(callback, *args):
+    """
+    Call a callback that may be either a coroutine function, which is awaited, or a plain function, which is run in the
+    event loop's default executor so that it cannot block the loop.
+
+    :param callback: The callback.
+    :param args: The arguments to call it with.
+    """
+    if asyncio.iscoroutinefunction(callback):
+        return await callback(*args)
+    return await asyncio.get_event_loop().run_in_executor(None, partial(callback, *args))
+
+
+async def run_to_completion(function, *args, **kwargs):
+    """
+    Run a blocking step of the clean-up of a task (stopping the chains, saving their files) in the event loop's default
+    executor, so that the other tasks carry on meanwhile, and wait for it to finish. Cancelling the task while it waits
+    interrupts neither the step nor the rest of the clean-up: the task is on its way out already, so the cancellation
+    is dropped.
+
+    :param function: The function.
+    :param args: The positional arguments to call it with.
+    :param kwargs: The keyword arguments to call it with.
+    """
+    future = asyncio.get_event_loop().run_in_executor(None, partial(function, *args, **kwargs))
+    while True:
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if future.cancelled():
+                raise
+
+
+async def check_thresholds_periodic(alignment, chains, callback, check_freq, min_cycles, work_dir='.',
+                                    diagnostics=DIAGNOSTICS, tiered=False, tree_check_every=TREE_CHECK_EVERY,
+                                    adaptive=False, check_gens=CHECK_GENS, progress_callback=None, supervisor=None,
+                                    early_abort=False, abort_confidence=ABORT_CONFIDENCE, burn_in=BURN_IN,
+                                    telemetry=None, consensus=CONSENSUS, verbose=True, **thresholds):
+    """
+    Periodically check for convergence using [check_thresholds], waiting before each check. Return the [Convergence]
+    of the check that stopped the chains.
+
+    By default the checks are [check_freq] seconds apart. If [adaptive] is True, the wait is driven by the chains
+    instead: the trace files are watched for growth, and the next check happens once the chains have reached the number
+    of generations chosen by a [CheckScheduler] (or [check_freq] seconds have passed, whichever comes first).
+
+    Nothing in here blocks the event loop, so one loop can supervise the chains of many alignments at once: the checks
+    are coroutines, and a callback that is a plain function (and may well spend a while moving files around) is run in
+    the event loop's default executor.
+
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains b eing run.
+    :param callback: The callback function to call when the threshold check has failed, for whatever reason. This
+    function must take the [Convergence] instance generated by the check as its first and only argument. It may also
+    be a coroutine function.
+    :param check_freq: How often to perform the check (in seconds). If [adaptive] is True, this is the longest time
+    between checks.
+    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+    :param work_dir: The directory that the chains are being run in. Defaults to the current directory.
+    :param diagnostics: How to compute the diagnostics; see [check_thresholds].
+    :param tiered: If True, the maximum difference is only computed once the log likelihood thresholds have been
+    broken; see [check_thresholds].
+    :param tree_check_every: When [tiered] is True, compute the maximum difference anyway on every [tree_check_every]th
+    check, so that it still shows up in the output every so often. If 0, it is never computed early.
+    :param adaptive: If True, schedule the checks adaptively rather than every [check_freq] seconds.
+    :param check_gens: When [adaptive] is True, the smallest number of new generations to wait for between checks.
+    :param progress_callback: A function to call with the [Convergence] instance generated by every check (including
+    the last one), for example to record it. Like [callback], it may be a coroutine function.
+    :param supervisor: The [ChainSupervisor] for the chains, if any. It is given the generations reached by every chain
+    after each check that does not stop the chains, so that it can restart any chain that has fallen behind.
+    :param early_abort: If True, stop the chains as soon as a [ConvergencePredictor] projects, with [abort_confidence],
+    that they will not converge before the maximum number of generations. The chains are then treated as not having
+    converged, and the last [Convergence] is marked as aborted.
+    :param abort_confidence: How sure the projection must be before the chains are stopped early.
+    :param burn_in: How to choose the burn-in; see [check_thresholds].
+    :param telemetry: The [Telemetry] to record every check in, if any.
+    :param consensus: How the consensus tree is to be built; see [check_thresholds].
+    :param verbose: If True, print the summary statistics of every check.
+    :param thresholds: The convergence thresholds to be used by [check_thresholds]. For details check the documentation
+    of the former.
+    """
+    loop = asyncio.get_event_loop()
+    # the readers are kept between checks, so that each check only reads what the chains have written since the last
+    trace_readers = trace_readers_for(alignment, chains, work_dir)
+    trace_diagnostics = TraceDiagnostics(trace_readers)
+    bipartition_index = bipartition_index_for(alignment, chains, work_dir)
+    check = partial(check_thresholds, alignment, chains, min_cycles, work_dir=work_dir, trace_readers=trace_readers,
+                    trace_diagnostics=trace_diagnostics, bipartition_index=bipartition_index,
+                    diagnostics=diagnostics, tiered=tiered, burn_in=burn_in, consensus=consensus, **thresholds)
+
+    async def wait_for_generations(result, checked_at):
+        # the cheap part of a check: find out how far the chains have got
+        await asyncio.gather(*[loop.run_in_executor(None, reader.update) for reader in trace_readers.values()])
+        generations = min(reader.generations() for reader in trace_readers.values())
+        scheduler.observe(generations)
+        target = scheduler.next_target(result, generations)
+
+        while True:
+            now = time.time()
+            if now >= checked_at + check_freq or (generations >= target and now >= checked_at + MIN_CHECK_INTERVAL):
+                return
+            if generations >= target:
+                timeout = checked_at + MIN_CHECK_INTERVAL - now
+            else:
+                timeout = checked_at + check_freq - now
+            await watcher.wait(timeout, scheduler.poll_interval(target, generations))
+
+            await asyncio.gather(*[loop.run_in_executor(None, reader.update) for reader in trace_readers.values()])
+            generations = min(reader.generations() for reader in trace_readers.values())
+            scheduler.observe(generations)
+
+    scheduler = CheckScheduler(check_gens, min_cycles, **thresholds)
+    if adaptive:
+        watcher = TraceWatcher(work_dir)
+
+    predictor = ConvergencePredictor(confidence=abort_confidence, **thresholds)
+
+    checks = 0
+    try:
+        while True:
+            checked_at = time.time()
+            tree_check = tree_check_every > 0 and checks % tree_check_every == 0
+            result = await check(tree_check=tree_check)
+            if result is not None:
+                checks += 1
+                if not result.stop:
+                    predictor.observe(result)
+                    result.projected_generations = predictor.projected_generations()
+                    if early_abort and predictor.hopeless(result.projected_generations):
+                        if verbose:
+                            print('Alignment %s is projected not to converge before %d generations; stopping it '
+                                  'early.' % (alignment, predictor.max_gen))
+                        result.stop = True
+                        result.aborted = True
+                if telemetry is not None:
+                    # until the predictor has enough checks to go on, fall back on the scheduler's rougher projection
+                    telemetry.record_check(alignment, result, scheduler.projected_generations(result))
+                if progress_callback is not None:
+                    await call_callback(progress_callback, result)
+            # None indicates that the minimum number of cycles has not yet been reached
+            if result is None or not result.stop:
+                if result is not None and verbose:
+                    # print some data for the user
+                    print('Alignment %s:' % alignment)
+                    result.print_data()
+                    print('')  # new line
+
+                if supervisor is not None:
+                    await supervisor.supervise([trace_readers[chain].generations() for chain in chains])
+
+                if adaptive:
+                    await wait_for_generations(result, checked_at)
+                else:
+                    await asyncio.sleep(check_freq)
+                continue
+            else:
+                if verbose:
+                    # print some data for the user
+                    print('Alignment %s:' % alignment)
+                    result.print_data()
+                    print('')  # new line
+                await call_callback(callback, result)
+                return result
+    finally:
+        if adaptive:
+            watcher.close()
+
+
+def mpirun_cmd(threads, phyle_name, chain_name, resume=False):
+    """
+    Return the [mpirun] command to execute given an alignment and a chain.
+
+    :param threads: The number of threads to run the chain on.
+    :param phyle_name: The *full* name of the alignment file to process.
+    :param chain_name: The *full* name of the chain.
+    :param resume: If True, return the command that restarts the chain from its checkpoint (its .chain file, along with
+    the other chain files) rather than starting a new one. The chain then carries on appending to its trace file and
+    tree list.
+    """
+    if resume:
+        return shlex.split('mpirun -np %d pb_mpi %s' % (threads, chain_name))
+    # Get it? Phyle name? .phy file name?
+    return shlex.split('mpirun -np %d pb_mpi -cat -gtr -dgam 4 -d %s %s' % (threads, phyle_name, chain_name))
+
+
+def start_chain_process(cmd, work_dir, cpus=None):
+    """
+    Start the [mpirun] process of a chain in its own process group, so that it can be stopped along with every MPI rank
+    that it starts (see [terminate_all_processes]). Return the process.
+
+    :param cmd: The command to run, as returned by [mpirun_cmd].
+    :param work_dir: The directory to run the chain in.
+    :param cpus: The cores to pin the chain to, if any. The pinning is inherited by [mpirun] and by its ranks. The
+    command is run through [taskset] so that it is pinned before it starts; without [taskset], [mpirun] is pinned just
+    after it has started, which may miss a rank that it starts straight away.
+    """
+    taskset = cpus is not None and shutil.which('taskset') is not None
+    if taskset:
+        cmd = ['taskset', '-c', ','.join('%d' % cpu for cpu in sorted(cpus))] + cmd
+    process = subprocess.Popen(cmd, cwd=work_dir, start_new_session=True)
+    if cpus is not None and not taskset:
+        try:
+            os.sched_setaffinity(process.pid, cpus)
+        except ProcessLookupError:
+            pass
+    return process
+
+
+def signal_process_group(process, sig):
+    """
+    Send a signal to every process in the process group of a process started by [start_chain_process]. Return False if
+    the group has no processes left.
+
+    :param process: The process that leads the group.
+    :param sig: The signal to send; 0 only checks whether the group has any processes left.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the only process left is a zombie that has not been reaped yet
+        return process.poll() is None
+    return True
+
+
+def wait_for_process_group(process, timeout):
+    """
+    Wait until every process in the process group of a process has exited, reaping the process itself. Ranks whose
+    [mpirun] has already exited have been handed over to init, which reaps them. Return False if some are still running
+    after [timeout] seconds.
+
+    :param process: The process that leads the group.
+    :param timeout: How long to wait, in seconds.
+    """
+    deadline = time.time() + timeout
+    try:
+        process.wait(max(timeout, 0))
+    except subprocess.TimeoutExpired:
+        return False
+    while signal_process_group(process, 0):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def terminate_all_processes(processes, timeout=TERMINATE_TIMEOUT):
+    """
+    Terminate all the processes in a list, along with every process in their process groups (such as the MPI ranks
+    started by [mpirun]). Each group is first sent a SIGTERM, allowing its processes to exit gracefully; the groups
+    that are still running [timeout] seconds later are sent a SIGKILL. This only returns once the processes have exited
+    and been reaped, so that their cores are free again.
+
+    :param processes: The list of processes to terminate, as started by [start_chain_process].
+    :param timeout: How long to wait after the SIGTERM before sending a SIGKILL, in seconds.
+    """
+    for process in processes:
+        signal_process_group(process, signal.SIGTERM)
+    deadline = time.time() + timeout
+    for process in processes:
+        if not wait_for_process_group(process, deadline - time.time()):
+            signal_process_group(process, signal.SIGKILL)
+            if not wait_for_process_group(process, timeout):
+                warnings.warn('Process group %d is still running after a SIGKILL.' % process.pid, UserWarning)
+
+def file_directory(file):
+    """
+    Get the parent directory of a given file. For example, the parent directory of "path/to/file.txt" is "path/to".
+
+    :param file: The path to the file.
+    """
+    return os.path.dirname(os.path.realpath(file))
+
+
+def alignment_name(path):
+    """
+    Return the name of an alignment: the path to its file as it was given, without its first component, with the
+    directories separated by '--'. The name only depends on the path, so an alignment keeps its name from one run to the
+    next whatever else is run with it. A bare file name (or one in the current directory) names the alignment after the
+    file. The name is used for the directory that its chains run in, for the names of its chains and output files, and
+    as its key in the [RunStore].
+
+    :param path: The path to the alignment file, as given on the command line or found in a directory given there.
+    """
+    parts = [part for part in path.split(os.path.sep)[1:] if part]
+    return '--'.join(parts) or os.path.basename(path)
+
+
+def alignment_names(alignment_files):
+    """
+    Return a dictionary from the paths to alignment files to their names (see [alignment_name]), in the same order.
+
+    :param alignment_files: The paths to the alignment files.
+
+    :raises ValueError: If two different files would get the same name.
+    """
+    names = collections.OrderedDict()
+    files = {}
+    for path in alignment_files:
+        name = alignment_name(path)
+        if name in files and os.path.abspath(files[name]) != os.path.abspath(path):
+            raise ValueError('The alignments %s and %s would both be named %s.' % (files[name], path, name))
+        files[name] = path
+        names[path] = name
+    return names
+
+
+def alignment_dimensions(path):
+    """
+    Read the number of taxa, the number of sites and the datatype of an alignment from the header of its file, without
+    reading the whole file. NEXUS files declare all three (the datatype defaults to DNA); for PHYLIP files the datatype
+    is guessed from the first few sequences. Return a (taxa, sites, datatype) tuple, or None if the header cannot be
+    parsed.
+
+    :param path: The path to the alignment file, in PHYLIP (including relaxed PHYLIP) or NEXUS format.
+    """
+    with open(path) as file:
+        first_line = file.readline()
+        while first_line and not first_line.strip():
+            first_line = file.readline()
+
+        if first_line.strip().upper().startswith('#NEXUS'):
+            # the dimensions and the datatype are declared before the matrix
+            header = []
+            for line in file:
+                if line.strip().lower().startswith('matrix'):
+                    break
+                header.append(line)
+            header = ' '.join(header)
+            taxa = re.search(r'ntax\s*=\s*(\d+)', header, re.IGNORECASE)
+            sites = re.search(r'nchar\s*=\s*(\d+)', header, re.IGNORECASE)
+            datatype = re.search(r'datatype\s*=\s*(\w+)', header, re.IGNORECASE)
+            if taxa is None or sites is None:
+                return None
+            return int(taxa.group(1)), int(sites.group(1)), datatype.group(1).lower() if datatype else 'dna'
+
+        dimensions = first_line.split()
+        if len(dimensions) < 2 or not (dimensions[0].isdigit() and dimensions[1].isdigit()):
+            return None
+        symbols = set()
+        for i, line in zip(range(DATATYPE_SAMPLE_LINES), file):
+            # the first word of a line is the name of the taxon
+            symbols.update(''.join(line.split()[1:]).upper())
+        datatype = 'dna' if symbols <= NUCLEOTIDE_SYMBOLS else 'protein'
+        return int(dimensions[0]), int(dimensions[1]), datatype
+
+
+def alignment_cost(path):
+    """
+    Estimate how expensive an alignment is to run, in arbitrary units: the number of taxa times the number of sites,
+    times the square of the number of character states. Return None if the size of the alignment is unknown.
+
+    :param path: The path to the alignment file.
+    """
+    dimensions = alignment_dimensions(path)
+    if dimensions is None:
+        return None
+    taxa, sites, datatype = dimensions
+    # datatypes that we do not know about (e.g. 'standard') are costed as nucleotides
+    return taxa * sites * DATATYPE_STATES.get(datatype, 4) ** 2
+
+
+def plan_alignments(alignment_files, max_threads_per_chain, threads_per_chain=None, cost_per_thread=COST_PER_THREAD):
+    """
+    Order a list of alignments longest job first, and decide how many threads to run each of their chains on, so that
+    the most expensive alignments are started first and the cheap ones fill in the gaps at the end of a batch. Unless
+    the number of threads per chain is fixed, each alignment gets a thread for every [cost_per_thread] of its cost
+    (at least one, and at most [max_threads_per_chain]). The threads only depend on the alignment itself, not on the
+    rest of the batch, so a batch of cheap alignments is run many alignments at a time, and an expensive alignment
+    gets as much of the machine as it can make use of. Return a list of (alignment file, threads per chain) pairs, in
+    the order the alignments are to be started in.
+
+    :param alignment_files: The paths to the alignment files.
+    :param max_threads_per_chain: The largest number of threads to run the chains of any alignment on.
+    :param threads_per_chain: If given, run the chains of every alignment on this many threads.
+    :param cost_per_thread: The cost (see [alignment_cost]) of an alignment that is worth a thread per chain.
+    """
+    costs = collections.OrderedDict((alignment_file, alignment_cost(alignment_file))
+                                    for alignment_file in alignment_files)
+    known_costs = [cost for cost in costs.values() if cost is not None]
+    for alignment_file, cost in costs.items():
+        if cost is None:
+            warnings.warn('Could not read the size of alignment %s; it is assumed to be of average cost.'
+                          % alignment_file, UserWarning)
+            # with nothing to go by, the alignment is given every thread it may have, as it would be without a plan
+            costs[alignment_file] = np.mean(known_costs) if known_costs else max_threads_per_chain * cost_per_thread
+
+    # [sorted] is stable, so alignments of the same cost stay in the order they were given in
+    plan = []
+    for alignment_file in sorted(costs, key=lambda alignment_file: -costs[alignment_file]):
+        if threads_per_chain is None:
+            threads = min(max_threads_per_chain, max(1, int(math.ceil(costs[alignment_file] / cost_per_thread))))
+        else:
+            threads = threads_per_chain
+        plan.append((alignment_file, threads))
+    return plan
+
+
+def archive_file(path, directory, compression='none'):
+    """
+    Move a file into a directory, compressing it on the way if a compression format is given. The file is streamed
+    block by block, so even very large chain files are never held in memory, and the archive only appears under its
+    final name once it is complete. Files are copied if the directory is on a different filesystem. Return the path to
+    the archived file.
+
+    :param path: The path to the file to archive.
+    :param directory: The directory to archive the file in.
+    :param compression: The compression format to use, one of the keys of [COMPRESSION_FORMATS]; 'none' to move the
+    file as it is.
+    """
+    new_path = os.path.join(directory, os.path.basename(path)) + COMPRESSION_FORMATS[compression]
+    if compression == 'none':
+        # [shutil.move] renames the file if it can, and copies it otherwise
+        shutil.move(path, new_path)
+        return new_path
+
+    partial_path = new_path + '.part'
+    with open(path, 'rb') as source:
+        if compression == 'zstd':
+            with open(partial_path, 'wb') as destination:
+                zstandard.ZstdCompressor().copy_stream(source, destination, read_size=ARCHIVE_BLOCK_SIZE)
+        else:
+            open_archive = gzip.open if compression == 'gzip' else lzma.open
+            with open_archive(partial_path, 'wb') as destination:
+                shutil.copyfileobj(source, destination, ARCHIVE_BLOCK_SIZE)
+    os.replace(partial_path, new_path)
+    os.remove(path)
+    return new_path
+
+
+def build_consensus_tree(alignment, chains, discard=None, work_dir='.', consensus=CONSENSUS, executor=None):
+    """
+    Build the consensus tree of the chains of an alignment from their tree lists, as the tree file that
+    [move_output_files] saves, unless [bpcomp] has already left one there and [consensus] asks for its tree. The trees
+    sampled after the burn-in are written to the tree sample that it saves along with it (see [write_tree_sample]) in
+    the same pass over the tree lists. If the tree lists were thinned as the chains ran (see [TreelistSampler]), only
+    the thinned tree lists are read, and the burn-in is applied to them. Return True if there is a tree file
+    afterwards.
+
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains.
+    :param discard: The number of trees to discard from the start of every chain as burn-in, usually the burn-in of the
+    last check. Defaults to [discard_samples] of the shortest chain.
+    :param work_dir: The directory that the chains were run in. Defaults to the current directory.
+    :param consensus: How the consensus tree is to be built; one of [CONSENSUS_MODES].
+    :param executor: The [concurrent.futures.Executor] (usually a process pool) to build the tree in, if any; this
+    function waits for it either way.
+    """
+    tree_path = os.path.join(work_dir, TREE_FILE_NAME)
+    sample_path = os.path.join(work_dir, TREE_SAMPLE_FILE_NAME)
+    treelist_paths = [os.path.join(work_dir, '%s.treelist' % chain_full_name(alignment, chain)) for chain in chains]
+    every = None
+    thinned_paths = [path + TREELIST_SAMPLE_SUFFIX for path in treelist_paths]
+    if all(os.path.exists(path) for path in thinned_paths):
+        # every [TREE_SAMPLE_FREQ]th tree has been kept already, so the burn-in is all that is left to apply
+        if discard is None:
+            discard = discard_samples(min(treelist_len(path) for path in thinned_paths) * TREE_SAMPLE_FREQ)
+        treelist_paths, discard, every = thinned_paths, int(math.ceil(discard / TREE_SAMPLE_FREQ)), 1
+    if consensus == 'bpcomp' and os.path.exists(tree_path):
+        job = partial(write_tree_sample, treelist_paths, sample_path, discard, every)
+    else:
+        job = partial(write_consensus_tree, treelist_paths, tree_path, discard, every, sample_path=sample_path)
+    if executor is None:
+        job()
+    else:
+        executor.submit(job).result()
+    return os.path.exists(tree_path)
+
+
+def move_output_files(output_dir, tree_dir, alignment, save_chain_files, work_dir='.', compression='none',
+                      sync_dir=None, keep_treelists=True):
+    """
+    After the chains have finished running, move the chain output files and the generated tree file to their places in
+    the output directory.
+
+    :param output_dir: The path to the output directory.
+    :param tree_dir: The directory to move the tree file to.
+    :param alignment: The name of the alignment.
+    :param save_chain_files: True if the output chain files from this run are to be kept, False if they are to be
+    deleted.
+    :param work_dir: The directory that the chains were run in. Only this directory is scanned for chain files, so
+    alignments running in other directories are left alone. If it is not the current directory, it is removed once all
+    of the files have been moved out of it. Defaults to the current directory.
+    :param compression: The format to archive the chain files in, one of the keys of [COMPRESSION_FORMATS]. Defaults to
+    'none', in which case the chain files are moved as they are.
+    :param sync_dir: The directory that a [CheckpointSync] has been syncing the chain files to, if the chains were run
+    in a scratch directory. It is removed once all of the files have been moved out of the scratch directory.
+    :param keep_treelists: False if the tree lists are to be deleted rather than kept; the tree sample, which is
+    always kept, is then all that is left of them.
+
+    Preconditions:
+        - the [run] command must have been executed prior to calling this function.
+    """
+    # Create output directory, and subdirectories: analyses, good_trees, bad_trees
+    analyses_dir = os.path.join(output_dir, 'analyses', alignment)
+
+    if not os.path.exists(analyses_dir):
+        os.makedirs(analyses_dir)
+
+    if not os.path.exists(tree_dir):
+        os.makedirs(tree_dir)
+
+    # Move chain files into output/analyses/[alignment]: .chain (maybe), .monitor, .param, .run, .trace, .treelist
+    # note that .chain files should only be kept if the save_run flag is True
+    keep_file_types = ALL_CHAIN_FILE_TYPES if save_chain_files else KEEP_CHAIN_FILE_TYPES
+    if not keep_treelists:
+        keep_file_types = [file_type for file_type in keep_file_types if file_type != '.treelist']
+    candidate_files = os.listdir(work_dir)
+    for file_type in keep_file_types:
+        for file in candidate_files:
+            if file.endswith(file_type):
+                archive_file(os.path.join(work_dir, file), analyses_dir, compression)
+
+    # delete all remaining run files, and the thinned tree lists, which a resumed run thins again from the start
+    for file_type in ALL_CHAIN_FILE_TYPES + [TREELIST_SAMPLE_SUFFIX]:
+        for file in os.listdir(work_dir):
+            if file.endswith(file_type):
+                os.remove(os.path.join(work_dir, file))
+
+    # Move and rename output tree file if it has been created
+    try:
+        shutil.move(os.path.join(work_dir, TREE_FILE_NAME), os.path.join(tree_dir, new_tree_file_name(alignment)))
+    except FileNotFoundError:
+        warnings.warn("The chains have not been running long enough for a tree file to have been generated",
+                      UserWarning)
+    if os.path.exists(os.path.join(work_dir, TREE_SAMPLE_FILE_NAME)):
+        shutil.move(os.path.join(work_dir, TREE_SAMPLE_FILE_NAME),
+                    os.path.join(tree_dir, new_tree_sample_file_name(alignment)))
+
+    # the summary files left behind by [tracecomp] and [bpcomp] are of no further use
+    if os.path.realpath(work_dir) != os.path.realpath('.'):
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if sync_dir is not None:
+        shutil.rmtree(sync_dir, ignore_errors=True)
+
+
+def restore_output_files(output_dir, alignment, chains, work_dir, sync_dir=None):
+    """
+    Bring the chain files of an interrupted run back into the directory that the chains are run in, so that the chains
+    can be restarted from their checkpoints. If the run was interrupted cleanly, [move_output_files] will have moved the
+    chain files to output/analyses/[alignment] and the tree to output/incomplete_trees; these are moved back. If it was
+    not (for example, because the node was rebooted), the chain files will still be in the working directory. If the
+    chains were run in a scratch directory that has been lost along with its node, the copies of the chain files in
+    [sync_dir] are copied back instead. Return True if every chain has a checkpoint to restart from, and False if not,
+    in which case the chains have to start over.
+
+    :param output_dir: The path to the output directory.
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains being run.
+    :param work_dir: The directory that the chains are run in.
+    :param sync_dir: The directory that a [CheckpointSync] synced the chain files to, if the chains are run in a
+    scratch directory.
+    """
+    analyses_dir = os.path.join(output_dir, 'analyses', alignment)
+    chain_full_names = [chain_full_name(alignment, chain) for chain in chains]
+
+    def has_checkpoints(directory):
+        return every(chain_full_names, lambda name: os.path.exists(os.path.join(directory, '%s.chain' % name)))
+
+    if has_checkpoints(work_dir):
+        return True
+    if sync_dir is not None and has_checkpoints(sync_dir):
+        # the synced copies are kept until the run is over, in case this node is lost as well
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        for file in os.listdir(sync_dir):
+            if any(file == name + file_type for name in chain_full_names for file_type in ALL_CHAIN_FILE_TYPES):
+                shutil.copy2(os.path.join(sync_dir, file), os.path.join(work_dir, file))
+        return True
+    if not has_checkpoints(analyses_dir):
+        return False
+
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    for file in os.listdir(analyses_dir):
+        if any(file == name + file_type for name in chain_full_names for file_type in ALL_CHAIN_FILE_TYPES):
+            shutil.move(os.path.join(analyses_dir, file), os.path.join(work_dir, file))
+
+    incomplete_tree = os.path.join(output_dir, 'incomplete_trees', new_tree_file_name(alignment))
+    if os.path.exists(incomplete_tree):
+        shutil.move(incomplete_tree, os.path.join(work_dir, TREE_FILE_NAME))
+    return True
+
+
+class CheckpointSync(object):
+    """
+    Copies the chain files of an alignment whose chains run in a node-local scratch directory to a directory on the
+    shared filesystem, so that the chains can be resumed from there (see [restore_output_files]) if the node is lost.
+
+    The trace files and tree lists only ever grow, so every sync only copies what has been appended to them since the
+    last one. The other chain files, including the .chain checkpoints, are small, and are copied whole, each replacing
+    its previous copy only once it is complete. The growing files are copied first, so that the copies of the trace
+    files and tree lists never fall behind the copies of the checkpoints.
+    """
+    APPENDED_FILE_TYPES = ['.trace', '.treelist']
+
+    def __init__(self, work_dir, sync_dir, chain_full_names):
+        """
+        :param work_dir: The scratch directory that the chains are run in.
+        :param sync_dir: The directory to copy the chain files to.
+        :param chain_full_names: The *full* names of the chains.
+        """
+        self.work_dir = work_dir
+        self.sync_dir = sync_dir
+        self.chain_full_names = chain_full_names
+        self._offsets = {}
+        # copies left by an earlier run that the chains were resumed from are where the chain files started from
+        for name in chain_full_names:
+            for file_type in self.APPENDED_FILE_TYPES:
+                copy = os.path.join(sync_dir, name + file_type)
+                if os.path.exists(copy):
+                    self._offsets[name + file_type] = os.path.getsize(copy)
+
+    def sync(self):
+        """
+        Copy the chain files that have changed since the last sync.
+        """
+        if not os.path.exists(self.sync_dir):
+            os.makedirs(self.sync_dir)
+        for file_type in self.APPENDED_FILE_TYPES:
+            for name in self.chain_full_names:
+                self._append(name + file_type)
+        for file_type in ALL_CHAIN_FILE_TYPES:
+            if file_type in self.APPENDED_FILE_TYPES:
+                continue
+            for name in self.chain_full_names:
+                source = os.path.join(self.work_dir, name + file_type)
+                if os.path.exists(source):
+                    copy = os.path.join(self.sync_dir, name + file_type)
+                    shutil.copyfile(source, copy + '.part')
+                    os.replace(copy + '.part', copy)
+
+    def _append(self, file):
+        source = os.path.join(self.work_dir, file)
+        copy = os.path.join(self.sync_dir, file)
+        if not os.path.exists(source):
+            return
+        offset = self._offsets.get(file, 0)
+        if os.path.getsize(source) < offset or (offset and not os.path.exists(copy)):
+            # the chain has started over, or the copy has gone missing, so copy the file from the start
+            offset = 0
+        with open(source, 'rb') as f, open(copy, 'ab' if offset else 'wb') as destination:
+            f.seek(offset)
+            while True:
+                block = f.read(ARCHIVE_BLOCK_SIZE)
+                if not block:
+                    break
+                destination.write(block)
+                offset += len(block)
+        self._offsets[file] = offset
+
+    async def run(self, period=SYNC_FREQ):
+        """
+        Sync the chain files every [period] seconds until cancelled. The copying is done in the event loop's default
+        executor. A sync that fails is reported as a warning, and tried again at the next one.
+
+        :param period: The time between syncs, in seconds.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(period)
+            try:
+                await loop.run_in_executor(None, self.sync)
+            except OSError as e:
+                warnings.warn('Could not sync the chain files to %s: %s' % (self.sync_dir, e), UserWarning)
+
+
+class Archiver(object):
+    """
+    Archives the output files of finished alignments on a pool of background threads, so that moving (and possibly
+    compressing) multi-gigabyte chain files does not hold up the alignments that are waiting for the cores that the
+    finished ones have freed up. Before the files are moved, the consensus tree of each alignment is built with
+    [build_consensus_tree] in a pool of worker processes, so that the trees of many alignments that finish together are
+    built in parallel.
+    """
+    def __init__(self, workers=ARCHIVE_WORKERS, compression=COMPRESSION, consensus=CONSENSUS,
+                 consensus_workers=CONSENSUS_WORKERS, treelists=TREELISTS):
+        """
+        :param workers: How many alignments to archive at the same time.
+        :param compression: The format to compress the chain files in, one of the keys of [COMPRESSION_FORMATS].
+        :param consensus: How the consensus trees are to be built; one of [CONSENSUS_MODES].
+        :param consensus_workers: How many consensus trees to build at the same time.
+        :param treelists: Whether the tree lists of alignments whose chain files are not saved are archived in full, or
+        only their tree samples are kept; one of [TREELIST_MODES].
+        """
+        self.compression = compression
+        self.consensus = consensus
+        self.treelists = treelists
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._consensus_executor = concurrent.futures.ProcessPoolExecutor(max_workers=consensus_workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """
+        The number of alignments that have not been archived yet.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, output_dir, tree_dir, alignment, save_chain_files, work_dir, chains, discard=None, sync_dir=None):
+        """
+        Queue the consensus tree of an alignment to be built by [build_consensus_tree], and its output files to be moved
+        to the output directory by [move_output_files], and return straight away. Errors are reported as warnings once
+        the archiving job has failed.
+
+        For details on the parameters, check the documentation of [move_output_files] and [build_consensus_tree].
+        """
+        future = self._executor.submit(self._archive, output_dir, tree_dir, alignment, save_chain_files, work_dir,
+                                       chains, discard, sync_dir)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(partial(self._done, alignment))
+        return future
+
+    def _archive(self, output_dir, tree_dir, alignment, save_chain_files, work_dir, chains, discard, sync_dir):
+        build_consensus_tree(alignment, chains, discard, work_dir, self.consensus, self._consensus_executor)
+        move_output_files(output_dir, tree_dir, alignment, save_chain_files, work_dir=work_dir,
+                          compression=self.compression, sync_dir=sync_dir,
+                          keep_treelists=save_chain_files or self.treelists == 'full')
+
+    def _done(self, alignment, future):
+        with self._lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            warnings.warn('Could not archive the output files of alignment %s: %s' % (alignment, future.exception()),
+                          UserWarning)
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting new archiving jobs, and by default wait for the queued ones to finish.
+
+        :param wait: Whether to block until all of the queued jobs are done.
+        """
+        if wait and self.pending:
+            click.echo('Waiting for the output files of %d alignment(s) to be archived...' % self.pending)
+        self._executor.shutdown(wait=wait)
+        self._consensus_executor.shutdown(wait=wait)
+
+
+def check_fail_callback(convergence, alignment, chains, processes, output_dir, save_good_tree_chains, work_dir='.',
+                        store=None, archiver=None, consensus=CONSENSUS, sync_dir=None, treelists=TREELISTS,
+                        log_dir=None, samplers=()):
+    """
+    This is the function that is called when the threshold check fails. All but the first arguments are intended to be
+    bound to the function using [functools.partial] to create a callback that fits the specification outlined in
+    [check_thresholds_periodic].
+
+    :param convergence: The [Convergence] instance generated by the check.
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains being run.
+    :param processes: A list of the [mpirun] processes running the chains.
+    :param output_dir: The output directory (where the output files are being moved to).
+    :param save_good_tree_chains: True if output chain files from good trees are to be kept, False if they are to be
+    deleted.
+    :param work_dir: The directory that the chains were run in. Defaults to the current directory.
+    :param store: The [RunStore] to record the final summary statistics in, if any.
+    :param archiver: The [Archiver] to hand the output files over to, if any; otherwise the consensus tree is built
+    and the files are moved before this function returns.
+    :param consensus: How the consensus tree is to be built if there is no [archiver]; one of [CONSENSUS_MODES].
+    :param sync_dir: The directory that the chain files have been synced to, if the chains were run in a scratch
+    directory; see [move_output_files].
+    :param treelists: What to keep of the tree lists if there is no [archiver]; one of [TREELIST_MODES].
+    :param log_dir: The directory of the logfile to add the row of the alignment to, if it is not the output directory.
+    :param samplers: The [TreelistSampler] of every chain, if the tree lists are being thinned as the chains run.
+    """
+    # Stop all chain runs
+    terminate_all_processes(processes)
+    # and thin the trees that they wrote since the last check
+    for sampler in samplers:
+        sampler.update()
+
+    if store is not None:
+        store.finish(alignment, convergence)
+
+    # Write output data to the log
+    generations_list = [0 for i in convergence.generations.items()]
+    for chain, generations in convergence.generations.items():
+        i = chains.index(chain)
+        generations_list[i] = generations
+
+    log_data = [alignment] + convergence.as_list() + generations_list
+    log_data += [convergence.aborted, convergence.projected_generations]
+    add_row_to_logfile(log_dir or output_dir, *log_data)
+
+    # Now we need to move the output files to the correct directories
+
+    # If the chains converged, move the output tree file to good_trees, otherwise move it to bad_trees
+    # Also, rename it to [alignment].tre
+    save_chain_files = True
+    if convergence.converged:
+        # do we save the runs?
+        if not save_good_tree_chains:
+            save_chain_files = False
+        tree_dir = os.path.join(output_dir, 'good_trees')
+    else:
+        save_chain_files = True
+        tree_dir = os.path.join(output_dir, 'bad_trees')
+
+    if archiver is not None:
+        # the chains have been stopped, so their cores can be handed on while the files are archived
+        archiver.submit(
+            output_dir=output_dir,
+            tree_dir=tree_dir,
+            alignment=alignment,
+            save_chain_files=save_chain_files,
+            work_dir=work_dir,
+            chains=chains,
+            discard=convergence.discard,
+            sync_dir=sync_dir)
+    else:
+        build_consensus_tree(alignment, chains, convergence.discard, work_dir, consensus)
+        move_output_files(
+            output_dir=output_dir,
+            tree_dir=tree_dir,
+            alignment=alignment,
+            save_chain_files=save_chain_files,
+            work_dir=work_dir,
+            sync_dir=sync_dir,
+            keep_treelists=save_chain_files or treelists == 'full')
+
+
+class CoreBudget(object):
+    """
+    The pool of cores shared by every alignment being processed. Alignments ask for the cores that their chains need
+    before starting them, and hand them back once the chains have been stopped. Requests are served in the order they
+    were made, so an alignment that needs many cores is not starved by a stream of smaller ones.
+    """
+    def __init__(self, cores, placement=None, admission=None):
+        """
+        :param cores: The total number of cores that may be in use at any one time.
+        :param placement: The [CorePlacement] to pin the chains with, if any. It must have at least [cores] cores.
+        :param admission: The [AdmissionControl] that must also admit every request before its cores are handed out, if
+        any. A request that it holds back is looked at again every [ADMISSION_POLL] seconds, and holds back the
+        requests behind it.
+        """
+        self.cores = cores
+        self.free = cores
+        self.placement = placement
+        self.admission = admission
+        self._waiting = collections.deque()
+        self._retry = None
+
+    def _admits(self, cores, memory):
+        return self.admission is None or self.admission.admits(memory, cores, self.cores - self.free)
+
+    def _take(self, cores, memory):
+        self.free -= cores
+        if self.admission is not None:
+            self.admission.reserve(memory)
+
+    async def acquire(self, cores, memory=0):
+        """
+        Wait until the given number of cores is free (and the [admission] control, if any, admits the request), and
+        take them.
+
+        :param cores: The number of cores to take. This must not be greater than the total size of the budget.
+        :param memory: The memory that the request is estimated to need, in bytes, for the [admission] control.
+        """
+        if not self._waiting and cores <= self.free and self._admits(cores, memory):
+            self._take(cores, memory)
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiting.append((cores, memory, waiter))
+        if self._waiting[0][2] is waiter and cores <= self.free:
+            # the cores are free, so it was the [admission] control that held the request back
+            self._schedule_retry()
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # the cores were handed out just as we were cancelled, so give them straight back
+                self.release(cores, memory)
+            else:
+                self._waiting.remove((cores, memory, waiter))
+                self._wake()
+            raise
+        finally:
+            if self._retry is not None and not self._waiting:
+                self._retry.cancel()
+                self._retry = None
+
+    @property
+    def waiting(self):
+        """
+        The number of requests waiting for cores.
+        """
+        return len(self._waiting)
+
+    def try_acquire(self, cores, memory=0):
+        """
+        Take the given number of cores if they are free, nobody is waiting for cores and the [admission] control, if
+        any, admits the request, without waiting. Return True if the cores were taken, and False if not.
+
+        :param cores: The number of cores to take.
+        :param memory: The memory that the request is estimated to need, in bytes, for the [admission] control.
+        """
+        if self._waiting or cores > self.free or not self._admits(cores, memory):
+            return False
+        self._take(cores, memory)
+        return True
+
+    def release(self, cores, memory=0):
+        """
+        Return cores to the budget, and hand them out to whoever is waiting for them.
+
+        :param cores: The number of cores to return.
+        :param memory: The memory that was estimated for them, which the [admission] control no longer holds back.
+        """
+        self.free += cores
+        if self.admission is not None:
+            self.admission.unreserve(memory)
+        self._wake()
+
+    def _schedule_retry(self):
+        # the memory (or the load) may free up without any cores being released, so look at the first request again
+        # in a while; there is only ever one retry pending
+        if self._retry is not None:
+            self._retry.cancel()
+        self._retry = asyncio.get_event_loop().call_later(ADMISSION_POLL, self._wake)
+
+    def _wake(self):
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        while self._waiting and self._waiting[0][0] <= self.free:
+            cores, memory, waiter = self._waiting[0]
+            if not self._admits(cores, memory):
+                self._schedule_retry()
+                return
+            self._waiting.popleft()
+            self._take(cores, memory)
+            waiter.set_result(None)
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a list of cores in the format of the Linux kernel (for example, 0-3,8-11) into a list of core numbers.
+
+    :param cpu_list: The list of cores.
+    """
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes(cpus):
+    """
+    Return the cores of each NUMA node of the machine, as a list of lists, keeping only the given cores. If the NUMA
+    nodes are not known, all the cores form a single node.
+
+    :param cpus: The cores that may be used.
+    """
+    nodes = []
+    if os.path.isdir(NUMA_NODES_DIRECTORY):
+        for entry in sorted(os.listdir(NUMA_NODES_DIRECTORY)):
+            if not re.match(r'node\d+$', entry):
+                continue
+            with open(os.path.join(NUMA_NODES_DIRECTORY, entry, 'cpulist')) as f:
+                node = [cpu for cpu in parse_cpu_list(f.read()) if cpu in cpus]
+            if node:
+                nodes.append(node)
+    placed = set(cpu for node in nodes for cpu in node)
+    if not nodes or placed != set(cpus):
+        # any cores that are missing from the NUMA nodes go together
+        nodes.append(sorted(set(cpus) - placed))
+    return [node for node in nodes if node]
+
+
+class CorePlacement(object):
+    """
+    Hands out disjoint sets of cores for chains to be pinned to. The cores of a chain are taken from a single NUMA node
+    whenever one has enough free cores, choosing the node with the fewest free cores that is big enough, so that the
+    larger free blocks are kept for larger chains; otherwise they are spread over the nodes with the most free cores.
+
+    The placement does not wait for cores to be freed: the [CoreBudget] that it belongs to does that, so there must be
+    at least as many cores to place as there are in the budget.
+    """
+    def __init__(self, cpus=None):
+        """
+        :param cpus: The cores to hand out. Default: every core that this process may run on.
+        """
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0))
+        self.nodes = numa_nodes(cpus)
+        self.free = [list(node) for node in self.nodes]
+
+    @property
+    def cores(self):
+        """
+        The total number of cores to hand out.
+        """
+        return sum(len(node) for node in self.nodes)
+
+    def allocate(self, cores):
+        """
+        Take a set of free cores, and return them as a list.
+
+        :param cores: The number of cores to take.
+        """
+        fitting = [node for node in self.free if len(node) >= cores]
+        if fitting:
+            node = min(fitting, key=len)
+            cpus, node[:] = node[:cores], node[cores:]
+            return cpus
+        cpus = []
+        for node in sorted(self.free, key=len, reverse=True):
+            taken, node[:] = node[:cores - len(cpus)], node[cores - len(cpus):]
+            cpus.extend(taken)
+        if len(cpus) < cores:
+            self.release(cpus)
+            raise ValueError('Cannot place %d cores, only %d are free.' % (cores, len(cpus)))
+        return cpus
+
+    def release(self, cpus):
+        """
+        Return a set of cores taken with [allocate].
+
+        :param cpus: The cores to return.
+        """
+        for node, free in zip(self.nodes, self.free):
+            free.extend(cpu for cpu in cpus if cpu in node)
+            free.sort()
+
+
+def available_memory():
+    """
+    Return the memory, in bytes, that can still be used without swapping: the available memory of the machine, as
+    estimated by the kernel, or what is left under the memory limit of the cgroup of this process, whichever is less.
+    Return [None] if neither is known.
+    """
+    available = []
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        available.append(max(limit[0] - limit[1], 0))
+    return min(available) if available else None
+
+
+def cgroup_memory_limit():
+    """
+    Return the memory limit of the cgroup of this process and the memory that the cgroup is using, in bytes, as a
+    tuple, or [None] if there is no limit. Both cgroup v2 and the memory controller of cgroup v1 are supported.
+    """
+    try:
+        with open('/proc/self/cgroup') as f:
+            lines = [line.strip().split(':', 2) for line in f if line.strip()]
+    except OSError:
+        return None
+    for hierarchy, controllers, path in lines:
+        if hierarchy == '0' and not controllers:
+            files = os.path.join('/sys/fs/cgroup', path.lstrip('/'), 'memory.max'), \
+                os.path.join('/sys/fs/cgroup', path.lstrip('/'), 'memory.current')
+        elif 'memory' in controllers.split(','):
+            files = os.path.join('/sys/fs/cgroup/memory', path.lstrip('/'), 'memory.limit_in_bytes'), \
+                os.path.join('/sys/fs/cgroup/memory', path.lstrip('/'), 'memory.usage_in_bytes')
+        else:
+            continue
+        try:
+            with open(files[0]) as f:
+                limit = f.read().strip()
+            with open(files[1]) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        # an unlimited cgroup v1 reports a limit close to the largest 64-bit number
+        if limit.isdigit() and int(limit) < 2 ** 62:
+            return int(limit), usage
+    return None
+
+
+def process_group_rss(pgids):
+    """
+    Return the resident memory of every process in a set of process groups, in bytes, summed over each group, as a
+    dictionary from the process group ids. Memory shared between the processes of a group is counted once for every
+    process, so this errs on the high side.
+
+    :param pgids: The ids of the process groups.
+    """
+    pgids = set(pgids)
+    rss = dict.fromkeys(pgids, 0)
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read()
+        except OSError:
+            # the process has just exited
+            continue
+        # the name of the command may contain spaces, but not a closing bracket followed by a space
+        fields = stat[stat.rfind(')') + 2:].split()
+        pgid = int(fields[2])
+        if pgid in pgids:
+            rss[pgid] += int(fields[21]) * page_size
+    return rss
+
+
+class AdmissionControl(object):
+    """
+    Holds back new chains while the machine does not have the memory (or, optionally, the spare load) for them, so that
+    alignments that share a node do not push it into swapping, or get their chains killed for running out of memory.
+
+    The memory of an alignment is estimated from its dimensions, and the estimate is corrected by how far off the
+    estimates of the alignments measured so far were: the footprint of a running alignment is measured as the resident
+    memory of the process groups of its chains (see [process_group_rss]). An alignment is admitted if its estimate fits
+    into the available memory (see [available_memory]), less a headroom, and less the memory that the alignments that
+    are already running are still expected to grow into.
+    """
+    def __init__(self, memory=MEMORY_ADMISSION, headroom=MEMORY_HEADROOM, max_load=MAX_LOAD, history=None):
+        """
+        :param memory: Whether to hold back alignments for memory.
+        :param headroom: The fraction of the memory of the machine (or of the limit of its cgroup) to keep free.
+        :param max_load: Hold back alignments while the load average, counting the new chains, would go over this many
+        times the number of cores. 0 never holds them back for the load.
+        :param history: The ratios of the measured to the estimated memory of earlier alignments, as returned by
+        [RunStore.memory_ratios], to correct the estimates with.
+        """
+        self.memory = memory
+        self.headroom = headroom
+        self.max_load = max_load
+        self.ratios = list(history or [])[-MEMORY_HISTORY:]
+        # the memory handed out to the running alignments, and the chain processes of each of them
+        self.reserved = 0
+        self.running = []
+
+    @property
+    def correction(self):
+        """
+        The factor that the estimates are multiplied by: the median ratio of the measured to the estimated memory of
+        the alignments measured so far, or 1 if there are none.
+        """
+        return float(np.median(self.ratios)) if self.ratios else 1.0
+
+    @staticmethod
+    def raw_estimate(alignment_file, chains, threads_per_chain):
+        """
+        Return the memory that the chains of an alignment need according to the uncorrected memory model, in bytes.
+
+        :param alignment_file: The path to the alignment file.
+        :param chains: The number of chains.
+        :param threads_per_chain: The number of MPI ranks of each chain.
+        """
+        dimensions = alignment_dimensions(alignment_file)
+        per_chain = AdmissionControl.raw_rank_estimate(threads_per_chain)
+        if dimensions is not None:
+            taxa, sites, datatype = dimensions
+            per_chain += MEMORY_PER_CELL * taxa * sites * DATATYPE_STATES.get(datatype, 4)
+        return chains * per_chain
+
+    @staticmethod
+    def raw_rank_estimate(ranks):
+        """
+        Return the memory that MPI ranks need on top of the data of a chain according to the uncorrected memory model,
+        in bytes. This is all that a chain that is restarted on extra ranks needs on top of what it had, since its
+        conditional likelihoods are split between its ranks.
+
+        :param ranks: The number of ranks.
+        """
+        return MEMORY_PER_RANK * ranks
+
+    def estimate(self, alignment_file, chains, threads_per_chain):
+        """
+        Return the corrected estimate of the memory that the chains of an alignment need, in bytes.
+
+        For details on the parameters, check the documentation of [raw_estimate].
+        """
+        return self.raw_estimate(alignment_file, chains, threads_per_chain) * self.correction
+
+    def measure(self, processes=None):
+        """
+        Return the resident memory of the process groups of some chains, in bytes.
+
+        :param processes: The chain processes, as started by [start_chain_process]. Default: those of every running
+        alignment.
+        """
+        if processes is None:
+            processes = [process for group in self.running for process in group]
+        return sum(process_group_rss(process.pid for process in processes).values())
+
+    def admits(self, memory, cores, cores_in_use):
+        """
+        Return True if a request for cores and memory may be let through now. A request is always let through if
+        nothing else is running, so that an alignment that is estimated to need more memory than there is cannot hold
+        up the batch for good; it is then only warned about.
+
+        :param memory: The estimated memory of the request, in bytes.
+        :param cores: The number of cores of the request.
+        :param cores_in_use: The number of cores that are in use by the chains that are already running.
+        """
+        if self.max_load > 0 and cores_in_use:
+            # the chains that are already running are counted by their cores, since the load average lags behind
+            outside_load = max(os.getloadavg()[0] - cores_in_use, 0)
+            if outside_load + cores_in_use + cores > self.max_load * N_THREADS:
+                return False
+        if not self.memory or not memory:
+            return True
+        available = available_memory()
+        if available is None:
+            return True
+        limit = cgroup_memory_limit()
+        total = limit[0] if limit is not None else os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        # the running alignments will still grow into whatever they have been given but are not using yet
+        growth = max(self.reserved - self.measure(), 0)
+        if memory <= available - growth - self.headroom * total:
+            return True
+        if not self.reserved:
+            warnings.warn('Starting chains that are estimated to need %.1f GiB of memory, with only %.1f GiB free.'
+                          % (memory / 2 ** 30, max(available - self.headroom * total, 0) / 2 ** 30), UserWarning)
+            return True
+        return False
+
+    def reserve(self, memory):
+        """
+        Count the memory of a request that has been let through as taken.
+
+        :param memory: The estimated memory of the request, in bytes.
+        """
+        self.reserved += memory
+
+    def unreserve(self, memory):
+        """
+        Count the memory of a request as free again.
+
+        :param memory: The estimated memory of the request, in bytes.
+        """
+        self.reserved = max(self.reserved - memory, 0)
+
+    def start(self, processes):
+        """
+        Start measuring the chains of an alignment along with the others.
+
+        :param processes: The list of the chain processes of the alignment; processes that are replaced in it are
+        followed.
+        """
+        self.running.append(processes)
+
+    def finish(self, processes, raw_estimate, peak):
+        """
+        Stop measuring the chains of an alignment, and correct future estimates by how far off its estimate was.
+
+        :param processes: The list of the chain processes of the alignment, as given to [start].
+        :param raw_estimate: The uncorrected estimate of the memory of the alignment, in bytes.
+        :param peak: The largest footprint that the alignment was measured at, in bytes, or 0 if it was not measured.
+        """
+        self.running = [group for group in self.running if group is not processes]
+        if raw_estimate > 0 and peak > 0:
+            self.ratios = (self.ratios + [peak / raw_estimate])[-MEMORY_HISTORY:]
+
+
+class LeaseLost(Exception):
+    """
+    Raised by [run_alignment] when the lease of a worker on an alignment has been taken over by another worker.
+    """
+    pass
+
+
+class Lease(object):
+    """
+    The claim of a worker on an alignment in a [LeaseQueue]: a file in the queue directory that holds the id of the
+    worker, and whose modification time is the last time that the worker renewed it.
+    """
+    def __init__(self, path, worker):
+        """
+        :param path: The path to the lease file.
+        :param worker: The id of the worker that holds the lease.
+        """
+        self.path = path
+        self.worker = worker
+        self.lost = False
+
+    def owned(self):
+        """
+        Return True if the lease file still belongs to this worker, and False if it has been taken over or removed.
+        """
+        try:
+            with open(self.path) as f:
+                return f.read().strip() == self.worker
+        except FileNotFoundError:
+            return False
+
+    def renew(self):
+        """
+        Renew the lease, so that it does not expire. Return False, and mark the lease as lost, if it no longer belongs
+        to this worker.
+        """
+        if self.lost or not self.owned():
+            self.lost = True
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            self.lost = True
+            return False
+        return True
+
+    async def keep_alive(self, period, on_lost):
+        """
+        Renew the lease every [period] seconds until cancelled, or until it is found to have been lost. A renewal that
+        fails is reported as a warning, and tried again at the next one.
+
+        :param period: The time between renewals, in seconds.
+        :param on_lost: A function to call (with no arguments) if the lease is lost.
+        """
+        while True:
+            await asyncio.sleep(period)
+            try:
+                renewed = self.renew()
+            except OSError as e:
+                warnings.warn('Could not renew the lease %s: %s' % (self.path, e), UserWarning)
+                continue
+            if not renewed:
+                warnings.warn('Worker %s has lost its lease %s.' % (self.worker, self.path), UserWarning)
+                on_lost()
+                return
+
+    def release(self):
+        """
+        Remove the lease file, if it still belongs to this worker.
+        """
+        if not self.lost and self.owned():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class LeaseQueue(object):
+    """
+    A job queue of alignments in a directory on a shared filesystem, which any number of workers, on any number of
+    nodes, claim the alignments from. A worker claims an alignment by creating its lease file, which only one worker
+    can do, and keeps it by renewing the lease (see [Lease]) until the alignment is done. A lease that has not been
+    renewed for [timeout] seconds has expired, and the alignment can be claimed again by any worker.
+
+    Taking over an expired lease first renames the lease file to a name that belongs to the new worker, so that only one
+    of the workers racing to take it over succeeds. The clocks of the nodes are assumed to agree to well within the
+    timeout.
+
+    An alignment that has been run to the end is marked as done by a marker file next to its lease, which is created
+    before the lease is released, so that the alignment is never claimed again. The queue, not the run store, is what
+    the workers go by to tell which alignments are done.
+    """
+    def __init__(self, directory, worker=None, timeout=LEASE_TIMEOUT, heartbeat=LEASE_HEARTBEAT):
+        """
+        :param directory: The queue directory, which is created if it does not exist.
+        :param worker: The id of this worker. Default: the host name and the process id.
+        :param timeout: How long after its last renewal a lease expires (in seconds).
+        :param heartbeat: How often the leases of this worker are renewed (in seconds).
+        """
+        self.directory = directory
+        self.worker = worker or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, alignment):
+        return os.path.join(self.directory, alignment + '.lease')
+
+    def _done_path(self, alignment):
+        return os.path.join(self.directory, alignment + '.done')
+
+    def is_done(self, alignment):
+        """
+        Return True if an alignment has been marked as done with [mark_done].
+
+        :param alignment: The name of the alignment.
+        """
+        return os.path.exists(self._done_path(alignment))
+
+    def mark_done(self, alignment):
+        """
+        Mark an alignment as done, by the worker that ran it. Marking an alignment that is already done does nothing.
+
+        :param alignment: The name of the alignment.
+        """
+        try:
+            fd = os.open(self._done_path(alignment), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker + '\n')
+
+    def _expired(self, path):
+        return time.time() - os.path.getmtime(path) > self.timeout
+
+    def claimable(self, alignment):
+        """
+        Return True if an alignment is not done, and nobody holds a lease on it (or its lease has expired).
+
+        :param alignment: The name of the alignment.
+        """
+        if self.is_done(alignment):
+            return False
+        try:
+            return self._expired(self._path(alignment))
+        except FileNotFoundError:
+            return True
+
+    def claim(self, alignment):
+        """
+        Claim an alignment. Return its [Lease], or [None] if another worker holds a lease on it that has not expired.
+
+        :param alignment: The name of the alignment.
+        """
+        path = self._path(alignment)
+        if not self.claimable(alignment):
+            return None
+        if os.path.exists(path):
+            # take the expired lease over, unless another worker does so first
+            taken = '%s.%s' % (path, self.worker)
+            try:
+                os.rename(path, taken)
+            except FileNotFoundError:
+                return None
+            if not self._expired(taken):
+                # the lease was renewed, or taken over, since we looked at it, so hand it back
+                try:
+                    os.link(taken, path)
+                except FileExistsError:
+                    pass
+                os.remove(taken)
+                return None
+            os.remove(taken)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker + '\n')
+        return Lease(path, self.worker)
+
+
+class ChainSupervisor(object):
+    """
+    Keeps track of how fast each chain of an alignment is running, and restarts any chain that has fallen well behind
+    the others (a straggler, for example because of a noisy neighbour or a bad placement of its MPI ranks) from its
+    checkpoint, so that all of the chains reach the burn-in and convergence windows at about the same time. The number
+    of processes of a running MPI job cannot be changed, so a straggler is given more cores by restarting it on extra
+    cores from the budget, if any are free (and no alignment is waiting for them); otherwise it is restarted on as many
+    cores as before, which at least gives it a fresh placement. The extra cores go through the [AdmissionControl] of
+    the budget, if it has one, as would any other request.
+    """
+    def __init__(self, chains, processes, threads_per_chain, budget, work_dir, ratio=STRAGGLER_RATIO,
+                 max_restarts=STRAGGLER_RESTARTS, cpus=None, verbose=False):
+        """
+        :param chains: A list of the *full* names of the chains.
+        :param processes: The list of the [mpirun] processes running the chains, in the same order as [chains].
+        Restarted chains have their processes replaced in this list.
+        :param threads_per_chain: The number of threads that the chains were started on.
+        :param budget: The [CoreBudget] to take extra cores from.
+        :param work_dir: The directory that the chains are being run in.
+        :param ratio: How slow a chain must be, relative to the fastest other chain, to be restarted. 0 disables the
+        supervision.
+        :param max_restarts: How many times each chain may be restarted.
+        :param cpus: The list of the cores that the chains are pinned to, in the same order as [chains], if the budget
+        has a [CorePlacement]. Restarted chains are pinned to new cores, which replace their old ones in this list.
+        :param verbose: Whether to print a message when a chain is restarted.
+        """
+        self.chains = chains
+        self.processes = processes
+        self.cpus = cpus
+        self.threads = {chain: threads_per_chain for chain in chains}
+        self.budget = budget
+        self.work_dir = work_dir
+        self.ratio = ratio
+        self.max_restarts = max_restarts
+        self.verbose = verbose
+        self.base_threads = threads_per_chain
+        self.extra_cores = 0
+        # the memory estimated for the extra ranks, as it was reserved, and before it was corrected
+        self.extra_memory = 0
+        self.extra_raw_memory = 0
+        self.restarts = {chain: 0 for chain in chains}
+        self.rates = {chain: None for chain in chains}
+        self._samples = {chain: 0 for chain in chains}
+        self._last = {chain: None for chain in chains}
+
+    def observe(self, generations):
+        """
+        Record how many generations each chain has reached, to keep track of how fast they are running.
+
+        :param generations: A list of the number of generations reached by each chain, in the same order as [chains].
+        """
+        now = time.time()
+        for chain, chain_generations in zip(self.chains, generations):
+            last = self._last[chain]
+            if last is not None and now > last[0] and chain_generations >= last[1]:
+                rate = (chain_generations - last[1]) / (now - last[0])
+                self.rates[chain] = rate if self.rates[chain] is None else 0.7 * self.rates[chain] + 0.3 * rate
+                self._samples[chain] += 1
+            self._last[chain] = (now, chain_generations)
+
+    def stragglers(self, generations):
+        """
+        Return the full names of the chains that should be restarted.
+
+        :param generations: The number of generations reached by each chain, as passed to [observe].
+        """
+        if self.ratio <= 0 or any(self._samples[chain] < STRAGGLER_MIN_SAMPLES for chain in self.chains):
+            return []
+        generations = dict(zip(self.chains, generations))
+        stragglers = []
+        for chain in self.chains:
+            others = [other for other in self.chains if other != chain]
+            fastest = max(others, key=lambda other: self.rates[other])
+            if (self.rates[chain] < self.ratio * self.rates[fastest]
+                    and generations[fastest] - generations[chain] >= STRAGGLER_MIN_LAG
+                    and self.restarts[chain] < self.max_restarts
+                    and os.path.exists(os.path.join(self.work_dir, '%s.chain' % chain))):
+                stragglers.append(chain)
+        return stragglers
+
+    async def supervise(self, generations):
+        """
+        Record how many generations each chain has reached, and restart any stragglers.
+
+        :param generations: The number of generations reached by each chain, as passed to [observe].
+        """
+        self.observe(generations)
+        for chain in self.stragglers(generations):
+            await self.restart(chain)
+
+    async def restart(self, chain):
+        """
+        Stop a chain and restart it from its checkpoint, on extra cores if the budget has some to spare.
+
+        :param chain: The full name of the chain.
+        """
+        i = self.chains.index(chain)
+        extra = 0
+        raw_memory = memory = 0
+        if self.budget.admission is not None:
+            raw_memory = self.budget.admission.raw_rank_estimate(self.base_threads)
+            memory = raw_memory * self.budget.admission.correction
+        if self.threads[chain] < 2 * self.base_threads and self.budget.try_acquire(self.base_threads, memory):
+            extra = self.base_threads
+            self.extra_memory += memory
+            self.extra_raw_memory += raw_memory
+        if self.verbose:
+            fastest = max(self.rates[other] for other in self.chains if other != chain)
+            click.echo('Chain %s is running at %.2f generations/s, against %.2f for the fastest chain; restarting it '
+                       'from its checkpoint on %d thread(s).'
+                       % (chain, self.rates[chain], fastest, self.threads[chain] + extra))
+
+        process = self.processes[i]
+        await asyncio.get_event_loop().run_in_executor(None, terminate_all_processes, [process])
+
+        self.threads[chain] += extra
+        self.extra_cores += extra
+        cpus = None
+        if self.cpus is not None:
+            self.budget.placement.release(self.cpus[i])
+            cpus = self.cpus[i] = self.budget.placement.allocate(self.threads[chain])
+        self.processes[i] = start_chain_process(mpirun_cmd(self.threads[chain], None, chain, resume=True),
+                                                self.work_dir, cpus)
+        self.restarts[chain] += 1
+        # the chain's rate has to be measured again from scratch, since it is starting up
+        self.rates[chain] = None
+        self._samples[chain] = 0
+        self._last[chain] = None
+
+    def release(self):
+        """
+        Return any extra cores taken for restarted chains to the budget, along with their memory.
+        """
+        self.budget.release(self.extra_cores, self.extra_memory)
+        self.extra_cores = 0
+        self.extra_memory = 0
+
+
+def prometheus_value(value):
+    """
+    Format a number as a sample value in the Prometheus text format.
+
+    :param value: The number.
+    """
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def prometheus_labels(**labels):
+    """
+    Format labels for a sample in the Prometheus text format, escaping their values.
+
+    :param labels: The label names and values.
+    """
+    values = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in sorted(labels.items())]
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in values)
+
+
+def json_number(value):
+    """
+    Return a number as it should be written to JSON, where there is no infinity: infinite numbers become [None].
+
+    :param value: The number, or [None].
+    """
+    if value is None or math.isinf(value):
+        return None
+    return value
+
+
+class Telemetry(object):
+    """
+    Collects live statistics on a batch of alignments: the generations per second of every chain, the wall time spent
+    in each stage of the convergence checks, the number of alignments waiting for cores, how many cores are in use,
+    and the projected time until each alignment (and the whole batch) is done. Every event (an alignment starting, a
+    check, an alignment finishing) is appended to a JSON lines file, and the latest statistics are written to a
+    Prometheus textfile, which a node exporter can scrape. The textfile is replaced atomically, so a scrape never sees
+    a half-written file.
+    """
+    def __init__(self, output_dir, prometheus_file=None):
+        """
+        :param output_dir: The output directory, which the JSON lines file is written to.
+        :param prometheus_file: The path to write the Prometheus textfile to. Defaults to [PROMETHEUS_FILE] in the
+        output directory; to be scraped, it must be in the node exporter's textfile directory and end with ".prom".
+        """
+        self.jsonl_path = os.path.join(output_dir, TELEMETRY_FILE)
+        self.prometheus_path = prometheus_file or os.path.join(output_dir, PROMETHEUS_FILE)
+        self.budget = None
+        self.alignments = 0
+        self.checks = 0
+        self.running = {}
+        self.durations = {}
+        self.generations = {}
+        self.rates = {}
+        self.timings = {}
+        self.stage_totals = collections.defaultdict(float)
+        self.etas = {}
+        self._last = {}
+
+    def attach(self, budget, alignments):
+        """
+        Start keeping track of a batch of alignments.
+
+        :param budget: The [CoreBudget] of the batch.
+        :param alignments: The number of alignments in the batch.
+        """
+        self.budget = budget
+        self.alignments = alignments
+        self._write_prometheus()
+
+    def start(self, alignment):
+        """
+        Record that the chains of an alignment have been started.
+
+        :param alignment: The name of the alignment.
+        """
+        self.running[alignment] = time.time()
+        self._event('start', alignment=alignment)
+
+    def record_check(self, alignment, convergence, projected_generations=None):
+        """
+        Record the result of a convergence check.
+
+        :param alignment: The name of the alignment.
+        :param convergence: The [Convergence] instance generated by the check.
+        :param projected_generations: The number of generations at which the chains are projected to converge, if the
+        check itself does not have a projection (see [Convergence]).
+        """
+        now = time.time()
+        rates = self.rates.setdefault(alignment, {})
+        last = self._last.get(alignment)
+        for chain, generations in convergence.generations.items():
+            if last is not None and now > last[0] and chain in last[1]:
+                rate = (generations - last[1][chain]) / (now - last[0])
+                rates[chain] = rate if rates.get(chain) is None else 0.7 * rates[chain] + 0.3 * rate
+        self._last[alignment] = (now, dict(convergence.generations))
+        self.generations[alignment] = dict(convergence.generations)
+
+        self.checks += 1
+        self.timings[alignment] = dict(convergence.timings)
+        for stage, seconds in convergence.timings.items():
+            self.stage_totals[stage] += seconds
+
+        # the chains are done when the slowest one gets to the projected number of generations
+        projected = convergence.projected_generations
+        if projected is None:
+            projected = projected_generations
+        rate = min(rates.values()) if len(rates) == len(convergence.generations) else None
+        if projected is None or not rate:
+            self.etas[alignment] = None
+        elif math.isinf(projected):
+            self.etas[alignment] = math.inf
+        else:
+            self.etas[alignment] = max(projected - min(convergence.generations.values()), 0) / rate
+
+        self._event('check', alignment=alignment, generations=convergence.generations, rates=rates,
+                    timings=convergence.timings, loglik_effsize=convergence.loglik_effsize,
+                    loglik_rel_diff=convergence.loglik_rel_diff, max_diff=convergence.max_diff,
+                    discard=None if convergence.discard is None else int(convergence.discard),
+                    projected_generations=json_number(projected), eta_seconds=json_number(self.etas[alignment]),
+                    stop=convergence.stop, converged=convergence.converged)
+
+    def finish(self, alignment, status):
+        """
+        Record that the chains of an alignment have been stopped.
+
+        :param alignment: The name of the alignment.
+        :param status: How the run ended, for example one of the statuses of [RunStore].
+        """
+        started = self.running.pop(alignment, None)
+        if started is not None:
+            self.durations[alignment] = time.time() - started
+        for statistics in (self.generations, self.rates, self.timings, self.etas, self._last):
+            statistics.pop(alignment, None)
+        self._event('finish', alignment=alignment, status=status, seconds=self.durations.get(alignment))
+
+    def batch_eta(self):
+        """
+        Return the projected number of seconds until every alignment in the batch is done, or [None] if there is not
+        enough to go on yet. The alignments that are still waiting are assumed to take as long as the finished ones did
+        on average, and to be run as many at a time as are running now.
+        """
+        pending = self.alignments - len(self.running) - len(self.durations)
+        etas = [self.etas.get(alignment) for alignment in self.running]
+        if any(eta is None for eta in etas):
+            return None
+        running = max(etas) if etas else 0.0
+        if pending <= 0:
+            return running
+        if not self.durations:
+            return None
+        return running + pending * np.mean(list(self.durations.values())) / max(len(self.running), 1)
+
+    def _batch_statistics(self):
+        return {
+            'running': len(self.running),
+            'pending': max(self.alignments - len(self.running) - len(self.durations), 0),
+            'finished': len(self.durations),
+            'queue_depth': self.budget.waiting if self.budget is not None else 0,
+            'cores_used': self.budget.cores - self.budget.free if self.budget is not None else 0,
+            'cores_total': self.budget.cores if self.budget is not None else 0,
+            'batch_eta_seconds': json_number(self.batch_eta()),
+        }
+
+    def _event(self, event, **fields):
+        record = collections.OrderedDict([('time', time.time()), ('event', event)])
+        record.update(fields)
+        record.update(self._batch_statistics())
+        with open(self.jsonl_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self._write_prometheus()
+
+    def _write_prometheus(self):
+        metrics = []
+
+        def metric(name, metric_type, description, samples):
+            metrics.append('# HELP %s %s' % (name, description))
+            metrics.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                metrics.append('%s%s %s' % (name, prometheus_labels(**labels) if labels else '',
+                                            prometheus_value(value)))
+
+        batch = self._batch_statistics()
+        metric('ezpb_chain_generations', 'gauge', 'Generations reached by each chain at its last check.',
+               [({'alignment': alignment, 'chain': chain}, generations)
+                for alignment, chains in self.generations.items() for chain, generations in chains.items()])
+        metric('ezpb_chain_generations_per_second', 'gauge', 'Smoothed generation rate of each chain.',
+               [({'alignment': alignment, 'chain': chain}, rate)
+                for alignment, chains in self.rates.items() for chain, rate in chains.items()])
+        metric('ezpb_check_stage_seconds', 'gauge', 'Wall time spent in each stage of the last check of an alignment.',
+               [({'alignment': alignment, 'stage': stage}, seconds)
+                for alignment, stages in self.timings.items() for stage, seconds in stages.items()])
+        metric('ezpb_check_stage_seconds_total', 'counter', 'Wall time spent in each stage of all checks.',
+               [({'stage': stage}, seconds) for stage, seconds in self.stage_totals.items()])
+        metric('ezpb_checks_total', 'counter', 'Convergence checks performed.', [({}, self.checks)])
+        metric('ezpb_alignment_eta_seconds', 'gauge', 'Projected time until an alignment converges.',
+               [({'alignment': alignment}, eta) for alignment, eta in self.etas.items() if eta is not None])
+        metric('ezpb_alignments', 'gauge', 'Alignments in the batch, by state.',
+               [({'state': state}, batch[state]) for state in ('running', 'pending', 'finished')])
+        metric('ezpb_queue_depth', 'gauge', 'Alignments waiting for cores.', [({}, batch['queue_depth'])])
+        metric('ezpb_cores_used', 'gauge', 'Cores in use by running chains.', [({}, batch['cores_used'])])
+        metric('ezpb_cores_total', 'gauge', 'Cores available to the batch.', [({}, batch['cores_total'])])
+        batch_eta = self.batch_eta()
+        metric('ezpb_batch_eta_seconds', 'gauge', 'Projected time until every alignment in the batch is done.',
+               [({}, batch_eta)] if batch_eta is not None else [])
+        metric('ezpb_last_update_timestamp_seconds', 'gauge', 'When these statistics were written.',
+               [({}, time.time())])
+
+        partial_path = self.prometheus_path + '.part'
+        with open(partial_path, 'w') as f:
+            f.write('\n'.join(metrics) + '\n')
+        os.replace(partial_path, self.prometheus_path)
+
+
+async def run_alignment(alignment_file, chain_names, threads_per_chain, budget, output_dir, save_good_tree_chains,
+                        check_freq, min_cycles, store=None, resume=False, archiver=None,
+                        straggler_ratio=STRAGGLER_RATIO, straggler_restarts=STRAGGLER_RESTARTS, telemetry=None,
+                        consensus=CONSENSUS, treelists=TREELISTS, scratch=None, sync_freq=SYNC_FREQ, queue=None,
+                        name=None, on_check=None, verbose=True, log_dir=None, **check_options):
+    """
+    Run and monitor the chains for a single alignment, once enough cores are free in the budget. The chains are run in
+    their own directory inside the output directory, so that several alignments can be run at the same time.
+
+    Return the [Convergence] of the check that stopped the chains, or [None] if the alignment was claimed by another
+    worker first (see [queue]).
+
+    :param alignment_file: The path to the alignment file to process.
+    :param chain_names: A list of the names of the chains to run.
+    :param threads_per_chain: The number of threads to run each chain on.
+    :param budget: The [CoreBudget] to take the cores for the chains from.
+    :param output_dir: The output directory (where the output files are being moved to).
+    :param save_good_tree_chains: True if output chain files from good trees are to be kept, False if they are to be
+    deleted.
+    :param check_freq: How often to perform the convergence check (in seconds).
+    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+    :param store: The [RunStore] to record the progress and the results of the alignment in, if any.
+    :param resume: If True, and an earlier run of the alignment was interrupted, restart its chains from their
+    checkpoints (see [restore_output_files]) rather than from scratch. The convergence checks then carry on from the
+    generations that the chains had already reached.
+    :param archiver: The [Archiver] to archive the output files of the alignment with once it has finished, if any.
+    The output files of interrupted runs are always moved straight away, and never compressed, so that the chains can
+    be resumed.
+    :param straggler_ratio: How slow a chain must be, relative to the fastest other chain, to be restarted from its
+    checkpoint by a [ChainSupervisor]. 0 disables the supervision.
+    :param straggler_restarts: How many times each chain may be restarted for being a straggler.
+    :param telemetry: The [Telemetry] of the batch, if any.
+    :param consensus: How the consensus tree is to be built once the chains have stopped; one of [CONSENSUS_MODES]. The
+    consensus tree of an interrupted run is always built natively from the trees sampled so far.
+    :param treelists: What to keep of the tree lists, if there is no [archiver]; one of [TREELIST_MODES].
+    :param scratch: A node-local directory to run the chains in, if any. The chains then run (and are checked) in
+    their own directory inside it, their files are synced to their directory in the output directory by a
+    [CheckpointSync] every [sync_freq] seconds, and the output files are staged to the output directory from the
+    scratch directory when the chains have stopped.
+    :param sync_freq: How often to sync the chain files from the scratch directory (in seconds).
+    :param queue: The [LeaseQueue] to claim the alignment from once the cores are free, if any. The lease is renewed
+    for as long as the chains run. If it is taken over by another worker, the chains are stopped, their files are left
+    for the new owner, and [LeaseLost] is raised.
+    :param name: The name of the alignment, which must not be shared by any other alignment in the output directory.
+    Default: the name given to it by [alignment_name], which is its path without the first directory.
+    :param on_check: A function to call with the name of the alignment and the [Convergence] of every check, for
+    example to follow the progress of the chains. It may be a coroutine function.
+    :param verbose: If True, print what is being run and the summary statistics of every check.
+    :param log_dir: The directory of the logfile to add the alignment to once it is done, if it is not the output
+    directory (for a worker, which keeps a logfile of its own along with its [store]).
+    :param check_options: The convergence thresholds and the other options for the convergence check, passed on to
+    [check_thresholds_periodic]. For details check the documentation of the former and of [check_thresholds].
+    """
+    # The name of the alignment
+    name = name or alignment_name(alignment_file)
+    # The directory that the chains are run in, and the one on the shared filesystem that it is synced to, if any
+    work_dir = os.path.join(output_dir, WORK_DIRECTORY, name)
+    sync_dir = None
+    if scratch is not None:
+        work_dir, sync_dir = os.path.join(scratch, name), work_dir
+    cores = threads_per_chain * len(chain_names)
+    # the memory that the chains are estimated to need, and the most that they have been measured to use
+    admission = budget.admission
+    raw_memory = memory = peak_memory = 0
+    if admission is not None:
+        raw_memory = admission.raw_estimate(alignment_file, len(chain_names), threads_per_chain)
+        memory = raw_memory * admission.correction
+
+    await budget.acquire(cores, memory)
+
+    lease = None
+    if queue is not None:
+        lease = queue.claim(name)
+        if lease is None or queue.is_done(name):
+            # another worker got there first
+            if lease is not None:
+                lease.release()
+            budget.release(cores, memory)
+            return None
+        if verbose:
+            click.echo('Worker %s claimed alignment %s.' % (queue.worker, name))
+
+    processes = []
+    # the cores that each chain is pinned to, if any
+    chain_cpus = [] if budget.placement is not None else None
+    supervisor = None
+    syncing = None
+    checking = None
+    heartbeat = None
+    status = RunStore.INCOMPLETE
+    # the thinned tree lists of the chains
+    samplers = []
+    # generate specific chain file names
+    chain_full_names = [chain_full_name(name, chain_name)
+                        for chain_name in chain_names]
+
+    try:
+        resuming = resume and restore_output_files(output_dir, name, chain_names, work_dir, sync_dir)
+        if resuming and verbose:
+            click.echo('Resuming alignment %s from its checkpoints.' % name)
+        else:
+            # whatever is left over from an earlier run is of no use if we are starting over
+            for directory in (work_dir, sync_dir):
+                if directory is not None and os.path.exists(directory):
+                    shutil.rmtree(directory)
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        if store is not None:
+            store.start(name, alignment_file)
+        samplers = [TreelistSampler(os.path.join(work_dir, '%s.treelist' % chain)) for chain in chain_full_names]
+
+        for chain_name in chain_full_names:
+            # the chains do not run in the current directory, so they need the full path to the alignment
+            cmd = mpirun_cmd(threads_per_chain, os.path.abspath(alignment_file), chain_name, resume=resuming)
+            if verbose:
+                click.echo('Starting run: %s' % ' '.join(cmd))
+            cpus = None
+            if chain_cpus is not None:
+                cpus = budget.placement.allocate(threads_per_chain)
+                chain_cpus.append(cpus)
+            # open it and start running
+            process = start_chain_process(cmd, work_dir, cpus)
+            processes.append(process)
+        if admission is not None:
+            admission.start(processes)
+
+        callback = partial(check_fail_callback,
+                           alignment=name,
+                           chains=chain_names,
+                           processes=processes,
+                           output_dir=output_dir,
+                           save_good_tree_chains=save_good_tree_chains,
+                           work_dir=work_dir,
+                           store=store,
+                           archiver=archiver,
+                           consensus=consensus,
+                           sync_dir=sync_dir,
+                           treelists=treelists,
+                           log_dir=log_dir,
+                           samplers=samplers)
+        check_options['consensus'] = consensus
+        check_options['verbose'] = verbose
+        if sync_dir is not None:
+            syncing = asyncio.ensure_future(CheckpointSync(work_dir, sync_dir, chain_full_names).run(sync_freq))
+
+        async def report_progress(convergence):
+            nonlocal peak_memory
+            # thin the trees written since the last check, so that the full tree lists never have to be read again
+            await asyncio.get_event_loop().run_in_executor(None, lambda: [sampler.update() for sampler in samplers])
+            if admission is not None:
+                peak_memory = max(peak_memory, admission.measure(processes))
+            if store is not None:
+                await call_callback(partial(store.record_check, name), convergence)
+            if on_check is not None:
+                await call_callback(on_check, name, convergence)
+
+        check_options['progress_callback'] = report_progress
+        supervisor = ChainSupervisor(chain_full_names, processes, threads_per_chain, budget, work_dir,
+                                     ratio=straggler_ratio, max_restarts=straggler_restarts, cpus=chain_cpus,
+                                     verbose=verbose)
+        check_options['supervisor'] = supervisor
+        if telemetry is not None:
+            telemetry.start(name)
+            check_options['telemetry'] = telemetry
+
+        checking = asyncio.ensure_future(check_thresholds_periodic(
+            name, chain_names, callback, check_freq, min_cycles, work_dir=work_dir, **check_options))
+        if lease is not None:
+            heartbeat = asyncio.ensure_future(lease.keep_alive(queue.heartbeat, on_lost=checking.cancel))
+        convergence = await checking
+
+        if verbose:
+            print('Alignment %s chains finished processing.' % name)
+        status = 'finished'
+    except BaseException:  # so that it catches KeyboardInterrupts and cancellations
+        # Upon an exception:
+        # 1. Stop all chains
+        # 2. Move all chain output files to output/analyses
+        # 3. Move output tree file to output/incomplete_trees
+
+        # Step 1:
+        if verbose:
+            print('Exception raised, terminating all chains of alignment %s...' % name)
+        # stopping the chains, and saving their files, can take a while, and the other alignments carry on meanwhile
+        await run_to_completion(terminate_all_processes, processes)
+        if syncing is not None:
+            syncing.cancel()
+        if lease is not None and lease.lost:
+            # the alignment, and its files, belong to another worker now
+            if sync_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            raise LeaseLost('Alignment %s was taken over by another worker.' % name)
+        if store is not None and store.status(name) == RunStore.RUNNING:
+            store.mark_incomplete(name)
+
+        # Steps 2 & 3:
+        if os.path.exists(work_dir):
+            if verbose:
+                print('Saving output files...')
+            tree_dir = os.path.join(output_dir, 'incomplete_trees')
+
+            # Save runs because the tree is incomplete; the chain files must be saved even if the tree cannot be built,
+            # and the exception that stopped the chains is the one to raise
+            try:
+                for sampler in samplers:
+                    await run_to_completion(sampler.update)
+                await run_to_completion(build_consensus_tree, name, chain_names, work_dir=work_dir,
+                                        consensus='native')
+            except Exception as e:
+                warnings.warn('Could not build the consensus tree of alignment %s: %s' % (name, e), UserWarning)
+            await run_to_completion(
+                move_output_files,
+                output_dir=output_dir,
+                tree_dir=tree_dir,
+                alignment=name,
+                save_chain_files=True,
+                work_dir=work_dir,
+                sync_dir=sync_dir)
+        raise
+    finally:
+        await run_to_completion(terminate_all_processes, processes)
+        if syncing is not None:
+            syncing.cancel()
+        if heartbeat is not None:
+            heartbeat.cancel()
+        for cpus in chain_cpus or []:
+            budget.placement.release(cpus)
+        if supervisor is not None:
+            supervisor.release()
+        if admission is not None:
+            # the chains may have been restarted on extra ranks, which the footprint includes
+            if supervisor is not None:
+                raw_memory += supervisor.extra_raw_memory
+            admission.finish(processes, raw_memory, peak_memory)
+            if store is not None and peak_memory:
+                store.record_memory(name, raw_memory, peak_memory)
+        if lease is not None:
+            if status == 'finished' and not lease.lost:
+                # everything about the alignment has been recorded, and it must not be claimed again once the lease
+                # is gone
+                queue.mark_done(name)
+            lease.release()
+        budget.release(cores, memory)
+        if telemetry is not None and name in telemetry.running:
+            telemetry.finish(name, status)
+    return convergence
+
+
+async def run_alignments(alignment_files, chain_names, threads, threads_per_chain, output_dir, save_good_tree_chains,
+                         check_freq, min_cycles, store=None, resume=False, archiver=None, telemetry=None,
+                         placement=None, admission=None, names=None, **check_options):
+    """
+    Run and monitor the chains for a list of alignments, running as many alignments at the same time as the thread
+    budget allows. Alignments are started in the order they are given in, as soon as enough cores have been freed up by
+    the alignments before them; [plan_alignments] puts them in a good order. Return a dictionary mapping the name of
+    every alignment to the [Convergence] of the check that stopped its chains, in the same order.
 
-    Preconditions:
-        - the [run] command must have been executed prior to calling this function.
+    If any of the alignments raises an exception, all other alignments are stopped (and their output files saved), and
+    the exception is re-raised.
+
+    :param alignment_files: The paths to the alignment files to process.
+    :param chain_names: A list of the names of the chains to run for each alignment.
+    :param threads: The total number of threads that may be used by all chains at any one time.
+    :param threads_per_chain: The number of threads to run each chain on; either a single number for every alignment,
+    or a dictionary from the alignment files to the number of threads to run their chains on.
+    :param placement: The [CorePlacement] to pin the chains with, if any.
+    :param admission: The [AdmissionControl] to hold back alignments with, if any.
+    :param names: A dictionary from the alignment files to their names. Default: the names given to them by
+    [alignment_names].
+    For the other parameters, see the documentation of [run_alignment].
     """
-    # Create output directory, and subdirectories: analyses, good_trees, bad_trees
-    analyses_dir = os.path.join(output_dir, 'analyses', alignment)
+    if not isinstance(threads_per_chain, dict):
+        threads_per_chain = {alignment_file: threads_per_chain for alignment_file in alignment_files}
+    names = names or alignment_names(alignment_files)
+    budget = CoreBudget(threads, placement, admission)
+    if telemetry is not None:
+        telemetry.attach(budget, len(alignment_files))
+    tasks = [asyncio.ensure_future(run_alignment(alignment_file, chain_names, threads_per_chain[alignment_file], budget,
+                                                 output_dir, save_good_tree_chains, check_freq, min_cycles,
+                                                 store=store, resume=resume, archiver=archiver, telemetry=telemetry,
+                                                 name=names[alignment_file], **check_options))
+             for alignment_file in alignment_files]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # let every alignment save its output files before giving up
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return collections.OrderedDict(zip((names[alignment_file] for alignment_file in alignment_files), results))
 
-    if not os.path.exists(analyses_dir):
-        os.makedirs(analyses_dir)
 
-    if not os.path.exists(tree_dir):
-        os.makedirs(tree_dir)
+async def analyse_alignments(alignments, chains, output_dir=OUTPUT_DIRECTORY, threads=N_THREADS,
+                             threads_per_chain=None, max_gen=MAX_GEN, max_loglik_effsize=MAX_LOGLIK_EFFSIZE,
+                             min_loglik_rel_diff=MIN_LOGLIK_REL_DIFF, min_maxdiff=MIN_MAXDIFF, check_freq=CHECK_FREQ,
+                             min_cycles=MIN_CYCLES, on_check=None, verbose=False, **options):
+    """
+    Run and monitor the chains for a batch of alignments, as the run command does, from Python. Any number of batches
+    can be run at the same time from the same event loop, each with its own thresholds and output directory; every
+    batch has its own thread budget, though.
 
-    # Move chain files into output/analyses/[alignment]: .chain (maybe), .monitor, .param, .run, .trace, .treelist
-    # note that .chain files should only be kept if the save_run flag is True
-    keep_file_types = ALL_CHAIN_FILE_TYPES if save_chain_files else KEEP_CHAIN_FILE_TYPES
-    candidate_files = os.listdir('.')
-    for file_type in keep_file_types:
-        for file in candidate_files:
-            if file.endswith(file_type):
-                current_path = os.path.join('.', file)
-                new_path = os.path.join(analyses_dir, file)
-                os.rename(current_path, new_path)
+    Return a dictionary mapping the name of every alignment that was run to the [Convergence] of the check that stopped
+    its chains. Alignments that are already done in the output directory are skipped, and left out of it.
 
-    # delete all remaining run files
-    for file_type in ALL_CHAIN_FILE_TYPES:
-        for file in os.listdir('.'):
-            if file.endswith(file_type):
-                os.remove(file)
+    :param alignments: The paths to the alignment files, or to directories of alignment files.
+    :param chains: The number of chains to run for each alignment.
+    :param output_dir: The output directory, which is created if it does not exist.
+    :param threads: The total number of threads that may be used by all chains at any one time.
+    :param threads_per_chain: The number of threads to run each chain on, or [None] to size the chains of each
+    alignment by [plan_alignments].
+    :param max_gen: The maximum number of generations to run the chains for.
+    :param max_loglik_effsize: The log likelihood effective size that the chains must reach to converge.
+    :param min_loglik_rel_diff: The log likelihood relative difference that the chains must get below to converge.
+    :param min_maxdiff: The maximum difference that the chains must get below to converge.
+    :param check_freq: How often to check for convergence (in seconds); see [check_thresholds_periodic].
+    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+    :param on_check: A function to call with the name of the alignment and the [Convergence] of every check of every
+    alignment. It may be a coroutine function.
+    :param verbose: If True, print what is being run and the summary statistics of every check, as the run command
+    does.
+    :param options: The other options to run the alignments with, such as [adaptive], [diagnostics] or [resume]. For
+    details check the documentation of [run_alignment] and [check_thresholds_periodic].
 
-    # Move and rename output tree file if it has been created
+    :raises ValueError: If the options are not valid, or if two of the alignments would get the same name.
+    """
+    error = run_options_error(threads, chains, threads_per_chain, 'none', 1, 1,
+                              options.get('abort_confidence', ABORT_CONFIDENCE), options.get('scratch'),
+                              options.get('sync_freq', SYNC_FREQ))
+    if error is not None:
+        raise ValueError(error)
+    names = alignment_names(find_alignment_files(alignments))
+    chain_names = [('chain_%d' % (j + 1)) for j in range(chains)]
+    store = open_output_dir(output_dir, chain_names)
     try:
-        os.rename(TREE_FILE_NAME, os.path.join(tree_dir, new_tree_file_name(alignment)))
-    except FileNotFoundError:
-        warnings.warn("The chains have not been running long enough for a tree file to have been generated",
-                      UserWarning)
+        pending_files = [alignment_file for alignment_file, name in names.items() if not store.is_done(name)]
+        plan = plan_alignments(pending_files, threads // chains, threads_per_chain)
+        return await run_alignments(
+            [alignment_file for alignment_file, alignment_threads in plan], chain_names, threads, dict(plan),
+            output_dir, options.pop('save_good_tree_chains', False), check_freq, min_cycles, store=store, names=names,
+            on_check=on_check, verbose=verbose, max_gen=max_gen, max_loglik_effsize=max_loglik_effsize,
+            min_loglik_rel_diff=min_loglik_rel_diff, min_maxdiff=min_maxdiff, **options)
+    finally:
+        store.close()
 
 
-def check_fail_callback(convergence, alignment, chains, processes, output_dir, save_good_tree_chains):
+async def run_worker(queue, alignment_files, chain_names, threads, threads_per_chain, output_dir,
+                     save_good_tree_chains, check_freq, min_cycles, store, telemetry=None, placement=None,
+                     admission=None, names=None, **run_options):
     """
-    This is the function that is called when the threshold check fails. All but the first arguments are intended to be
-    bound to the function using [functools.partial] to create a callback that fits the specification outlined in
-    [check_thresholds_periodic].
+    Run alignments as a worker: claim alignments from a [LeaseQueue] whenever enough cores are free, run them, and keep
+    looking for alignments to claim, including those whose leases have expired, until every alignment is done (see
+    [LeaseQueue.mark_done]).
 
-    :param convergence: The [Convergence] instance generated by the check.
+    If an alignment is taken over by another worker, this is reported as a warning, and the worker carries on. If any
+    alignment raises another exception, all other alignments are stopped (and their output files saved), and the
+    exception is re-raised.
+
+    :param queue: The [LeaseQueue] to claim the alignments from.
+    :param store: The [RunStore] of this worker (see [merge_worker_stores]).
+    For the other parameters, see the documentation of [run_alignments] and [run_alignment].
+    """
+    if not isinstance(threads_per_chain, dict):
+        threads_per_chain = {alignment_file: threads_per_chain for alignment_file in alignment_files}
+    names = names or alignment_names(alignment_files)
+    budget = CoreBudget(threads, placement, admission)
+    if telemetry is not None:
+        telemetry.attach(budget, len(alignment_files))
+    # the alignments being run by this worker
+    tasks = {}
+    try:
+        while True:
+            pending = [alignment_file for alignment_file in alignment_files
+                       if alignment_file not in tasks.values() and not queue.is_done(names[alignment_file])]
+            if not pending and not tasks:
+                break
+            # claim as many alignments as there are free cores for, in the order of the plan, unless alignments that
+            # have already been claimed are being held back for memory
+            free = budget.free if not budget.waiting else 0
+            for alignment_file in pending:
+                cores = threads_per_chain[alignment_file] * len(chain_names)
+                if cores <= free and queue.claimable(names[alignment_file]):
+                    task = asyncio.ensure_future(run_alignment(
+                        alignment_file, chain_names, threads_per_chain[alignment_file], budget, output_dir,
+                        save_good_tree_chains, check_freq, min_cycles, store=store, telemetry=telemetry, queue=queue,
+                        name=names[alignment_file], **run_options))
+                    tasks[task] = alignment_file
+                    free -= cores
+
+            if tasks:
+                done, _ = await asyncio.wait(list(tasks), timeout=queue.heartbeat,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            else:
+                # every alignment left is being run by other workers, whose leases may yet expire
+                done = ()
+                await asyncio.sleep(queue.heartbeat)
+            for task in done:
+                tasks.pop(task)
+                try:
+                    task.result()
+                except LeaseLost as e:
+                    warnings.warn(str(e), UserWarning)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # let every alignment save its output files before giving up
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AlignmentServer(object):
+    """
+    The scheduler of [ezpb serve]: a long-running process that owns the cores of the node, and runs the alignments
+    submitted to it over a Unix socket as cores become free. Every submission shares the same [CoreBudget], so
+    alignments are started in the order they were submitted, whichever client submitted them.
+
+    Clients send one JSON object per line, and get one back for each. Every request has a [command]:
+        - submit: run the alignments in [alignments], a list of [name, file] pairs, where the file is an absolute path
+          and the name is the one that [alignment_names] gives the path on the client's side; alignments that are
+          done, or already queued or running, are skipped
+        - status: return the status of every alignment submitted since the server started, and the use of the cores
+        - cancel: stop the alignments named in [alignments], whether they are queued or running
+    Every reply has [ok], and [error] if the request failed.
+    """
+    def __init__(self, chain_names, threads, output_dir, store, threads_per_chain=None, telemetry=None,
+                 placement=None, admission=None, **run_options):
+        """
+        :param chain_names: A list of the names of the chains to run for each alignment.
+        :param threads: The total number of threads that may be used by all chains at any one time.
+        :param output_dir: The output directory.
+        :param store: The [RunStore] of the output directory.
+        :param threads_per_chain: The number of threads to run each chain on, or [None] to size the chains of each
+        submission by [plan_alignments].
+        :param telemetry: The [Telemetry] of the server, if any.
+        :param placement: The [CorePlacement] to pin the chains with, if any.
+        :param admission: The [AdmissionControl] to hold back alignments with, if any.
+        :param run_options: The other options to run the alignments with, passed on to [run_alignment].
+        """
+        self.chain_names = chain_names
+        self.output_dir = output_dir
+        self.store = store
+        self.threads_per_chain = threads_per_chain
+        self.telemetry = telemetry
+        self.run_options = run_options
+        self.budget = CoreBudget(threads, placement, admission)
+        # the files of the alignments submitted since the server started, and the tasks of those not done yet
+        self.submitted = collections.OrderedDict()
+        self.tasks = {}
+        self.errors = {}
+        if telemetry is not None:
+            telemetry.attach(self.budget, 0)
+
+    def submit(self, alignments):
+        """
+        Queue alignments. Return the names of the alignments that were queued, and of those that were skipped.
+
+        :param alignments: A list of the names of the alignments and the absolute paths to their files, in pairs.
+
+        :raises ValueError: If an alignment has the same name as a different alignment that is queued or running, or
+        that is submitted along with it.
+        """
+        submitted, skipped, names = [], [], {}
+        for name, alignment_file in alignments:
+            other_file = self.submitted.get(name) if name in self.tasks else \
+                next((other for other, other_name in names.items() if other_name == name), None)
+            if other_file is not None and other_file != alignment_file:
+                raise ValueError('The alignments %s and %s would both be named %s.'
+                                 % (other_file, alignment_file, name))
+            if name in self.tasks or name in names.values() or self.store.is_done(name):
+                skipped.append(name)
+            else:
+                names[alignment_file] = name
+        plan = plan_alignments(list(names), self.budget.cores // len(self.chain_names), self.threads_per_chain)
+        for alignment_file, threads_per_chain in plan:
+            name = names[alignment_file]
+            task = asyncio.ensure_future(run_alignment(
+                alignment_file, self.chain_names, threads_per_chain, self.budget, self.output_dir, store=self.store,
+                telemetry=self.telemetry, name=name, **self.run_options))
+            task.add_done_callback(partial(self._finished, name))
+            self.submitted[name] = alignment_file
+            self.submitted.move_to_end(name)
+            self.tasks[name] = task
+            self.errors.pop(name, None)
+            submitted.append(name)
+            click.echo('Queued alignment %s: %d thread(s) per chain.' % (name, threads_per_chain))
+        if self.telemetry is not None:
+            self.telemetry.attach(self.budget, len(self.submitted))
+        return submitted, skipped
+
+    def _finished(self, name, task):
+        del self.tasks[name]
+        if not task.cancelled() and task.exception() is not None:
+            self.errors[name] = str(task.exception())
+            warnings.warn('Alignment %s failed: %s' % (name, task.exception()), UserWarning)
+
+    def cancel(self, names):
+        """
+        Stop queued or running alignments. The output files of running alignments are saved as for an interrupted run.
+        Return the names of the alignments that were cancelled.
+
+        :param names: The names of the alignments.
+        """
+        cancelled = [name for name in names if name in self.tasks]
+        for name in cancelled:
+            self.tasks[name].cancel()
+        return cancelled
+
+    def status(self):
+        """
+        Return the status of every alignment submitted since the server started (queued, running, or the status it was
+        recorded with in the [RunStore]), and the use of the cores.
+        """
+        alignments = []
+        for name, alignment_file in self.submitted.items():
+            status = self.store.status(name)
+            if name in self.tasks and status != RunStore.RUNNING:
+                status = 'queued'
+            alignments.append({'name': name, 'file': alignment_file, 'status': status or 'cancelled',
+                               'generations': self.store.generations(name), 'error': self.errors.get(name)})
+        return {'alignments': alignments, 'cores': self.budget.cores, 'cores_free': self.budget.free,
+                'waiting': self.budget.waiting}
+
+    def handle_request(self, request):
+        """
+        Carry out a request from a client, and return the reply.
+
+        :param request: The request, as a dictionary.
+        """
+        command = request.get('command')
+        if command == 'submit':
+            submitted, skipped = self.submit(request.get('alignments', []))
+            return {'ok': True, 'submitted': submitted, 'skipped': skipped}
+        elif command == 'status':
+            return dict(ok=True, **self.status())
+        elif command == 'cancel':
+            return {'ok': True, 'cancelled': self.cancel(request.get('alignments', []))}
+        return {'ok': False, 'error': 'Unknown command: %s' % command}
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = self.handle_request(json.loads(line.decode()))
+                except (ValueError, TypeError, AttributeError, OSError) as e:
+                    reply = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        """
+        Accept requests on a Unix socket until cancelled. The alignments that are still queued or running are then
+        stopped, and their output files saved.
+
+        :param socket_path: The path to the socket.
+        """
+        server = await asyncio.start_unix_server(self._handle_client, path=socket_path)
+        click.echo('Listening on %s.' % socket_path)
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            server.close()
+            await server.wait_closed()
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            # let every alignment save its output files before giving up
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to an [AlignmentServer], and return its reply.
+
+    :param socket_path: The path to the socket of the server.
+    :param request: The request, as a dictionary.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('The server closed the connection.')
+    return json.loads(line.decode())
+
+
+def open_archived(path):
+    """
+    Open a chain file that may have been archived with compression (see [archive_file]) for reading as text. The file
+    is looked for under its own name, and then with the extension of every compression format. Return [None] if there
+    is no such file.
+
+    :param path: The path the file had before it was archived.
+    """
+    for compression, extension in COMPRESSION_FORMATS.items():
+        if not os.path.exists(path + extension):
+            continue
+        if compression == 'none':
+            return open(path)
+        if compression == 'gzip':
+            return gzip.open(path + extension, 'rt')
+        if compression == 'xz':
+            return lzma.open(path + extension, 'rt')
+        if zstandard is None:
+            raise RuntimeError('Reading %s requires the zstandard package.' % (path + extension))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path + extension, 'rb')))
+    return None
+
+
+def archived_chains(analyses_dir, alignment):
+    """
+    Return the names of the chains of an alignment that have an archived trace file, in order.
+
+    :param analyses_dir: The directory that the chain files of the alignment were archived in.
     :param alignment: The name of the alignment.
-    :param chains: A list of the names of the chains being run.
-    :param processes: A list of the [mpirun] processes running the chains.
-    :param output_dir: The output directory (where the output files are being moved to).
-    :param save_good_tree_chains: True if output chain files from good trees are to be kept, False if they are to be
-    deleted.
     """
-    # Stop all chain runs
-    terminate_all_processes(processes)
+    pattern = re.compile(r'^%s_(.+)\.trace(%s)?$' % (re.escape(alignment), '|'.join(
+        re.escape(extension) for extension in COMPRESSION_FORMATS.values() if extension)))
+    chains = [match.group(1) for match in map(pattern.match, os.listdir(analyses_dir)) if match]
+    return sorted(set(chains), key=lambda chain: [int(part) if part.isdigit() else part
+                                                  for part in re.split(r'(\d+)', chain)])
 
-    # Write output data to the log
-    generations_list = [0 for i in convergence.generations.items()]
-    for chain, generations in convergence.generations.items():
-        i = chains.index(chain)
-        generations_list[i] = generations
 
-    log_data = [alignment] + convergence.as_list() + generations_list
-    add_row_to_logfile(output_dir, *log_data)
+def replay_alignment(analyses_dir, alignment, chains, min_cycles, max_gen, max_loglik_effsize, min_loglik_rel_diff,
+                     min_maxdiff, timeline=None, check_freq=CHECK_FREQ, check_gens=None, burn_in=BURN_IN):
+    """
+    Replay the convergence checks of a finished run from its archived chain files, under a (possibly different) set of
+    thresholds, and return the outcome as a dictionary with the keys "alignment", "replay" ("good" or "bad" if the
+    chains would have been stopped, as converged or not, and "undecided" if the chains were not run for long enough to
+    tell), "replay_generations" (the generation at which the chains would have been stopped, or the last generation
+    replayed), "loglik_effsize", "loglik_rel_diff", "max_diff" and "checks" (the number of checks replayed).
 
-    # Now we need to move the output files to the correct directories
+    The chain files are copied into a scratch directory a check at a time, up to the generation of the check, and the
+    check is run on the copies with [check_thresholds], reusing the readers from check to check as a live run does.
+    Every chain is replayed up to the same generation at each check, so chains that ran at different speeds are treated
+    as if they had kept pace with the slowest one.
 
-    # If the chains converged, move the output tree file to good_trees, otherwise move it to bad_trees
-    # Also, rename it to [alignment].tre
-    save_chain_files = True
-    if convergence.converged:
-        # do we save the runs?
-        if not save_good_tree_chains:
-            save_chain_files = False
-        tree_dir = os.path.join(output_dir, 'good_trees')
+    This runs its own event loop, so that it can be run in a worker process (see [replay]).
+
+    :param analyses_dir: The directory that the chain files of the alignment were archived in.
+    :param alignment: The name of the alignment.
+    :param chains: A list of the names of the chains.
+    :param min_cycles: The minimum number of generations the chains must have before checking for convergence.
+    :param max_gen: The maximum number of generations for the chains to run before terminating regardless of
+    convergence.
+
+    Convergence thresholds:
+    :param max_loglik_effsize: The maximum log likelihood effective size.
+    :param min_loglik_rel_diff: The minimum log likelihood relative difference.
+    :param min_maxdiff: The minimum maximum difference.
+
+    :param timeline: A list of pairs (seconds since the chains were started, generations reached by the slowest chain)
+    from the original run, in order, as made by [run_timeline]. If given, the chains are checked every [check_freq]
+    seconds of the original run.
+    :param check_freq: The time between checks, in seconds.
+    :param check_gens: If given, or if there is no timeline, the chains are checked every this many generations instead.
+    Defaults to [CHECK_GENS] if there is no timeline.
+    :param burn_in: How to choose the burn-in; one of [BURN_IN_MODES].
+    """
+    if check_gens is None and not timeline:
+        check_gens = CHECK_GENS
+    if check_gens is None:
+        times, generations = zip(*timeline)
+        schedule = (int(np.interp(check_freq * (k + 1), times, generations))
+                    for k in range(int(times[-1] // check_freq)))
     else:
-        save_chain_files = True
-        tree_dir = os.path.join(output_dir, 'bad_trees')
+        schedule = (check_gens * (k + 1) for k in itertools.count())
+
+    sources = {}
+    targets = {}
+    scratch = tempfile.mkdtemp(prefix='ezpb-replay-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for chain in chains:
+            for file_type in ('.trace', '.treelist'):
+                name = '%s%s' % (chain_full_name(alignment, chain), file_type)
+                source = open_archived(os.path.join(analyses_dir, name))
+                if source is None:
+                    raise FileNotFoundError('No %s file for chain %s of alignment %s' % (file_type, chain, alignment))
+                sources[chain, file_type] = source
+                targets[chain, file_type] = open(os.path.join(scratch, name), 'w')
+
+        trace_readers = trace_readers_for(alignment, chains, scratch)
+        trace_diagnostics = TraceDiagnostics(trace_readers)
+        bipartition_index = bipartition_index_for(alignment, chains, scratch)
+        # the trace has a header line before the samples; both files have a sample for generation 0
+        copied = {key: -2 if key[1] == '.trace' else -1 for key in sources}
+        result = {'alignment': alignment, 'replay': 'undecided', 'replay_generations': 0, 'loglik_effsize': None,
+                  'loglik_rel_diff': None, 'max_diff': None, 'checks': 0}
+        previous = None
+        for generation in schedule:
+            if generation == previous:
+                continue
+            previous = generation
+            complete = True
+            for key, source in sources.items():
+                while copied[key] < generation:
+                    line = source.readline()
+                    if not line:
+                        complete = False
+                        break
+                    targets[key].write(line)
+                    copied[key] += 1
+                targets[key].flush()
+            if not complete:
+                break
+
+            convergence = loop.run_until_complete(check_thresholds(
+                alignment, chains, min_cycles, max_gen, max_loglik_effsize, min_loglik_rel_diff, min_maxdiff,
+                work_dir=scratch, trace_readers=trace_readers, trace_diagnostics=trace_diagnostics,
+                bipartition_index=bipartition_index, diagnostics='native', burn_in=burn_in, consensus='native'))
+            result['replay_generations'] = generation
+            if convergence is None:
+                continue
+            result['checks'] += 1
+            result.update(loglik_effsize=convergence.loglik_effsize, loglik_rel_diff=convergence.loglik_rel_diff,
+                          max_diff=convergence.max_diff)
+            if convergence.stop:
+                result['replay'] = 'good' if convergence.converged else 'bad'
+                break
+        return result
+    finally:
+        for file in itertools.chain(sources.values(), targets.values()):
+            file.close()
+        loop.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run_timeline(store, alignment):
+    """
+    Return the timeline of the last run of an alignment from the run-state store: a list of pairs (seconds since the
+    chains were started, generations reached by the slowest chain), one at the start, one for every check, and one when
+    the chains were stopped. Return an empty list if the store does not have the times of the run.
+
+    :param store: The [RunStore].
+    :param alignment: The name of the alignment.
+    """
+    started, finished = store.times(alignment)
+    if started is None or finished is None:
+        return []
+    timeline = [(0.0, 0)]
+    for check in store.checks(alignment):
+        if check['generations'] and started <= check['time'] <= finished:
+            timeline.append((check['time'] - started, min(check['generations'].values())))
+    generations = store.generations(alignment)
+    if generations:
+        timeline.append((finished - started, min(generations.values())))
+    return timeline if len(timeline) > 1 else []
 
-    move_output_files(
-        output_dir=output_dir,
-        tree_dir=tree_dir,
-        alignment=alignment,
-        save_chain_files=save_chain_files)
+
+def core_hours_saved(timeline, generation, cores):
+    """
+    Return the number of core hours that stopping the chains of a run at a generation would have saved, compared to
+    when they were stopped (negative if it would have taken longer), or [None] if the timeline does not cover it.
+
+    :param timeline: The timeline of the run, as returned by [run_timeline].
+    :param generation: The generation at which the chains would have been stopped.
+    :param cores: The number of cores the chains of the alignment ran on.
+    """
+    if not timeline:
+        return None
+    times, generations = zip(*timeline)
+    return cores * (times[-1] - float(np.interp(generation, generations, times))) / 3600
+
+
+def retriage_tree(output_dir, alignment, outcome):
+    """
+    Move the consensus tree of an alignment into good_trees or bad_trees, according to the outcome of a replay. Return
+    True if the tree was moved.
+
+    :param output_dir: The path to the output directory.
+    :param alignment: The name of the alignment.
+    :param outcome: The outcome of the replay, "good" or "bad".
+    """
+    tree_name = new_tree_file_name(alignment)
+    source_dir = os.path.join(output_dir, 'bad_trees' if outcome == 'good' else 'good_trees')
+    if not os.path.exists(os.path.join(source_dir, tree_name)):
+        return False
+    tree_dir = os.path.join(output_dir, '%s_trees' % outcome)
+    if not os.path.exists(tree_dir):
+        os.makedirs(tree_dir)
+    for file in (tree_name, new_tree_sample_file_name(alignment)):
+        if os.path.exists(os.path.join(source_dir, file)):
+            shutil.move(os.path.join(source_dir, file), os.path.join(tree_dir, file))
+    return True
 
 
 def apply_decorators(*decorators):
@@ -481,146 +4851,661 @@ def apply_decorators(*decorators):
     return dec
 
 
-@click.command()
-@click.option('--threads', type=int, default=N_THREADS,
-              help='How many threads the process should run on. Default: %d.' % N_THREADS)
-@click.option('--max-gen', type=int, default=MAX_GEN,
-              help='The maximum number of generations to run the process for. Default: %d.' % MAX_GEN)
-@click.option('--min-loglik-rel-diff', type=float, default=MIN_LOGLIK_REL_DIFF,
-              help='Threshold log likelihood relative difference. Default: %f.' % MIN_LOGLIK_REL_DIFF)
-@click.option('--max-loglik-effsize', type=int, default=MAX_LOGLIK_EFFSIZE,
-              help='Threshold log likelihood effective size difference. Default: %d.' % MAX_LOGLIK_EFFSIZE)
-@click.option('--min-maxdiff', type=float, default=MIN_MAXDIFF,
-              help='Threshold maximum difference. Default: %f.' % MIN_MAXDIFF)
-@click.option('--check-freq', type=float, default=CHECK_FREQ,
-              help='How often to check for convergence (in seconds). Default: %f.' % CHECK_FREQ)
-@click.option('--min-cycles', type=int, default=MIN_CYCLES,
-              help='How many generations to ignore before checking for convergence. Default: %d.' % MIN_CYCLES)
-@click.option('--out', type=str, default=OUTPUT_DIRECTORY,
-              help='The directory to store the output files in. Default: %s.' % OUTPUT_DIRECTORY)
-@click.option('--save-good-tree-chains', is_flag=True,
-              help='Save the .chain files for good trees as well as bad trees. '
-                   + 'If disabled, .chain files are only saved for bad trees.')
-@click.argument('alignments', type=click.Path(exists=True), required=True, nargs=-1)
-@click.argument('chains', type=int, required=True)
-def main(threads, alignments, chains, check_freq, min_cycles, out, save_good_tree_chains, **thresholds):
+class DefaultCommandGroup(click.Group):
+    """
+    A command group that falls back to a default command when the first argument is not the name of one of its
+    commands, so that [ezpb ALIGNMENTS... CHAINS] still runs the alignments.
+    """
+    def __init__(self, *args, **kwargs):
+        self.default_command = kwargs.pop('default_command')
+        super(DefaultCommandGroup, self).__init__(*args, **kwargs)
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args = [self.default_command] + list(args)
+        return super(DefaultCommandGroup, self).parse_args(ctx, args)
+
+
+@click.group(cls=DefaultCommandGroup, default_command='run')
+def cli():
+    """
+    Run PhyloBayes chains on alignments until they converge. Without a command, the arguments are passed to the run
+    command: ezpb [OPTIONS] ALIGNMENTS... CHAINS.
+    """
+
+
+# the options shared by every command that applies the convergence thresholds
+threshold_options = apply_decorators(
+    click.option('--max-gen', type=int, default=MAX_GEN,
+                 help='The maximum number of generations to run the process for. Default: %d.' % MAX_GEN),
+    click.option('--min-loglik-rel-diff', type=float, default=MIN_LOGLIK_REL_DIFF,
+                 help='Threshold log likelihood relative difference. Default: %f.' % MIN_LOGLIK_REL_DIFF),
+    click.option('--max-loglik-effsize', type=int, default=MAX_LOGLIK_EFFSIZE,
+                 help='Threshold log likelihood effective size difference. Default: %d.' % MAX_LOGLIK_EFFSIZE),
+    click.option('--min-maxdiff', type=float, default=MIN_MAXDIFF,
+                 help='Threshold maximum difference. Default: %f.' % MIN_MAXDIFF),
+)
+
+
+# the options of every command that runs alignments
+run_options = apply_decorators(
+    click.option('--threads', type=int, default=N_THREADS,
+                 help='How many threads the process should run on. Default: %d.' % N_THREADS),
+    threshold_options,
+    click.option('--check-freq', type=float, default=CHECK_FREQ,
+                 help='How often to check for convergence (in seconds); with --adaptive, the longest time between '
+                      + 'checks. Default: %f.' % CHECK_FREQ),
+    click.option('--min-cycles', type=int, default=MIN_CYCLES,
+                 help='How many generations to ignore before checking for convergence. Default: %d.' % MIN_CYCLES),
+    click.option('--out', type=str, default=OUTPUT_DIRECTORY,
+                 help='The directory to store the output files in. Default: %s.' % OUTPUT_DIRECTORY),
+    click.option('--save-good-tree-chains', is_flag=True,
+                 help='Save the .chain files for good trees as well as bad trees. '
+                      + 'If disabled, .chain files are only saved for bad trees.'),
+    click.option('--threads-per-chain', type=int, default=None,
+                 help='How many threads to run each chain on. If this leaves enough threads for the chains of several '
+                      + 'alignments, the alignments are processed concurrently. Default: sized for each alignment from '
+                      + 'its number of taxa, sites and datatype, with the most expensive alignments getting all '
+                      + 'threads divided by the number of chains.'),
+    click.option('--diagnostics', type=click.Choice(DIAGNOSTICS_MODES), default=DIAGNOSTICS,
+                 help='How to compute the convergence diagnostics: natively from the chain files, with the external '
+                      + 'tracecomp and bpcomp commands, or natively with tracecomp and bpcomp run alongside as a '
+                      + 'cross-check. Default: %s.' % DIAGNOSTICS),
+    click.option('--tiered/--no-tiered', default=TIERED,
+                 help='Only run the expensive tree test (max diff) once the log likelihood thresholds have been '
+                      + 'broken. Default: %s.' % ('tiered' if TIERED else 'no-tiered')),
+    click.option('--tree-check-every', type=int, default=TREE_CHECK_EVERY,
+                 help='With --tiered, run the tree test anyway on every this many checks, so that the max diff is '
+                      + 'still printed every so often; 0 to never run it early. Default: %d.' % TREE_CHECK_EVERY),
+    click.option('--adaptive/--fixed', default=ADAPTIVE,
+                 help='Schedule the convergence checks adaptively, by watching the chains\' trace files and checking '
+                      + 'once the chains have run for a number of generations that depends on how close they were to '
+                      + 'converging at the last check (with --check-freq as the longest time between checks), or check '
+                      + 'every --check-freq seconds. Default: %s.' % ('adaptive' if ADAPTIVE else 'fixed')),
+    click.option('--check-gens', type=int, default=CHECK_GENS,
+                 help='With --adaptive, the smallest number of new generations to wait for between checks. '
+                      + 'Default: %d.' % CHECK_GENS),
+    click.option('--resume', is_flag=True,
+                 help='Restart the chains of alignments whose earlier runs were interrupted (by Ctrl + C, an error, or '
+                      + 'the machine going down) from their checkpoints, rather than from scratch.'),
+    click.option('--compress', type=click.Choice(list(COMPRESSION_FORMATS)), default=COMPRESSION,
+                 help='The format to compress the chain files of finished alignments in (zstd needs the zstandard '
+                      + 'package). Default: %s.' % COMPRESSION),
+    click.option('--scratch', type=str, default=SCRATCH,
+                 help='A node-local directory (for example on tmpfs or a local SSD) to run the chains in. The chain '
+                      + 'files are synced to the output directory every --sync-freq seconds, and moved there once the '
+                      + 'chains have stopped. Default: %s.' % (SCRATCH or 'run the chains in the output directory')),
+    click.option('--sync-freq', type=float, default=SYNC_FREQ,
+                 help='With --scratch, how often to sync the chain files to the output directory (in seconds), so that '
+                      + 'the chains can be resumed if the node is lost. Default: %f.' % SYNC_FREQ),
+    click.option('--consensus', type=click.Choice(CONSENSUS_MODES), default=CONSENSUS,
+                 help='How to build the consensus tree of an alignment once its chains have stopped: natively (a '
+                      + 'majority-rule consensus of the trees sampled after the burn-in), or with bpcomp. '
+                      + 'Default: %s.' % CONSENSUS),
+    click.option('--treelists', type=click.Choice(TREELIST_MODES), default=TREELISTS,
+                 help='Whether to archive the full tree lists of alignments whose chain files are not saved, or only '
+                      + 'the trees sampled after the burn-in, which are always kept next to the consensus tree. '
+                      + 'Default: %s.' % TREELISTS),
+    click.option('--consensus-workers', type=int, default=CONSENSUS_WORKERS,
+                 help='How many consensus trees to build at the same time, in separate processes. '
+                      + 'Default: %d.' % CONSENSUS_WORKERS),
+    click.option('--archive-workers', type=int, default=ARCHIVE_WORKERS,
+                 help='How many finished alignments to archive at the same time, in the background. '
+                      + 'Default: %d.' % ARCHIVE_WORKERS),
+    click.option('--straggler-ratio', type=float, default=STRAGGLER_RATIO,
+                 help='Restart a chain from its checkpoint (on extra threads, if any are free) when it runs at less '
+                      + 'than this fraction of the speed of the fastest other chain of its alignment; 0 to never '
+                      + 'restart chains. Default: %f.' % STRAGGLER_RATIO),
+    click.option('--straggler-restarts', type=int, default=STRAGGLER_RESTARTS,
+                 help='How many times each chain may be restarted for running slowly. '
+                      + 'Default: %d.' % STRAGGLER_RESTARTS),
+    click.option('--pin/--no-pin', default=PIN_CORES,
+                 help='Pin every chain to its own set of cores, on a single NUMA node where possible. Default: %s.'
+                      % ('pin' if PIN_CORES else 'no-pin')),
+    click.option('--memory/--no-memory', 'memory_admission', default=MEMORY_ADMISSION,
+                 help='Only start the chains of an alignment once there is enough free memory for them, as estimated '
+                      + 'from the size of the alignment and the memory that earlier alignments were measured to use. '
+                      + 'Default: %s.' % ('memory' if MEMORY_ADMISSION else 'no-memory')),
+    click.option('--memory-headroom', type=float, default=MEMORY_HEADROOM,
+                 help='The fraction of the memory of the node (or of its cgroup) to keep free. Default: %f.'
+                      % MEMORY_HEADROOM),
+    click.option('--max-load', type=float, default=MAX_LOAD,
+                 help='Only start the chains of an alignment while the load average, counting the new chains, stays '
+                      + 'under this many times the number of cores; 0 to ignore the load. Default: %f.' % MAX_LOAD),
+    click.option('--early-abort/--no-early-abort', default=EARLY_ABORT,
+                 help='Stop the chains early, as not converged, once the history of their convergence checks projects '
+                      + 'that they will not converge before --max-gen. Default: %s.'
+                      % ('early-abort' if EARLY_ABORT else 'no-early-abort')),
+    click.option('--abort-confidence', type=float, default=ABORT_CONFIDENCE,
+                 help='With --early-abort, how sure the projection must be (between 0 and 1) before the chains are '
+                      + 'stopped. Default: %f.' % ABORT_CONFIDENCE),
+    click.option('--burn-in', type=click.Choice(BURN_IN_MODES), default=BURN_IN,
+                 help='How to choose the burn-in for the convergence diagnostics: detected from the log likelihood '
+                      + 'traces with a Geweke test, or a fixed tenth of the chains (up to %d generations). Default: %s.'
+                      % (MAX_GEN_DISCARD, BURN_IN)),
+    click.option('--telemetry/--no-telemetry', default=TELEMETRY,
+                 help='Write live statistics (chain throughput, check timings, queue depth, core use and projected '
+                      + 'completion times) to %s in the output directory, and to a Prometheus textfile. Default: %s.'
+                      % (TELEMETRY_FILE, 'telemetry' if TELEMETRY else 'no-telemetry')),
+    click.option('--prometheus-file', type=str, default=None,
+                 help='Where to write the Prometheus textfile, for example in the textfile directory of a node '
+                      + 'exporter. Implies --telemetry. Default: %s in the output directory.' % PROMETHEUS_FILE),
+)
+# the arguments of the commands that run a batch of alignments
+batch_arguments = apply_decorators(
+    click.argument('alignments', type=click.Path(exists=True), required=True, nargs=-1),
+    click.argument('chains', type=int, required=True),
+)
+
+
+@cli.command('run')
+@run_options
+@batch_arguments
+def main(**options):
     """
-    ALIGNMENTS: the paths to the alignment files to process. The alignments will be processed sequentially, and not in
-    parallel. To process in parallel, run several instances of this command, adjusting the number of threads
-    accordingly.
+    Run the chains of every alignment until they converge, or until they reach --max-gen.
+
+    ALIGNMENTS: the paths to the alignment files to process. The most expensive alignments (by their number of taxa,
+    sites and datatype) are started first. By default the chains of every alignment get a thread for every
+    cost_per_thread (in the configuration file) of its cost, up to all of the threads; if --threads-per-chain is set,
+    every chain gets that many instead. As many alignments are processed concurrently as the number of threads allows,
+    and a new alignment is started as soon as the chains of a previous one have stopped and freed up their threads.
 
     Alternatively, the paths can be to directories. In that case, all files of the relevant file type in the directory
-    will be processed sequentially. The file types that the command accepts can be set in the configuration file.
+    will be processed. The file types that the command accepts can be set in the configuration file.
 
-    CHAINS: the number of the chains to run in parallel. Threads will be shared evenly among the chains. The number of
-    chains must be at least two, but cannot be greater than the number of threads allocated.
+    CHAINS: the number of the chains to run in parallel for each alignment. The number of chains must be at least two,
+    but cannot be greater than the number of threads allocated.
     """
-    if chains < 2:
-        print('Error: Must specify at least two chains.')
+    run_batch(**options)
+
+
+@cli.command()
+@run_options
+@batch_arguments
+@click.option('--heartbeat', type=float, default=LEASE_HEARTBEAT,
+              help='How often to renew the lease on each alignment being run (in seconds). Default: %f.'
+                   % LEASE_HEARTBEAT)
+@click.option('--lease-timeout', type=float, default=LEASE_TIMEOUT,
+              help='How long after its last renewal a lease expires, so that another worker takes the alignment over '
+                   + '(in seconds). Default: %f.' % LEASE_TIMEOUT)
+def worker(heartbeat, lease_timeout, **options):
+    """
+    Run alignments as one of any number of workers, possibly on different nodes, that share an output directory on a
+    shared filesystem. The alignments form a job queue: each worker claims alignments by taking a lease on them, runs
+    and monitors their chains locally, and records the results in the output directory. A worker keeps renewing the
+    leases of the alignments it runs; if it stops (for example, because its node goes down), its leases expire, and
+    the other workers take its alignments over, resuming their chains from their checkpoints.
+
+    Every worker is given the same ALIGNMENTS and CHAINS, as for the run command. A worker exits once there is nothing
+    left for it to claim. Every worker keeps its run store and logfile in its own directory in the queue directory; the
+    first worker to find every alignment done merges them into the output directory.
+    """
+    if not 0 < heartbeat < lease_timeout:
+        print('Error: The heartbeat must be positive, and shorter than the lease timeout.')
         sys.exit(1)
+    run_batch(queue=LeaseQueue(os.path.join(options['out'], QUEUE_DIRECTORY), heartbeat=heartbeat,
+                               timeout=lease_timeout), **options)
+
+
+def run_options_error(threads, chains, threads_per_chain, compress, archive_workers, consensus_workers,
+                      abort_confidence, scratch, sync_freq, memory_headroom=MEMORY_HEADROOM, max_load=MAX_LOAD):
+    """
+    Return the error message for an invalid combination of the options of a command that runs alignments, or [None] if
+    they are valid. For details on the parameters, check the documentation of their command line options.
+    """
+    if chains < 2:
+        return 'Must specify at least two chains.'
     elif chains > threads:
-        print('Error: The number of chains cannot be less than the number of threads allocated.')
+        return 'The number of chains cannot be less than the number of threads allocated.'
+    elif threads_per_chain is not None and (threads_per_chain < 1 or threads_per_chain * chains > threads):
+        return 'The chains of one alignment cannot use more threads than are allocated.'
+    elif compress == 'zstd' and zstandard is None:
+        return 'zstd compression requires the zstandard package.'
+    elif archive_workers < 1 or consensus_workers < 1:
+        return 'Must archive with at least one worker.'
+    elif not 0 < abort_confidence < 1:
+        return 'The abort confidence must be between 0 and 1.'
+    elif scratch is not None and sync_freq <= 0:
+        return 'The sync frequency must be positive.'
+    elif not 0 <= memory_headroom < 1:
+        return 'The memory headroom must be at least 0 and less than 1.'
+    elif max_load < 0:
+        return 'The maximum load cannot be negative.'
+    return None
+
+
+def find_alignment_files(paths):
+    """
+    Return the paths to the alignment files given on the command line: the files themselves, and the files in the
+    given directories whose extensions are in [INPUT_FILE_TYPES]. A file that is given more than once is only returned
+    the first time. Name them with [alignment_names].
+
+    :param paths: The paths to alignment files, or to directories of alignment files.
+    """
+    alignment_files = []
+    for path in paths:
+        if os.path.isfile(path):
+            alignment_files.append(path)
+        else:
+            for file in os.listdir(path):
+                for file_type in INPUT_FILE_TYPES:
+                    if file.endswith(file_type):
+                        alignment_files.append(os.path.join(path, file))
+    seen = set()
+    unique_files = []
+    for alignment_file in alignment_files:
+        if os.path.abspath(alignment_file) not in seen:
+            seen.add(os.path.abspath(alignment_file))
+            unique_files.append(alignment_file)
+    return unique_files
+
+
+def open_output_dir(out, chain_names):
+    """
+    Create the output directory and its logfile if they do not exist yet, and open its [RunStore]. The logfile is
+    regenerated from the store if it has gone missing or was written by an older version.
+
+    :param out: The output directory.
+    :param chain_names: A list of the names of the chains, for the columns of the logfile.
+    """
+    # merge into the output directory if it exists
+    # if output directory does not exist, create it
+    # merging into the logfile happens "for free", i.e. there is no extra code required
+    try:
+        # create the output directory (unless a worker on another node has just done so)
+        os.makedirs(out)
+        # create a logfile
+        create_logfile(out, chain_names)
+    except FileExistsError:
+        pass
+
+    store = RunStore(out)
+    logfile = os.path.join(out, LOGFILE)
+    if not os.path.exists(logfile):
+        # the logfile has gone missing, so regenerate it from the store
+        store.export_csv(logfile, chain_names)
+    else:
+        with open(logfile) as f:
+            columns = [column.strip() for column in f.readline().split(',')]
+        if (columns[:len(LOGFILE_COLUMNS)] != LOGFILE_COLUMNS
+                or columns[-len(LOGFILE_EXTRA_COLUMNS):] != LOGFILE_EXTRA_COLUMNS):
+            # the logfile was written by an older version without the newer columns at the end, so rewrite it in the
+            # current format; the columns it had keep their positions
+            store.export_csv(logfile, chain_names)
+    return store
+
+
+def merge_worker_stores(output_dir, queue, chain_names):
+    """
+    Merge the run stores of the workers of a queue into the store of the output directory (see [RunStore.merge]),
+    regenerate the logfile of the output directory from it, and bundle the gene trees (see [write_gene_tree_bundle]).
+    Only one worker merges at a time. Return the number of trees in the bundle, or [None] if another worker is merging
+    already.
+
+    :param output_dir: The output directory.
+    :param queue: The [LeaseQueue] of the workers.
+    :param chain_names: A list of the names of the chains, for the columns of the logfile.
+    """
+    lease = queue.claim(MERGE_LEASE)
+    if lease is None:
+        return None
+    try:
+        store = open_output_dir(output_dir, chain_names)
+        try:
+            workers_dir = os.path.join(queue.directory, WORKERS_DIRECTORY)
+            for worker in sorted(os.listdir(workers_dir)) if os.path.exists(workers_dir) else []:
+                path = os.path.join(workers_dir, worker, RUN_STORE)
+                if os.path.exists(path):
+                    store.merge(path)
+            store.export_csv(os.path.join(output_dir, LOGFILE), chain_names)
+        finally:
+            store.close()
+        return write_gene_tree_bundle(output_dir)
+    finally:
+        lease.release()
+
+
+def core_placement(threads):
+    """
+    Return a [CorePlacement] for a budget of [threads] cores, or [None], with a warning, if fewer cores are available.
+
+    :param threads: The number of cores in the budget.
+    """
+    placement = CorePlacement()
+    if placement.cores < threads:
+        warnings.warn('Only %d cores are available for %d threads, so the chains are not pinned.'
+                      % (placement.cores, threads), UserWarning)
+        return None
+    return placement
+
+
+def run_batch(threads, alignments, chains, check_freq, min_cycles, out, save_good_tree_chains, threads_per_chain,
+              diagnostics, tiered, tree_check_every, adaptive, check_gens, resume, compress, scratch, sync_freq,
+              consensus, treelists, consensus_workers, archive_workers, straggler_ratio, straggler_restarts, pin,
+              memory_admission, memory_headroom, max_load, early_abort, abort_confidence, burn_in, telemetry,
+              prometheus_file, queue=None, **thresholds):
+    """
+    Run a batch of alignments, for the run and worker commands. For details on the parameters, check the documentation
+    of their command line options.
+
+    :param queue: The [LeaseQueue] to claim the alignments from, if this is a worker. Every alignment that this worker
+    takes over is resumed from its checkpoints, if it has any. The run store, the logfile and the telemetry of the
+    worker are written to its own directory in the queue directory, and merged into the output directory once every
+    alignment is done (see [merge_worker_stores]).
+    """
+    error = run_options_error(threads, chains, threads_per_chain, compress, archive_workers, consensus_workers,
+                              abort_confidence, scratch, sync_freq, memory_headroom, max_load)
+    if error is not None:
+        print('Error: %s' % error)
         sys.exit(1)
     else:
         # generate some chain names
         chain_names = [('chain_%d' % (j + 1)) for j in range(chains)]
         print('Chains: %s' % ', '.join(chain_names))
 
-        # merge into the output directory if it exists
-        # if output directory does not exist, create it
-        # merging into the logfile happens "for free", i.e. there is no extra code required
-        output_dir_exists = os.path.exists(out)
-
-        if not output_dir_exists:
-            # create the output directory
-            os.mkdir(out)
-            # create a logfile
-            create_logfile(out, chain_names)
-
-        alignment_files = []
-        for path in alignments:
-            if os.path.isfile(path):
-                alignment_files.append(path)
-            else:
-                for file in os.listdir(path):
-                    for file_type in INPUT_FILE_TYPES:
-                        if file.endswith(file_type):
-                            alignment_files.append(os.path.join(path, file))
-
-        # sequentially process each alignment
-        for alignment_file in alignment_files:
-            # The name of the alignment
-            name = alignment_name(alignment_file)
-            # The directory that the alignment file is in
-            root_dir = file_directory(alignment_file)
-
-            # first, check to see if it's already been done
-            # we can do this by checking the logfile
-            skip_alignment = False
-            if output_dir_exists:
-                with open(os.path.join(out, LOGFILE)) as csv_fp:
-                    reader = csv.DictReader(csv_fp)
-                    for row in reader:
-                        if name == row['alignment']:
-                            # the alignment is in the logfile, therefore it has already been run
-                            skip_alignment = True
-
-            if skip_alignment:
+        # every alignment must have a name of its own, since its chains run in a directory named after it
+        try:
+            names = alignment_names(find_alignment_files(alignments))
+        except ValueError as e:
+            print('Error: %s' % e)
+            sys.exit(1)
+
+        # first, check to see which alignments have already been done
+        # we can do this by checking the run-state store (which takes over the logfile if there is no store yet), or,
+        # for a worker, the queue, which takes over the alignments that an earlier run finished
+        store_dir = out
+        if queue is not None:
+            store_dir = os.path.join(queue.directory, WORKERS_DIRECTORY, queue.worker)
+            os.makedirs(store_dir, exist_ok=True)
+            for name in RunStore.finished_in(out):
+                queue.mark_done(name)
+        store = open_output_dir(store_dir, chain_names)
+        is_done = store.is_done if queue is None else queue.is_done
+        pending_files = []
+        for alignment_file, name in names.items():
+            if is_done(name):
                 click.echo('Skipping alignment %s.' % name)
-                continue
+            else:
+                pending_files.append(alignment_file)
+
+        # start the most expensive alignments first, and size their chains by how expensive they are
+        plan = plan_alignments(pending_files, threads // chains, threads_per_chain)
+        for alignment_file, alignment_threads in plan:
+            click.echo('Alignment %s: %d thread(s) per chain.' % (names[alignment_file], alignment_threads))
+        pending_files = [alignment_file for alignment_file, alignment_threads in plan]
+
+        # the output files of finished alignments are archived in the background while the next ones run
+        archiver = Archiver(archive_workers, compress, consensus, consensus_workers, treelists)
+        telemetry = Telemetry(store_dir, prometheus_file) if telemetry or prometheus_file else None
+        placement = core_placement(threads) if pin else None
+        admission = None
+        if memory_admission or max_load > 0:
+            admission = AdmissionControl(memory_admission, memory_headroom, max_load, store.memory_ratios())
+
+        # This event loop blocks execution until every alignment is done
+        loop = asyncio.get_event_loop()
+        run = run_alignments if queue is None else partial(run_worker, queue)
+        batch = asyncio.ensure_future(run(
+            pending_files, chain_names, threads, dict(plan), out, save_good_tree_chains, check_freq,
+            min_cycles, store=store, resume=resume or queue is not None, archiver=archiver, telemetry=telemetry,
+            diagnostics=diagnostics,
+            tiered=tiered, tree_check_every=tree_check_every, adaptive=adaptive, check_gens=check_gens,
+            straggler_ratio=straggler_ratio, straggler_restarts=straggler_restarts, placement=placement,
+            admission=admission, names=names, early_abort=early_abort, abort_confidence=abort_confidence,
+            burn_in=burn_in, consensus=consensus, log_dir=store_dir,
+            scratch=scratch, sync_freq=sync_freq, **thresholds))
+        try:
+            loop.run_until_complete(batch)
+        except KeyboardInterrupt:
+            # stop all chains and save their output files before exiting
+            batch.cancel()
+            loop.run_until_complete(asyncio.gather(batch, return_exceptions=True))
+            raise
+        finally:
+            archiver.shutdown()
+            store.close()
+
+        if queue is None:
+            bundled = write_gene_tree_bundle(out)
+        else:
+            bundled = merge_worker_stores(out, queue, chain_names)
+        print('All alignment chains finished.')
+        if bundled is None:
+            print('Another worker is merging the results of the workers.')
+        else:
+            print('Bundled the trees of %d good alignment(s) into %s.' % (bundled, os.path.join(out, GENE_TREES_FILE)))
+
+
+@cli.command()
+@run_options
+@click.option('--socket', 'socket_path', type=str, default=None,
+              help='The Unix socket to accept submissions on. Default: %s in the output directory.' % SOCKET_FILE)
+@click.argument('chains', type=int, required=True)
+def serve(threads, chains, out, socket_path, save_good_tree_chains, threads_per_chain, compress, scratch, sync_freq,
+          consensus, treelists, consensus_workers, archive_workers, pin, memory_admission, memory_headroom, max_load,
+          abort_confidence, telemetry, prometheus_file, **run_options):
+    """
+    Run a long-lived server that owns the cores given by --threads, and runs the alignments submitted to it with
+    [ezpb submit] as cores become free. Submissions from any number of clients share the same cores, so pipelines can
+    stream alignments to a single server rather than starting several EZ-PB processes that compete for the node.
+    The server takes the same options as the run command, and uses them for every alignment submitted to it. Stop it
+    with Ctrl + C, or with a SIGTERM; the alignments that are still running are then interrupted as for the run command.
+
+    CHAINS: the number of the chains to run in parallel for each alignment.
+    """
+    error = run_options_error(threads, chains, threads_per_chain, compress, archive_workers, consensus_workers,
+                              abort_confidence, scratch, sync_freq, memory_headroom, max_load)
+    if error is not None:
+        print('Error: %s' % error)
+        sys.exit(1)
+
+    chain_names = [('chain_%d' % (j + 1)) for j in range(chains)]
+    store = open_output_dir(out, chain_names)
+    socket_path = socket_path or os.path.join(out, SOCKET_FILE)
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'command': 'status'})
+        except OSError:
+            # left behind by a server that did not shut down cleanly
+            os.remove(socket_path)
+        else:
+            print('Error: A server is already listening on %s.' % socket_path)
+            sys.exit(1)
+
+    archiver = Archiver(archive_workers, compress, consensus, consensus_workers, treelists)
+    server = AlignmentServer(
+        chain_names, threads, os.path.abspath(out), store, threads_per_chain=threads_per_chain,
+        telemetry=Telemetry(out, prometheus_file) if telemetry or prometheus_file else None,
+        placement=core_placement(threads) if pin else None,
+        admission=AdmissionControl(memory_admission, memory_headroom, max_load, store.memory_ratios())
+        if memory_admission or max_load > 0 else None, save_good_tree_chains=save_good_tree_chains,
+        archiver=archiver, abort_confidence=abort_confidence, consensus=consensus, scratch=scratch,
+        sync_freq=sync_freq, **run_options)
 
-            processes = []
-            threads_per_chain = threads / chains
+    loop = asyncio.get_event_loop()
+    serving = asyncio.ensure_future(server.serve(socket_path))
+    loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        loop.run_until_complete(serving)
+    except KeyboardInterrupt:
+        serving.cancel()
+        loop.run_until_complete(asyncio.gather(serving, return_exceptions=True))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        archiver.shutdown()
+        store.close()
+    write_gene_tree_bundle(out)
+
+
+@cli.command()
+@click.option('--out', type=str, default=OUTPUT_DIRECTORY,
+              help='The output directory of the server. Default: %s.' % OUTPUT_DIRECTORY)
+@click.option('--socket', 'socket_path', type=str, default=None,
+              help='The Unix socket of the server. Default: %s in the output directory.' % SOCKET_FILE)
+@click.option('--status', is_flag=True, help='Print the status of the alignments submitted to the server instead.')
+@click.option('--cancel', is_flag=True, help='Stop the alignments with the given names instead.')
+@click.argument('alignments', type=str, nargs=-1)
+def submit(out, socket_path, status, cancel, alignments):
+    """
+    Submit alignments to a running [ezpb serve], or query or cancel them.
+
+    ALIGNMENTS: the paths to the alignment files (or directories of alignment files) to run or, with --cancel, the
+    names of the alignments to stop.
+    """
+    socket_path = socket_path or os.path.join(out, SOCKET_FILE)
+    if status:
+        request = {'command': 'status'}
+    elif cancel:
+        request = {'command': 'cancel', 'alignments': list(alignments)}
+    else:
+        missing = [path for path in alignments if not os.path.exists(path)]
+        if not alignments or missing:
+            print('Error: Must specify existing alignment files or directories. Missing: %s' % ', '.join(missing))
+            sys.exit(1)
+        # the alignments are named as the run command would name them, but the server does not share the working
+        # directory of the client
+        try:
+            names = alignment_names(find_alignment_files(alignments))
+        except ValueError as e:
+            print('Error: %s' % e)
+            sys.exit(1)
+        request = {'command': 'submit', 'alignments': [[name, os.path.abspath(alignment_file)]
+                                                       for alignment_file, name in names.items()]}
+
+    try:
+        reply = send_request(socket_path, request)
+    except OSError as e:
+        print('Error: Cannot reach the server on %s: %s' % (socket_path, e))
+        sys.exit(1)
+    if not reply['ok']:
+        print('Error: %s' % reply['error'])
+        sys.exit(1)
+
+    if status:
+        for alignment in reply['alignments']:
+            generations = ', '.join('%s: %d' % item for item in sorted(alignment['generations'].items()))
+            click.echo('%s\t%s\t%s%s' % (alignment['name'], alignment['status'], generations,
+                                          '\t%s' % alignment['error'] if alignment['error'] else ''))
+        click.echo('Cores: %d of %d free, %d alignment(s) waiting.'
+                   % (reply['cores_free'], reply['cores'], reply['waiting']))
+    elif cancel:
+        click.echo('Cancelled: %s' % (', '.join(reply['cancelled']) or 'none'))
+    else:
+        click.echo('Submitted: %s' % (', '.join(reply['submitted']) or 'none'))
+        if reply['skipped']:
+            click.echo('Skipped (done, or already queued): %s' % ', '.join(reply['skipped']))
+
+
+@cli.command()
+@threshold_options
+@click.option('--check-freq', type=float, default=CHECK_FREQ,
+              help='How often to replay a check, in seconds of the original run. Default: %f.' % CHECK_FREQ)
+@click.option('--check-gens', type=int, default=None,
+              help='Replay a check every this many generations instead. Default: every --check-freq seconds, or '
+                   + 'every %d generations for alignments whose run times were not recorded.' % CHECK_GENS)
+@click.option('--min-cycles', type=int, default=MIN_CYCLES,
+              help='How many generations to ignore before checking for convergence. Default: %d.' % MIN_CYCLES)
+@click.option('--burn-in', type=click.Choice(BURN_IN_MODES), default=BURN_IN,
+              help='How to choose the burn-in for the convergence diagnostics. Default: %s.' % BURN_IN)
+@click.option('--out', type=str, default=OUTPUT_DIRECTORY,
+              help='The output directory of the runs to replay. Default: %s.' % OUTPUT_DIRECTORY)
+@click.option('--threads-per-chain', type=int, default=1,
+              help='How many threads each chain ran on, to count the core hours saved or lost. Default: 1.')
+@click.option('--workers', type=int, default=N_THREADS,
+              help='How many alignments to replay at the same time, in separate processes. Default: %d.' % N_THREADS)
+@click.option('--report', type=str, default=None,
+              help='A CSV file to write the outcome of every alignment to.')
+@click.option('--retriage', is_flag=True,
+              help='Move the trees of alignments whose outcome changes between good_trees and bad_trees.')
+@click.argument('alignments', type=str, nargs=-1)
+def replay(check_freq, check_gens, min_cycles, burn_in, out, threads_per_chain, workers, report, retriage,
+           alignments, **thresholds):
+    """
+    Replay the convergence checks of finished runs from their chain files in the output directory, under a new set of
+    thresholds, without running any chains. For every alignment, print the generation at which its chains would have
+    been stopped, whether its tree would have been good or bad, and the core hours that this would have saved or cost.
+
+    ALIGNMENTS: the names of the alignments to replay. Default: every alignment with chain files in the output
+    directory.
+    """
+    analyses_dir = os.path.join(out, 'analyses')
+    if not os.path.isdir(analyses_dir):
+        print('Error: There are no chain files in %s.' % analyses_dir)
+        sys.exit(1)
+    elif workers < 1:
+        print('Error: Must replay with at least one worker.')
+        sys.exit(1)
 
-            # generate specific chain file names
-            chain_full_names = [chain_full_name(name, chain_name)
-                                for chain_name in chain_names]
+    store = RunStore(out) if os.path.exists(os.path.join(out, RUN_STORE)) else None
+    names = alignments or sorted(os.listdir(analyses_dir))
+    jobs = []
+    for name in names:
+        chains = archived_chains(os.path.join(analyses_dir, name), name) \
+            if os.path.isdir(os.path.join(analyses_dir, name)) else []
+        if len(chains) < 2:
+            warnings.warn('Alignment %s does not have the chain files of at least two chains to replay.' % name,
+                          UserWarning)
+            continue
+        timeline = run_timeline(store, name) if store is not None else []
+        status = store.status(name) if store is not None else None
+        original = {RunStore.CONVERGED: 'good', RunStore.NOT_CONVERGED: 'bad'}.get(status)
+        if original is None:
+            # fall back on where the tree ended up
+            original = next((outcome for outcome in ('good', 'bad')
+                             if os.path.exists(os.path.join(out, '%s_trees' % outcome, new_tree_file_name(name)))),
+                            'unknown')
+        jobs.append((name, chains, timeline, original))
+    if store is not None:
+        store.close()
 
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(replay_alignment, os.path.join(analyses_dir, name), name, chains, min_cycles,
+                                   timeline=timeline, check_freq=check_freq, check_gens=check_gens, burn_in=burn_in,
+                                   **thresholds)
+                   for name, chains, timeline, original in jobs]
+        for (name, chains, timeline, original), future in zip(jobs, futures):
             try:
-                for chain_name in chain_full_names:
-                    cmd = mpirun_cmd(threads_per_chain, alignment_file, chain_name)
-                    click.echo('Starting run: %s' % ' '.join(cmd))
-                    # open it and start running
-                    process = subprocess.Popen(cmd)
-                    processes.append(process)
-
-                callback = partial(check_fail_callback,
-                                   alignment=name,
-                                   chains=chain_names,
-                                   processes=processes,
-                                   output_dir=out,
-                                   save_good_tree_chains=save_good_tree_chains)
-
-                # This event loop blocks execution until it's done, thus preventing the next alignment from being
-                # processed until this one is done:
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(check_thresholds_periodic(
-                    name, chain_names, callback, check_freq, min_cycles, **thresholds))
-
-                print('Alignment %s chains finished processing.' % alignment)
-            except BaseException:  # so that it catches KeyboardInterrupts
-                # Upon an exception:
-                # 1. Stop all chains
-                # 2. Move all chain output files to output/analyses
-                # 3. Move output tree file to output/incomplete_trees
-
-                # Step 1:
-                print('Exception raised, terminating all chains...')
-                terminate_all_processes(processes)
-
-                # Steps 2 & 3:
-                print('Saving output files...')
-                tree_dir = os.path.join(out, 'incomplete_trees')
-
-                # Save runs because the tree is incomplete
-                move_output_files(
-                    output_dir=out,
-                    tree_dir=tree_dir,
-                    alignment=name,
-                    save_chain_files=True,
-                    root_dir=root_dir)
-                raise
-            finally:
-                terminate_all_processes(processes)
+                result = future.result()
+            except Exception as e:
+                warnings.warn('Alignment %s could not be replayed: %s' % (name, e), UserWarning)
+                continue
+            result['original'] = original
+            result['original_generations'] = timeline[-1][1] if timeline else None
+            saved = None
+            if result['replay'] != 'undecided':
+                saved = core_hours_saved(timeline, result['replay_generations'], threads_per_chain * len(chains))
+            result['core_hours_saved'] = saved
+            rows.append(result)
+
+            message = 'Alignment %s: %s at generation %d (originally %s)' % (
+                name, 'undecided' if result['replay'] == 'undecided' else result['replay'],
+                result['replay_generations'], original)
+            if saved is not None:
+                message += ', %.2f core hours %s' % (abs(saved), 'saved' if saved >= 0 else 'lost')
+            click.echo(message + '.')
+            if retriage and result['replay'] in ('good', 'bad') and result['replay'] != original:
+                if retriage_tree(out, name, result['replay']):
+                    click.echo('Moved the tree of alignment %s to %s_trees.' % (name, result['replay']))
+
+    if retriage:
+        # the good trees may have changed
+        write_gene_tree_bundle(out)
+
+    if report is not None:
+        with open(report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPLAY_REPORT_COLUMNS)
+            for row in rows:
+                writer.writerow([row[column] for column in REPLAY_REPORT_COLUMNS])
 
-            print('All alignment chains finished.')
+    outcomes = collections.Counter(row['replay'] for row in rows)
+    changed = sum(1 for row in rows if row['replay'] in ('good', 'bad') and row['replay'] != row['original'])
+    saved = [row['core_hours_saved'] for row in rows if row['core_hours_saved'] is not None]
+    click.echo('Replayed %d alignment(s): %d good, %d bad, %d undecided; %d changed outcome.'
+               % (len(rows), outcomes['good'], outcomes['bad'], outcomes['undecided'], changed))
+    if saved:
+        total = sum(saved)
+        click.echo('In total, %.2f core hours %s.' % (abs(total), 'saved' if total >= 0 else 'lost'))
@@ -9,10 +9,14 @@ setup(
         '': ['*.ini', 'tracecomp', 'pb_mpi']
     },
     install_requires=[
-        'Click'
+        'Click',
+        'numpy'
     ],
+    extras_require={
+        'zstd': ['zstandard']
+    },
     entry_points='''
         [console_scripts]
-        ezpb=ezpb:main
+        ezpb=ezpb:cli
     '''
 )
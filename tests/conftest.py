@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tests run against the EZ-PB module of this repository, whether or not it is installed
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
@@ -0,0 +1,93 @@
+"""
+Tests for the native convergence diagnostics: the effective sample size and the bipartition counts.
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+import ezpb
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'reference')
+
+T1 = '((a,b),(c,d),e);'
+T2 = '((a,c),(b,d),e);'
+
+
+def reference_outputs():
+    with open(os.path.join(REFERENCE_DIR, 'reference.json')) as f:
+        return json.load(f)
+
+
+def write_treelist(path, trees):
+    with open(str(path), 'w') as f:
+        f.write('\n'.join(trees) + '\n')
+    return str(path)
+
+
+@pytest.mark.parametrize('output', reference_outputs())
+def test_effective_sample_size_matches_tracecomp(output):
+    for chain, expected in zip(output['chains'], output['chain_effsizes']):
+        reader = ezpb.TraceReader(os.path.join(REFERENCE_DIR, '%s.trace' % chain))
+        reader.update()
+        values = reader.column(ezpb.LOGLIK_COLUMN)[output['discard']:]
+        assert int(ezpb.effective_sample_size(values)) == expected
+
+
+def test_effective_sample_size_of_a_constant_series():
+    assert ezpb.effective_sample_size(np.full(100, -2000.0)) == 100
+
+
+def test_effective_sample_size_of_correlated_samples():
+    rng = np.random.RandomState(0)
+    independent = rng.normal(size=2000)
+    correlated = np.zeros(2000)
+    for i in range(1, 2000):
+        correlated[i] = 0.9 * correlated[i - 1] + independent[i]
+
+    assert ezpb.effective_sample_size(independent) > 1000
+    assert ezpb.effective_sample_size(correlated) < 400
+
+
+def test_split_counter_samples_every_tree_after_the_burn_in(tmp_path):
+    # the second chain alternates between two topologies, starting with the one that the first chain always has
+    index = ezpb.BipartitionIndex({'same': write_treelist(tmp_path / 'same.treelist', [T1] * 20),
+                                   'alternating': write_treelist(tmp_path / 'alternating.treelist', [T1, T2] * 10)},
+                                  every=1)
+    assert index.max_diff(0) == pytest.approx(0.5)
+
+
+def test_split_counter_starts_at_the_every_th_tree(tmp_path):
+    index = ezpb.BipartitionIndex({'same': write_treelist(tmp_path / 'same.treelist', [T1] * 20),
+                                   'alternating': write_treelist(tmp_path / 'alternating.treelist', [T1, T2] * 10)},
+                                  every=2)
+    # like bpcomp, the first tree sampled is the second one after the burn-in, so only the other topology is sampled
+    assert index.max_diff(0) == pytest.approx(1.0)
+    assert index.max_diff(1) == pytest.approx(0.0)
+    # and moving the burn-in back again gives the same counts as before
+    assert index.max_diff(0) == pytest.approx(1.0)
+
+
+def test_split_counter_counts_the_trees_appended_since_the_last_use(tmp_path):
+    path = write_treelist(tmp_path / 'chain.treelist', [T1] * 4)
+    treelist = ezpb.TreelistReader(path, ezpb.SplitTable())
+    counter = ezpb.SplitCounter(treelist, 2)
+    treelist.update()
+    assert counter.frequencies(0)[1] == 2
+
+    with open(path, 'a') as f:
+        f.write('\n'.join([T2] * 4) + '\n')
+    treelist.update()
+    frequencies, sampled = counter.frequencies(0)
+    assert sampled == 4
+    # the two topologies share no bipartition, and each is half of the sample
+    assert list(frequencies[frequencies > 0]) == [0.5] * 4
+
+
+@pytest.mark.parametrize('output', [output for output in reference_outputs() if output['discard']])
+def test_bipartition_index_matches_bpcomp(output):
+    for every, expected in output['max_diff'].items():
+        index = ezpb.BipartitionIndex({chain: os.path.join(REFERENCE_DIR, '%s.treelist' % chain)
+                                       for chain in output['chains']}, int(every))
+        assert index.max_diff(output['discard']) == pytest.approx(expected, abs=1e-6)
@@ -0,0 +1,120 @@
+"""
+Tests for naming the alignments, sharing the cores between them, and the job queue of the workers.
+"""
+import asyncio
+import os
+
+import pytest
+
+import ezpb
+
+
+def test_alignment_names_do_not_depend_on_the_other_alignments():
+    alone = ezpb.alignment_names(['alns/a.phy'])
+    with_others = ezpb.alignment_names(['alns/a.phy', 'data/set1/b.phy', 'c.phy'])
+
+    assert alone['alns/a.phy'] == with_others['alns/a.phy'] == 'a.phy'
+    assert with_others['data/set1/b.phy'] == 'set1--b.phy'
+    assert with_others['c.phy'] == 'c.phy'
+
+
+def test_alignment_names_keep_the_order_of_the_files():
+    files = ['alns/c.phy', 'alns/a.phy', 'alns/b.phy']
+    assert list(ezpb.alignment_names(files)) == files
+
+
+def test_alignment_names_refuse_two_files_with_the_same_name():
+    with pytest.raises(ValueError):
+        ezpb.alignment_names(['d1/x/a.phy', 'd2/x/a.phy'])
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_core_budget_serves_requests_in_order():
+    async def scenario():
+        budget = ezpb.CoreBudget(4)
+        await budget.acquire(3)
+        order = []
+
+        async def request(name, cores):
+            await budget.acquire(cores)
+            order.append(name)
+
+        large = asyncio.ensure_future(request('large', 4))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(request('small', 1))
+        await asyncio.sleep(0)
+        # the free core is not handed to the small request while the large one waits ahead of it
+        assert order == [] and budget.waiting == 2
+        assert not budget.try_acquire(1)
+
+        budget.release(3)
+        await large
+        assert order == ['large'] and budget.free == 0
+        budget.release(4)
+        await small
+        assert order == ['large', 'small'] and budget.free == 3
+
+    run(scenario())
+
+
+def test_core_budget_gives_back_the_cores_of_a_cancelled_request():
+    async def scenario():
+        budget = ezpb.CoreBudget(2)
+        await budget.acquire(2)
+        waiting = asyncio.ensure_future(budget.acquire(2))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert budget.waiting == 0
+
+        budget.release(2)
+        assert budget.try_acquire(2)
+
+    run(scenario())
+
+
+def test_lease_queue_lets_one_worker_claim_an_alignment(tmp_path):
+    first = ezpb.LeaseQueue(str(tmp_path), worker='first')
+    second = ezpb.LeaseQueue(str(tmp_path), worker='second')
+
+    lease = first.claim('a.phy')
+    assert lease is not None and lease.owned()
+    assert second.claim('a.phy') is None
+
+    lease.release()
+    assert second.claim('a.phy') is not None
+
+
+def test_lease_queue_takes_over_an_expired_lease(tmp_path):
+    first = ezpb.LeaseQueue(str(tmp_path), worker='first')
+    second = ezpb.LeaseQueue(str(tmp_path), worker='second', timeout=60)
+
+    lease = first.claim('a.phy')
+    old = os.path.getmtime(lease.path) - 120
+    os.utime(lease.path, (old, old))
+
+    taken = second.claim('a.phy')
+    assert taken is not None and taken.worker == 'second'
+    # the first worker finds out that it has lost the alignment when it next renews its lease
+    assert not lease.renew() and lease.lost
+    lease.release()
+    assert taken.owned()
+
+
+def test_lease_queue_never_hands_out_a_done_alignment(tmp_path):
+    queue = ezpb.LeaseQueue(str(tmp_path), worker='first', timeout=0)
+    lease = queue.claim('a.phy')
+    queue.mark_done('a.phy')
+    lease.release()
+
+    assert queue.is_done('a.phy')
+    assert not queue.claimable('a.phy')
+    assert ezpb.LeaseQueue(str(tmp_path), worker='second').claim('a.phy') is None
@@ -0,0 +1,81 @@
+"""
+Tests for the run-state store and the CSV logfile.
+"""
+import os
+
+import ezpb
+
+CHAINS = ['chain_1', 'chain_2']
+
+
+def convergence(converged, generations, effsize=300):
+    return ezpb.Convergence(True, converged, effsize, 0.1, 0.05, dict(zip(CHAINS, generations)))
+
+
+def write_logfile(directory, lines):
+    with open(os.path.join(str(directory), ezpb.LOGFILE), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def test_import_csv_reads_the_current_layout(tmp_path):
+    write_logfile(tmp_path, ['alignment, converged, loglik_effsize, loglik_rel_diff, max_diff, chain_1, chain_2, '
+                             'aborted, projected_gen',
+                             'a.phy, True, 300, 0.1, 0.05, 1000, 1010, False, None',
+                             'b.phy, False, 20, 0.9, 0.5, 30000, 30004, True, 120000.0'])
+    store = ezpb.RunStore(str(tmp_path))
+
+    assert store.alignments() == ['a.phy', 'b.phy']
+    assert store.alignments(ezpb.RunStore.CONVERGED) == ['a.phy']
+    assert store.is_done('b.phy')
+    assert store.generations('a.phy') == {'chain_1': 1000, 'chain_2': 1010}
+
+
+def test_import_csv_reads_a_logfile_without_the_newer_columns(tmp_path):
+    write_logfile(tmp_path, ['alignment, converged, loglik_effsize, loglik_rel_diff, max_diff, chain_1, chain_2',
+                             'a.phy, True, 300, 0.1, 0.05, 1000, 1010'])
+    store = ezpb.RunStore(str(tmp_path))
+
+    assert store.is_done('a.phy')
+    assert store.generations('a.phy') == {'chain_1': 1000, 'chain_2': 1010}
+
+
+def test_export_csv_puts_the_newer_columns_after_the_chains(tmp_path):
+    store = ezpb.RunStore(str(tmp_path))
+    store.start('a.phy', 'alns/a.phy')
+    store.finish('a.phy', convergence(True, [1000, 1010]))
+    path = os.path.join(str(tmp_path), 'exported.csv')
+    store.export_csv(path, CHAINS)
+
+    with open(path) as f:
+        header, row = [[value.strip() for value in line.split(',')] for line in f.read().splitlines()]
+    assert header == ezpb.LOGFILE_COLUMNS + CHAINS + ezpb.LOGFILE_EXTRA_COLUMNS
+    assert row[:len(ezpb.LOGFILE_COLUMNS)] == ['a.phy', 'True', '300', '0.1', '0.05']
+    assert row[len(ezpb.LOGFILE_COLUMNS):][:len(CHAINS)] == ['1000', '1010']
+
+
+def test_merge_keeps_the_finished_run(tmp_path):
+    main_dir, worker_dir = tmp_path / 'main', tmp_path / 'worker'
+    main_dir.mkdir()
+    worker_dir.mkdir()
+    main, worker = ezpb.RunStore(str(main_dir)), ezpb.RunStore(str(worker_dir))
+
+    main.start('a.phy', 'alns/a.phy')
+    main.record_check('a.phy', convergence(False, [500, 500], effsize=50))
+    main.finish('a.phy', convergence(True, [1000, 1010]))
+    # a worker that started the alignment again later, and never finished it, does not undo the finished run
+    worker.start('a.phy', 'alns/a.phy')
+    worker.record_check('a.phy', convergence(False, [200, 200], effsize=10))
+    worker.start('b.phy', 'alns/b.phy')
+    worker.finish('b.phy', convergence(False, [30000, 30000]))
+    worker.close()
+
+    main.merge(os.path.join(str(worker_dir), ezpb.RUN_STORE))
+    assert main.alignments(ezpb.RunStore.CONVERGED) == ['a.phy']
+    assert main.alignments(ezpb.RunStore.NOT_CONVERGED) == ['b.phy']
+    assert main.generations('a.phy') == {'chain_1': 1000, 'chain_2': 1010}
+    assert [check['loglik_effsize'] for check in main.checks('a.phy')] == [50, 10]
+
+    # merging the same store again changes nothing
+    main.merge(os.path.join(str(worker_dir), ezpb.RUN_STORE))
+    assert len(main.checks('a.phy')) == 2
+    assert main.alignments() == ['a.phy', 'b.phy']